@@ -8,13 +8,15 @@
 """
 
 # https://click.palletsprojects.com/en/8.0.x/utils/
-import click, os
+import click, os, json
 from . import __version__
 from . import cs_utils
-from . import snews_coinc as snews_coinc
-from . heartbeat_feedbacks import FeedBack
+from .core.logging import initialize_logging
 from socket import gethostname
 
+# The subcommands import their (heavy) modules themselves, so that
+# `snews_cs --help` does not load pandas, hop or matplotlib
+
 
 @click.group(invoke_without_command=True)
 @click.version_option(__version__)
@@ -30,6 +32,7 @@ def main(ctx, env):
     env_path = base + env
     ctx.ensure_object(dict)
     cs_utils.set_env(env_path)
+    initialize_logging("debug")
     ctx.obj['env'] = env
 
 @main.command()
@@ -38,16 +41,30 @@ def main(ctx, env):
 @click.option('--dropdb/--no-dropdb', default=True, show_default='True', help='Whether to drop the current database')
 @click.option('--email/--no-email', default=True, show_default='True', help='Whether to send emails along with the alert')
 @click.option('--slackbot/--no-slackbot', default=True, show_default='True', help='Whether to send the alert on slack')
-def run_coincidence(local, firedrill, dropdb, email, slackbot):
+@click.option('--db', type=click.Choice(['mongo', 'sqlite']), default=None, show_default='env STORAGE_BACKEND or mongo',
+              help='Storage backend, sqlite needs no database server')
+@click.option('--warm-start/--no-warm-start', default=False, show_default='False',
+              help='Rebuild the cache from the stored messages of the last 24 hours, keeps the database')
+@click.option('--restore-state/--no-restore-state', default=False, show_default='False',
+              help='Continue from the state journal of the previous run')
+@click.option('--profile', type=float, default=0, show_default='0',
+              help='Profile the server for this many seconds after it starts, the profile is written to logs/')
+def run_coincidence(local, firedrill, dropdb, email, slackbot, db, warm_start, restore_state, profile):
     """ Initiate Coincidence Decider 
     """
+    from . import snews_coinc
     HOST = gethostname()
     coinc = snews_coinc.CoincidenceDistributor(use_local_db=local,
                                                drop_db=dropdb,
                                                firedrill_mode=firedrill,
                                                server_tag=HOST,
                                                send_email=email,
-                                               send_slack=slackbot)
+                                               send_slack=slackbot,
+                                               storage_backend=db,
+                                               warm_start=warm_start,
+                                               restore_state=restore_state)
+    if profile > 0:
+        coinc.profiler.start(profile)
     try: 
         coinc.run_coincidence()
     except KeyboardInterrupt: 
@@ -55,17 +72,60 @@ def run_coincidence(local, firedrill, dropdb, email, slackbot):
     except Exception as e:
         print(e)
     finally:
+        coinc.shutdown()
         click.secho(f'\n{"="*30}DONE{"="*30}', fg='white', bg='green')
 
 @main.command()
 @click.option('--verbose', '-v', default=False, show_default='False', help='Verbose print')
-def run_feedback(verbose):
+@click.option('--restore-state/--no-restore-state', default=False, show_default='False',
+              help='Do not repeat the warnings sent by the previous run')
+def run_feedback(verbose, restore_state):
     """ Start the feedback checks
     """
-    feedback = FeedBack(verbose=verbose)
+    from .heartbeat_feedbacks import FeedBack
+    feedback = FeedBack(verbose=verbose, restore_state=restore_state)
     click.secho(f'\nInvoking Feedback search, verbose={verbose}\n', fg='white', bg='green')
     feedback()
 
+@main.command()
+@click.option('--duration', type=float, default=3600, show_default='3600', help='Simulated seconds of traffic')
+@click.option('--speedup', type=float, default=100, show_default='100',
+              help='Times faster than real time, 0 for as fast as possible')
+@click.option('--rate', type=float, default=None, help='Messages per second, instead of the simulated timing')
+@click.option('--heartbeat-interval', type=float, default=60, show_default='60', help='Seconds between heartbeats')
+@click.option('--jitter', type=float, default=0.1, show_default='0.1', help='Relative jitter of the heartbeats')
+@click.option('--dropout', type=float, default=0.001, show_default='0.001',
+              help='Probability that a detector goes silent after a heartbeat')
+@click.option('--noise-rate', type=float, default=1/86400, show_default='1/day',
+              help='Background CoincidenceTier messages per detector per second')
+@click.option('--burst-interval', type=float, default=1800, show_default='1800',
+              help='Mean seconds between two supernova bursts, 0 for none')
+@click.option('--burst-size', type=(int, int), default=(3, 8), show_default='3 8',
+              help='Min and max number of detectors observing a burst')
+@click.option('--seed', type=int, default=None, help='Random seed')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+              help='Write the messages to this file as json lines')
+@click.option('--measure/--no-measure', default=False, show_default='False',
+              help='Process the messages with a coincidence system in this process and report its throughput')
+@click.option('--db', type=click.Choice(['mongo', 'sqlite']), default='sqlite', show_default='sqlite',
+              help='Storage backend of the measured coincidence system')
+def simulate_load(duration, speedup, rate, heartbeat_interval, jitter, dropout, noise_rate, burst_interval,
+                  burst_size, seed, output, measure, db):
+    """ Generate synthetic heartbeats and observations, to a file or the in-process coincidence system
+    """
+    from .load_generator import LoadGenerator, measure as measure_load
+    generator = LoadGenerator(heartbeat_interval=heartbeat_interval, jitter=jitter, dropout=dropout,
+                              noise_rate=noise_rate, burst_interval=burst_interval, burst_size=burst_size, seed=seed)
+    if measure:
+        report = measure_load(generator, duration, speedup=speedup, rate=rate, storage_backend=db)
+    elif output:
+        with open(output, "w") as file:
+            report = generator.produce(lambda message: file.write(json.dumps(message) + "\n"), duration,
+                                       speedup=speedup, rate=rate)
+    else:
+        raise click.UsageError("Give an --output file, or --measure")
+    for key, value in report.items():
+        click.echo(f"{key:>16} : {value}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+"""
+Publish each alert once among redundant coincidence servers
+
+Every server sees the same observation messages and forms the same sub-groups, so
+the alerts are identified by their content (`alert_identity`) rather than by the server
+and time that issued them. Before publishing, a server claims a lease on the alert id.
+Only the owner of the lease publishes; the others keep the alert pending, and if the
+owner does not mark it as published before its lease expires (e.g. it crashed), one of
+them takes the lease over and publishes instead.
+
+The leases live in a directory shared by the servers (`FileLeaseCoordinator`) or in the
+MongoDB (`MongoLeaseCoordinator`), selected by env ALERT_LEASE.
+
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+lease_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../alert_leases"))
+
+
+def alert_identity(alert_type, detector_names, neutrino_times, p_vals, reset_id=None):
+    """ Identity of an alert, the same on every server that forms the same sub-group
+        The sub-group number and the server are not part of it, they differ between servers.
+        `reset_id` is the last reset of the cache, the same observations sent again after a
+        reset form a new alert rather than one already published.
+    """
+    content = sorted(zip(map(str, detector_names), map(str, neutrino_times), map(str, p_vals)))
+    identity = (alert_type, content) if reset_id is None else (alert_type, content, reset_id)
+    digest = hashlib.sha1(repr(identity).encode()).hexdigest()[:20]
+    return f"SNEWS_Coincidence_ALERT-{digest}"
+
+
+class FileLeaseCoordinator:
+    """ Leases as files in a directory shared by the servers, each change under an exclusive lock
+
+    Parameters
+    ----------
+    directory : `str`, optional
+        defaults to env ALERT_LEASE_DIR or ./alert_leases
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.getenv("ALERT_LEASE_DIR", lease_path)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _update(self, alert_id, change):
+        """ Apply `change(lease) -> (new lease or None, result)` to the lease file under a lock
+        """
+        with open(os.path.join(self.directory, f"{alert_id}.lease"), "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            content = file.read()
+            lease = json.loads(content) if content else None
+            new_lease, result = change(lease)
+            if new_lease is not None:
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(new_lease))
+                file.flush()
+            return result
+
+    def claim(self, alert_id, owner, ttl):
+        def change(lease):
+            now = time.time()
+            if lease is None or (not lease["published"] and (lease["owner"] == owner or lease["expires"] < now)):
+                return dict(owner=owner, expires=now + ttl, published=False), True
+            return None, False
+        return self._update(alert_id, change)
+
+    def mark_published(self, alert_id, owner, retention):
+        def change(lease):
+            if lease is None or lease["owner"] != owner:
+                return None, False
+            return dict(owner=owner, expires=time.time() + retention, published=True), True
+        return self._update(alert_id, change)
+
+    def release(self, alert_id, owner):
+        def change(lease):
+            if lease is None or lease["owner"] != owner or lease["published"]:
+                return None, False
+            return dict(lease, expires=0), True
+        return self._update(alert_id, change)
+
+    def is_published(self, alert_id):
+        if not os.path.isfile(os.path.join(self.directory, f"{alert_id}.lease")):
+            return False
+        return self._update(alert_id, lambda lease: (None, lease is not None and lease["published"]))
+
+    def cleanup(self):
+        """ Remove the leases that expired
+        """
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as file:
+                    if json.load(file)["expires"] < now:
+                        os.remove(path)
+            except (OSError, ValueError, KeyError):
+                continue
+
+
+class MongoLeaseCoordinator:
+    """ Leases as documents of the `alert_leases` collection, removed by a TTL index once expired
+
+    Parameters
+    ----------
+    db : `pymongo.database.Database`
+        e.g. `Storage.db`
+
+    """
+
+    def __init__(self, db):
+        import pymongo
+        self.leases = db.alert_leases
+        self.leases.create_index([('expires', pymongo.ASCENDING)], expireAfterSeconds=0)
+
+    def claim(self, alert_id, owner, ttl):
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.utcnow()
+        try:
+            self.leases.insert_one({'_id': alert_id, 'owner': owner, 'expires': now + timedelta(seconds=ttl),
+                                    'published': False})
+            return True
+        except DuplicateKeyError:
+            lease = self.leases.find_one_and_update(
+                {'_id': alert_id, 'published': False, '$or': [{'owner': owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires': now + timedelta(seconds=ttl)}})
+            return lease is not None
+
+    def mark_published(self, alert_id, owner, retention):
+        result = self.leases.update_one({'_id': alert_id, 'owner': owner},
+                                        {'$set': {'published': True,
+                                                  'expires': datetime.utcnow() + timedelta(seconds=retention)}})
+        return result.modified_count == 1
+
+    def release(self, alert_id, owner):
+        result = self.leases.delete_one({'_id': alert_id, 'owner': owner, 'published': False})
+        return result.deleted_count == 1
+
+    def is_published(self, alert_id):
+        return self.leases.find_one({'_id': alert_id, 'published': True}) is not None
+
+    def cleanup(self):
+        pass  # the TTL index takes care of it
+
+
+class AlertLeases:
+    """ Publish each alert once, through the leases of a coordinator
+
+    Parameters
+    ----------
+    coordinator : `FileLeaseCoordinator` or `MongoLeaseCoordinator`
+    server_tag : `str`, optional
+        Used in the owner name of the leases
+    ttl : `float`, optional
+        Seconds the owner has to publish, i.e. the failover delay, defaults to env ALERT_LEASE_TTL or 5
+    retention : `float`, optional
+        Seconds a published alert is remembered, defaults to env ALERT_LEASE_RETENTION or 86400
+
+    """
+
+    def __init__(self, coordinator, server_tag=None, ttl=None, retention=None):
+        self.coordinator = coordinator
+        self.owner = f"{server_tag}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.ttl = float(ttl or os.getenv("ALERT_LEASE_TTL", "5"))
+        self.retention = float(retention or os.getenv("ALERT_LEASE_RETENTION", "86400"))
+        self._pending = dict()   # alert id -> publish callable, alerts owned by another server
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+        self._last_cleanup = time.monotonic()
+
+    def publish_once(self, alert_id, publish):
+        """ Call `publish` if this server gets the lease of `alert_id`, otherwise watch the owner
+
+        Returns
+        -------
+        `bool`
+            True if published by this server
+
+        """
+        if self._try_publish(alert_id, publish):
+            return True
+        log.info(f"\t> Alert {alert_id} is owned by another server, taking over if it is not published "
+                 f"within {self.ttl} sec.")
+        with self._lock:
+            self._pending[alert_id] = publish
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch, name="alert-leases", daemon=True)
+                self._watcher.start()
+        return False
+
+    def _try_publish(self, alert_id, publish):
+        if not self.coordinator.claim(alert_id, self.owner, self.ttl):
+            return False
+        try:
+            publish()
+        except Exception:
+            # let another server try right away
+            self.coordinator.release(alert_id, self.owner)
+            raise
+        self.coordinator.mark_published(alert_id, self.owner, self.retention)
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(min(self.ttl / 4, 1.0)):
+            with self._lock:
+                pending = list(self._pending.items())
+            for alert_id, publish in pending:
+                try:
+                    if self.coordinator.is_published(alert_id):
+                        done = True
+                    else:
+                        done = self._try_publish(alert_id, publish)
+                        if done:
+                            log.info(f"\t> The owner of {alert_id} did not publish it, published from here.")
+                except Exception as e:
+                    log.error(f"\t> Could not take over the alert {alert_id}\n{e}")
+                    done = False
+                if done:
+                    with self._lock:
+                        self._pending.pop(alert_id, None)
+            if time.monotonic() - self._last_cleanup > 3600:
+                self._last_cleanup = time.monotonic()
+                self.coordinator.cleanup()
+
+    def pending(self):
+        with self._lock:
+            return list(self._pending)
+
+    def stop(self):
+        self._stop.set()
+
+
+def get_alert_leases(storage=None, server_tag=None):
+    """ The alert leases chosen by env ALERT_LEASE: 'off' (default, every server publishes), 'file' or 'mongo'
+    """
+    kind = os.getenv("ALERT_LEASE", "off").lower()
+    if kind == "off":
+        return None
+    if kind == "file":
+        return AlertLeases(FileLeaseCoordinator(), server_tag=server_tag)
+    if kind == "mongo":
+        if not hasattr(storage, "db"):
+            raise ValueError("ALERT_LEASE=mongo needs the mongo storage backend")
+        return AlertLeases(MongoLeaseCoordinator(storage.db), server_tag=server_tag)
+    raise ValueError(f"Unknown ALERT_LEASE '{kind}', use 'off', 'file' or 'mongo'")
@@ -8,16 +8,17 @@ Melih Kara
 Sebastian Torres-Lara
 """
 import os, click
-from hop import Stream
 from . import cs_utils
-from .snews_db import Storage
+from .snews_db import get_storage
+from .transport import open_stream
 
 
 class AlertPublisher:
     """ Class to publish SNEWS SuperNova Alerts based on coincidence
 
     """
-    def __init__(self, env_path=None, verbose=True, auth=True, use_local=False, firedrill_mode=True):
+    def __init__(self, env_path=None, verbose=True, auth=True, use_local=False, firedrill_mode=True,
+                 storage_backend=None, storage=None):
         """
         Alert publisher constructor 
         Parameters
@@ -30,6 +31,10 @@ class AlertPublisher:
             Use hop-auth credentials, defaults to True
         use_local: bool
             Use local MongoClient, defaults to False
+        storage_backend: str
+            'mongo' or 'sqlite', defaults to env STORAGE_BACKEND
+        storage: Storage
+            An existing storage to use, instead of creating one
         """
         cs_utils.set_env(env_path)
         self.auth = auth
@@ -39,17 +44,17 @@ class AlertPublisher:
         else:
             self.alert_topic = os.getenv("ALERT_TOPIC")
         self.verbose = verbose
-        self.storage = Storage(drop_db=False, use_local_db=use_local)
+        self.storage = storage or get_storage(backend=storage_backend, drop_db=False, use_local_db=use_local)
 
     def __enter__(self):
-        self.stream = Stream(until_eos=True, auth=self.auth).open(self.alert_topic, 'w')
+        self.stream = open_stream(self.alert_topic, 'w', until_eos=True, auth=self.auth)
         return self
 
     def __exit__(self, *args):
         self.stream.close()
 
     def send(self, message):
-        """This method will set the sent_time and send the message to the hop broker.
+        """This method will set the sent_time and send the message to the alert topic.
 
         Parameters
         ----------
@@ -0,0 +1,240 @@
+"""
+Render an alert once for every output channel
+
+An alert goes to kafka, and optionally to e-mail and slack. Each of these used to
+build its own representation of the same sub-group (and the slack table its own DataFrame).
+Here the sub-group is read from the coincidence cache once, and the kafka payload, the
+e-mail text, the slack blocks and the markdown table are all rendered from this snapshot.
+The renders are cached per (sub-group, version) where the version is a hash of the
+snapshot, so a retry or a second channel reuses them instead of rendering again.
+Only the id and the sent time of the alert are stamped again on every render.
+
+"""
+
+import hashlib
+from collections import OrderedDict
+from .cs_alert_schema import CoincidenceTierAlert
+from .alert_lease import alert_identity
+
+
+def snapshot_sub_group(cache, sub_group_tag):
+    """ Read the detectors, neutrino times and p values of a sub-group from the cache in one pass
+
+    Parameters
+    ----------
+    cache : `pandas.DataFrame`
+        The coincidence cache
+    sub_group_tag : `int`
+
+    Returns
+    -------
+    `dict`
+        lists of 'detector_names', 'neutrino_times' and 'p_vals'
+
+    """
+    rows = cache.loc[cache['sub_group'] == sub_group_tag, ['detector_name', 'neutrino_time', 'p_val']]
+    return dict(detector_names=rows['detector_name'].tolist(),
+                neutrino_times=rows['neutrino_time'].tolist(),
+                p_vals=rows['p_val'].tolist())
+
+
+def average_p_val(p_vals):
+    """ Mean of the known p values, None if there are none
+        Like `pandas.Series.mean`, the missing (None or NaN) values are skipped
+    """
+    # NaN is the only value not equal to itself
+    known = [p_val for p_val in p_vals if p_val is not None and p_val == p_val]
+    return round(sum(known) / len(known), 5) if known else None
+
+
+def email_text(alert):
+    """ Plain text body of the alert mail
+    """
+    pretty_alert = ''
+    for k, v in alert.items():
+        space = 40 - len(k)
+        pretty_alert += f'{k} :{r" "*space}{v}\n'
+    return pretty_alert
+
+
+def markdown_table(alert_data):
+    """ Markdown table of the detectors in the alert, sorted by neutrino time
+    """
+    columns = ["detector_names", "neutrino_times", "p_vals"]
+    rows = sorted(zip(*[alert_data[col] for col in columns]), key=lambda row: row[1])
+    rows = [[str(i) for i in row] for row in rows]
+    widths = [max([len(col)] + [len(row[i]) for row in rows]) for i, col in enumerate(columns)]
+    lines = ["| " + " | ".join(col.ljust(w) for col, w in zip(columns, widths)) + " |",
+             "|" + "|".join(":" + "-" * (w + 1) for w in widths) + "|"]
+    lines += ["| " + " | ".join(cell.ljust(w) for cell, w in zip(row, widths)) + " |" for row in rows]
+    return "\n".join(lines)
+
+
+def get_image(is_test, alert_data, topic):
+    ## parse input
+    tag = '<!here>\n' if not is_test else '\n'
+    test = "TEST" if is_test else ""
+    topic_str = f"\n> Broker: {topic.center(50,'-')}"
+
+    alert_data = alert_data or dict(server_tag="Unknown Server",
+                                    alert_type="Unkown",
+                                    _id="Unknown ID",
+                                    false_alarm_prob="Unknown")
+    # update = True if "UPDATE" in alert_data['_id'] else False
+    # update = "UPDATE" if update else ""
+    alert_type = alert_data['alert_type']
+    server = alert_data['server_tag']
+    falseprob = alert_data['False Alarm Prob']
+
+    header = f"{test} *SUPERNOVA ALERT* {alert_type}".center(60, '=')+topic_str+f"{tag}" + \
+             f"> False Alarm Probability= *{falseprob}*\n> Issued from {server}"
+    giflink = "https://raw.githubusercontent.com/SNEWS2/SNEWS_Coincidence_System/main/snews_cs/auxiliary/snalert.gif"
+    retractlink = "https://www.shutterstock.com/image-vector/ooops-word-bubble-pop-art-600w-408777070.jpg"
+    updatelink = "https://www.shutterstock.com/image-vector/vector-illustration-modern-label-new-600w-1520423249.jpg"
+    # updatelink = "https://raw.githubusercontent.com/SNEWS2/SNEWS_Coincidence_System/main/snews_cs/auxiliary/update_image.png"
+    #"https://www.ris.world/wp-content/uploads/2018/09/update.jpg"
+    sendlink = giflink if alert_type=="NEW_MESSAGE" else (updatelink if alert_type=="UPDATE" else retractlink)
+
+    im = \
+        [{
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": header
+            }
+        },
+        {
+            "type": "image",
+            "image_url": sendlink,
+            "alt_text": "snews-alert"
+        },
+        {
+            "type": "actions",
+            "block_id": "actionblock789",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Checkout the SNEWS webpage!"
+                            },
+                    "url": "http://snews2.org"
+                }
+                        ]
+        }
+    ]
+    return im
+
+
+class RenderedAlert:
+    """ All the representations of one alert
+
+    Attributes
+    ----------
+    alert_data : `dict`
+        The collected sub-group information
+    kafka : `dict`
+        The alert message, in the `CoincidenceTierAlert` schema
+    email_text : `str`
+    slack_blocks : `list`
+    markdown : `str`
+        Table of the detectors in the alert
+
+    """
+
+    def __init__(self, alert_data, kafka, email_text, slack_blocks, markdown):
+        self.alert_data = alert_data
+        self.kafka = kafka
+        self.email_text = email_text
+        self.slack_blocks = slack_blocks
+        self.markdown = markdown
+
+
+class AlertRenderer:
+    """ Render alerts and keep the latest renders
+
+    Parameters
+    ----------
+    server_tag : `str`
+    topic : `str`
+        The observation topic, shown on slack
+    is_test : `bool`
+        Slack alerts of tests do not notify the channel
+    env_path : `str`, optional
+    max_entries : `int`
+        Number of renders kept
+
+    """
+
+    def __init__(self, server_tag=None, topic="", is_test=True, env_path=None, max_entries=64):
+        self.server_tag = server_tag
+        self.topic = topic or ""
+        self.is_test = is_test
+        self.alert_schema = CoincidenceTierAlert(env_path)
+        self.max_entries = max_entries
+        self._renders = OrderedDict()  # (sub group, version) -> RenderedAlert
+        # set by each cache reset, the alerts after it are new ones even if their content is the same
+        self.reset_id = None
+
+    @staticmethod
+    def version(alert_data):
+        """ Content hash of the alert data
+        """
+        return hashlib.sha1(repr(sorted(alert_data.items())).encode()).hexdigest()
+
+    def render(self, sub_group_tag, alert_type, snapshot, false_alarm_prob):
+        """ Render the alert of a sub-group, or return the cached render of the same content
+
+        Parameters
+        ----------
+        sub_group_tag : `int`
+        alert_type : `str`
+        snapshot : `dict`
+            from `snapshot_sub_group`
+        false_alarm_prob : `float`
+
+        Returns
+        -------
+        `RenderedAlert`
+
+        """
+        p_vals = snapshot['p_vals']
+        alert_data = dict(p_vals=p_vals,
+                          p_val_avg=average_p_val(p_vals),
+                          sub_list_num=sub_group_tag,
+                          neutrino_times=snapshot['neutrino_times'],
+                          detector_names=snapshot['detector_names'],
+                          false_alarm_prob=false_alarm_prob,
+                          server_tag=self.server_tag,
+                          alert_type=alert_type,
+                          alert_id=alert_identity(alert_type, snapshot['detector_names'],
+                                                  snapshot['neutrino_times'], p_vals, reset_id=self.reset_id))
+        key = (sub_group_tag, self.version(alert_data))
+        if key in self._renders:
+            self._renders.move_to_end(key)
+            cached = self._renders[key]
+            # a new alert, with its own id and sent time
+            alert_id = self.alert_schema.id_format(len(snapshot['detector_names']))
+            kafka = dict(cached.kafka, _id=alert_id, sent_time=alert_id.split(' ')[1])
+            return RenderedAlert(alert_data=cached.alert_data,
+                                 kafka=kafka,
+                                 email_text=email_text(kafka),
+                                 slack_blocks=cached.slack_blocks,
+                                 markdown=cached.markdown)
+
+        kafka = self.alert_schema.get_cs_alert_schema(data=alert_data)
+        rendered = RenderedAlert(alert_data=alert_data,
+                                 kafka=kafka,
+                                 email_text=email_text(kafka),
+                                 slack_blocks=get_image(self.is_test, kafka, self.topic),
+                                 markdown=markdown_table(alert_data))
+        self._renders[key] = rendered
+        while len(self._renders) > self.max_entries:
+            self._renders.popitem(last=False)
+        return rendered
+
+    def clear(self, reset_id=None):
+        """ Forget the renders, after a reset of the cache `reset_id`
+        """
+        self._renders.clear()
+        self.reset_id = reset_id
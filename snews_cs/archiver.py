@@ -0,0 +1,194 @@
+"""
+Move old messages out of the database
+
+`all_mgs` keeps every message ever received. The `MessageArchiver` periodically moves
+the messages older than `ARCHIVE_AFTER_DAYS` to compressed files, one directory per
+day of reception, and deletes them from the database. Each file holds one page of
+messages column by column (a json object of field -> list of values, gzipped).
+`ArchiveReader` queries the archived and the live messages as one.
+
+    ~/.snews_cs/archive/all_mgs/2026-10-19/part-<hash>.json.gz
+
+Archiving deletes the archived messages from the database, it is off unless ARCHIVE_MESSAGES is True.
+
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from .core.logging import getLogger
+from .snews_db import _as_time_string, _project
+
+log = getLogger(__name__)
+
+# outside of the source tree, like the state journal
+archive_path = os.path.join("~", ".snews_cs", "archive")
+
+
+def _day_of(received_time):
+    return str(received_time)[:10]
+
+
+def write_columns(path, documents):
+    """ Write the documents column by column, to a gzipped json file
+    """
+    fields = []
+    for document in documents:
+        fields += [k for k in document if k not in fields]
+    columns = {field: [document.get(field) for document in documents] for field in fields}
+    temp = path + ".tmp"
+    with gzip.open(temp, "wt") as file:
+        json.dump(dict(count=len(documents), columns=columns), file, default=str)
+    os.replace(temp, path)
+
+
+def read_columns(path):
+    """ Read the documents of a file written by `write_columns`
+    """
+    with gzip.open(path, "rt") as file:
+        content = json.load(file)
+    fields = list(content["columns"])
+    rows = zip(*[content["columns"][field] for field in fields])
+    # fields that a document did not have are stored as null
+    return [{k: v for k, v in zip(fields, row) if v is not None} for row in rows]
+
+
+class MessageArchiver:
+    """ Background archiver of `all_mgs`
+
+    Parameters
+    ----------
+    storage : `Storage` or `SQLiteStorage`
+    directory : `str`, optional
+        defaults to env ARCHIVE_DIR or ~/.snews_cs/archive
+    max_age : `float`, optional
+        Days after which the messages are archived, defaults to env ARCHIVE_AFTER_DAYS or 7
+    interval : `float`, optional
+        Seconds between two runs, defaults to env ARCHIVE_INTERVAL or 3600
+    page_size : `int`, optional
+        Messages per file, defaults to env ARCHIVE_PAGE_SIZE or 5000
+
+    """
+
+    def __init__(self, storage, directory=None, max_age=None, interval=None, page_size=None):
+        self.storage = storage
+        directory = os.path.expanduser(directory or os.getenv("ARCHIVE_DIR", archive_path))
+        self.directory = os.path.join(directory, "all_mgs")
+        self.max_age = float(max_age or os.getenv("ARCHIVE_AFTER_DAYS", "7"))
+        self.interval = float(interval or os.getenv("ARCHIVE_INTERVAL", "3600"))
+        self.page_size = int(page_size or os.getenv("ARCHIVE_PAGE_SIZE", "5000"))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="message-archiver", daemon=True)
+        self._thread.start()
+        log.info(f"\t> Messages older than {self.max_age} days are archived to {self.directory}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.archive_once()
+            except Exception as e:
+                log.error(f"\t> Archiving the old messages failed, will try again\n{e}")
+            self._stop.wait(self.interval)
+
+    def archive_once(self, now=None):
+        """ Archive all the messages older than `max_age`, one page at a time
+
+        Returns
+        -------
+        `int`
+            number of archived messages
+
+        """
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.max_age)
+        archived = 0
+        while not self._stop.is_set():
+            # always the oldest page, the previous ones are deleted by now
+            documents, _ = self.storage.query(end=cutoff, limit=self.page_size)
+            if not documents:
+                break
+            by_day = dict()
+            for document in documents:
+                by_day.setdefault(_day_of(document.get("received_time")), []).append(document)
+            for day, day_documents in by_day.items():
+                os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+                # named after its content, a page written before a crash is not written twice
+                key = f"{day_documents[0]['_id']}{day_documents[0].get('received_time')}" \
+                      f"{day_documents[-1]['_id']}{len(day_documents)}"
+                path = os.path.join(self.directory, day, f"part-{hashlib.sha1(key.encode()).hexdigest()[:16]}.json.gz")
+                if not os.path.isfile(path):
+                    write_columns(path, day_documents)
+            deleted = self.storage.delete_messages([document["_id"] for document in documents], before=cutoff)
+            archived += len(documents)
+            if not deleted:
+                log.error("\t> Archived messages could not be deleted from the database, stopping this run.")
+                break
+        if archived:
+            log.info(f"\t> {archived} messages received before {cutoff.isoformat()} are archived.")
+        return archived
+
+
+class ArchiveReader:
+    """ Range queries over the archived and the live messages
+
+    Parameters
+    ----------
+    storage : `Storage` or `SQLiteStorage`
+    directory : `str`, optional
+        defaults to env ARCHIVE_DIR or ~/.snews_cs/archive
+
+    """
+
+    def __init__(self, storage, directory=None):
+        self.storage = storage
+        directory = os.path.expanduser(directory or os.getenv("ARCHIVE_DIR", archive_path))
+        self.directory = os.path.join(directory, "all_mgs")
+
+    def days(self, start=None, end=None):
+        """ The archived days within [start, end]
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        days = sorted(os.listdir(self.directory))
+        if start is not None:
+            days = [day for day in days if day >= _day_of(_as_time_string(start))]
+        if end is not None:
+            days = [day for day in days if day <= _day_of(_as_time_string(end))]
+        return days
+
+    def iter_query(self, start=None, end=None, detector_names=None, tiers=None, projection=None, page_size=1000):
+        """ Stream the messages received in [start, end), oldest first, with the filters of `Storage.query`
+        """
+        start_iso = None if start is None else _as_time_string(start)
+        end_iso = None if end is None else _as_time_string(end)
+        for day in self.days(start, end):
+            documents = []
+            for name in os.listdir(os.path.join(self.directory, day)):
+                if not name.endswith(".json.gz"):
+                    continue
+                for document in read_columns(os.path.join(self.directory, day, name)):
+                    received = str(document.get("received_time"))
+                    if start_iso is not None and received < start_iso:
+                        continue
+                    if end_iso is not None and received >= end_iso:
+                        continue
+                    if detector_names is not None and document.get("detector_name") not in detector_names:
+                        continue
+                    if tiers is not None and document.get("tier") not in tiers:
+                        continue
+                    documents.append(document)
+            documents.sort(key=lambda document: (str(document.get("received_time")), document["_id"]))
+            for document in documents:
+                yield _project(document, projection)
+        yield from self.storage.iter_query(start=start, end=end, detector_names=detector_names, tiers=tiers,
+                                           projection=projection, page_size=page_size)
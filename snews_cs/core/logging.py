@@ -25,7 +25,6 @@ log_date = date.today().strftime("%Y-%m-%d")
 log_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../logs"))
 
 log_file = f"{log_dir}/snews_cs.log"
-fh = FileHandler(log_file)
 
 formatter = Formatter(
     f"%(asctime)s on {HOST}\n" f"  %(levelname)s [%(name)s] %(message)s",
@@ -34,8 +33,6 @@ formatter = Formatter(
 
 formatter.converter = time.gmtime
 
-fh.setFormatter(formatter)
-
 logger = getLogger("snews_cs")
 logger.addHandler(NullHandler())
 
@@ -49,8 +46,11 @@ levels = {
 
 
 def initialize_logging(level):
-    """Initialize top-level logger with the file handler and a `level`."""
-    if fh not in logger.handlers:
+    """Initialize top-level logger with the file handler and a `level`.
+    The log file is only opened here, not when the package is imported."""
+    if not any(isinstance(h, FileHandler) for h in logger.handlers):
+        fh = FileHandler(log_file)
+        fh.setFormatter(formatter)
         logger.addHandler(fh)
         logger.setLevel(levels.get(level))
         logger.propagate = False
@@ -52,7 +52,7 @@ class CoincidenceTierAlert:
 
         """
         id = self.id_format(len(data['detector_names']))
-        return {"_id": id,
+        alert = {"_id": id,
                 "alert_type":data['alert_type'],
                 "server_tag": data['server_tag'],
                 "False Alarm Prob": f"{data['false_alarm_prob']*100:.2f}%",
@@ -63,3 +63,7 @@ class CoincidenceTierAlert:
                 "p_values average": data['p_val_avg'],
                 "sub list number": data['sub_list_num']
                 }
+        if 'alert_id' in data:
+            # the same on every server, see `alert_lease`
+            alert["alert_id"] = data['alert_id']
+        return alert
@@ -1,15 +1,17 @@
 import os, json
+import atexit
+import fcntl
+import threading
 from datetime import datetime
 from .core.logging import getLogger
+from .cs_utils import get_contact_list
+from .alert_render import email_text
 from .snews_hb import beats_path
 
 ### smtplib bits
 # Import smtplib for the actual sending function
 import smtplib
 
-# For guessing MIME type
-import mimetypes
-
 # Import the email modules we'll need
 import email
 import email.mime.text
@@ -19,79 +21,227 @@ from email.mime.multipart import MIMEMultipart
 
 log = getLogger(__name__)
 
-### Pull in environment variables for use with _smtp_sender service function
-smtpserver = os.getenv("smtp_server_addr")
-sender = os.getenv("snews_sender_email")
-password = os.getenv("snews_sender_pass")
 
-contact_list_file = os.path.abspath(os.path.join(os.path.dirname(__file__), 'auxiliary/contact_list.json'))
-with open(contact_list_file) as file:
-    contact_list = json.load(file)
+class MailDelivery:
+    """ Deliver mails over one persistent SMTP session
+
+    Each message is built once and sent to all of its recipients over the same session,
+    the session is re-opened only when the server drops it. Deliveries that fail are kept
+    in a persistent outbox (one json per line) and retried before the next sends, and
+    every `retry_interval` seconds once `start_retries` is called.
+
+    Parameters
+    ----------
+    server : `str`, optional
+        SMTP server address, defaults to env smtp_server_addr
+    sender : `str`, optional
+        Sender address, defaults to env snews_sender_email
+    outbox : `str`, optional
+        File of failed deliveries, defaults to env MAIL_OUTBOX or beats/mail_outbox.jsonl
+    smtp_factory : `callable`, optional
+        Creates a connected session from the server address, defaults to `smtplib.SMTP`.
+        Pass a local stand-in for testing.
+    max_attempts : `int`, optional
+        Give up on a delivery after this many attempts, defaults to env MAIL_MAX_ATTEMPTS or 5
+    retry_interval : `float`, optional
+        Seconds between two retries of the outbox, defaults to env MAIL_RETRY_INTERVAL or 300
+
+    """
+
+    def __init__(self, server=None, sender=None, outbox=None, smtp_factory=smtplib.SMTP, max_attempts=None,
+                 retry_interval=None):
+        self.server = server or os.getenv("smtp_server_addr")
+        self.sender = sender or os.getenv("snews_sender_email")
+        # a copy of every message goes to this address, if set
+        self.monitor = os.getenv("snews_monitor_email")
+        self.outbox = outbox or os.getenv("MAIL_OUTBOX", os.path.join(beats_path, "mail_outbox.jsonl"))
+        self.smtp_factory = smtp_factory
+        self.max_attempts = int(max_attempts or os.getenv("MAIL_MAX_ATTEMPTS", "5"))
+        self.retry_interval = float(retry_interval or os.getenv("MAIL_RETRY_INTERVAL", "300"))
+        self._smtp = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._retries = None
+
+    def start_retries(self):
+        """ Retry the outbox now, e.g. what was left by the previous run,
+            and then every `retry_interval` seconds in a daemon thread
+        """
+        if self._retries is not None:
+            return
+        self._stop.clear()
+        self._retries = threading.Thread(target=self._retry_loop, name="mail-retries", daemon=True)
+        self._retries.start()
+
+    def _retry_loop(self):
+        while True:
+            try:
+                self.retry_outbox()
+            except Exception as e:
+                log.error(f"\t\t> Retrying the mail outbox failed\n{e}")
+            if self._stop.wait(self.retry_interval):
+                return
+
+    def _session(self):
+        if self._smtp is None:
+            self._smtp = self.smtp_factory(self.server)
+            # TODO: We may need this.  Leaving for now.
+            ## Bits and pieces for authenticated smtp.
+            #self._smtp.starttls()
+            #self._smtp.login(self.sender, os.getenv("snews_sender_pass"))
+        return self._smtp
+
+    def close(self):
+        self._stop.set()
+        self._retries = None
+        with self._lock:
+            if self._smtp is not None:
+                try:
+                    self._smtp.quit()
+                except (smtplib.SMTPException, OSError):
+                    pass
+                self._smtp = None
+
+    def build_message(self, subject, body, attachment=None):
+        """ Create the MIME message, the To: header is set per recipient
+        """
+        msg = MIMEMultipart()
+        msg['Subject'] = subject
+        msg['From'] = 'SNEWS USER <' + self.sender + '>'
+        # The main body is just another attachment
+        msg.attach(email.mime.text.MIMEText(body))
+        if attachment is not None:
+            with open(attachment, 'rb') as fp:
+                att = email.mime.application.MIMEApplication(fp.read(), _subtype="octet-stream")
+            att.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment))
+            msg.attach(att)
+        return msg
+
+    def _sendmail(self, msg, to_addr):
+        """ Send to one address, re-opening the session once if the server dropped it
+        """
+        if msg['To'] is None:
+            msg['To'] = to_addr
+        else:
+            msg.replace_header('To', to_addr)
+        for reconnect in (False, True):
+            try:
+                self._session().sendmail(self.sender, [to_addr], msg.as_string())
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._smtp = None
+                if reconnect:
+                    raise e
+
+    def send(self, subject, body, recipients, attachment=None, _attempts=0):
+        """ Send a message to one or many recipients
+
+        Parameters
+        ----------
+        subject : `str`
+        body : `str`
+        recipients : `str` or `list`
+        attachment : `str`, optional
+            path of a file to attach
+
+        Returns
+        -------
+        `bool`
+            True if the message reached every recipient, the others are queued for a retry
+
+        """
+        # smtplib will take both, but ultimately it wants a list.
+        if type(recipients) == str:
+            recipients = [recipients]
+        recipients = list(recipients)
+        if self.monitor and self.monitor not in recipients and not _attempts:
+            recipients.append(self.monitor)
+        with self._lock:
+            if not _attempts:
+                self.retry_outbox()
+            try:
+                msg = self.build_message(subject, body, attachment)
+            except OSError as e:
+                log.error(f"\t\t> Could not attach {attachment}, mail '{subject}' is not sent\n{e}")
+                return False
+
+            # While smtplib will take a list for the to: address, the envelope
+            # ought to be addressed to one person. Send one envelope per recipient over the same session.
+            failed = []
+            for to_addr in recipients:
+                try:
+                    self._sendmail(msg, to_addr)
+                    log.info(f"\t\t> An e-mail was sent at {datetime.utcnow().isoformat()} to {to_addr}")
+                except (smtplib.SMTPException, OSError) as e:
+                    log.error(f"\t\t> Sending '{subject}' to {to_addr} failed\n{e}")
+                    failed.append(to_addr)
+            if failed:
+                self._queue(dict(subject=subject, body=body, recipients=failed,
+                                 attachment=attachment, attempts=_attempts + 1))
+            return not failed
+
+    def _queue(self, delivery):
+        if delivery['attempts'] >= self.max_attempts:
+            log.error(f"\t\t> Giving up on '{delivery['subject']}' to {delivery['recipients']} "
+                      f"after {delivery['attempts']} attempts.")
+            return
+        os.makedirs(os.path.dirname(self.outbox), exist_ok=True)
+        with open(self.outbox, 'a') as outbox:
+            fcntl.flock(outbox, fcntl.LOCK_EX)
+            outbox.write(json.dumps(delivery) + "\n")
+
+    def retry_outbox(self):
+        """ Try again the deliveries that failed before
+        """
+        if not os.path.isfile(self.outbox):
+            return
+        with self._lock:
+            # take over the whole outbox, the ones failing again are appended back
+            with open(self.outbox, 'r+') as outbox:
+                fcntl.flock(outbox, fcntl.LOCK_EX)
+                deliveries = [json.loads(line) for line in outbox if line.strip()]
+                outbox.truncate(0)
+            if deliveries:
+                log.info(f"\t\t> Retrying {len(deliveries)} failed mail deliveries.")
+            for delivery in deliveries:
+                self.send(delivery['subject'], delivery['body'], delivery['recipients'],
+                          delivery['attachment'], _attempts=delivery['attempts'])
+
+
+_mailer = None
+
+def get_mailer():
+    """ The mail delivery of this process
+    """
+    global _mailer
+    if _mailer is None:
+        _mailer = MailDelivery()
+        _mailer.start_retries()
+        atexit.register(_mailer.close)
+    return _mailer
 
 ### SNEWS Alert
-def send_email(alert_content):
+def send_email(alert_content, text=None):
     """ Send the SNEWS alert via e-mail
+        `text` is the already rendered body, see `alert_render`
     """
     # echo "This is not the same message as before" | mail -s "Echo test email" someone@example.com
-    pretty_alert = ''
-    for k, v in alert_content.items():
-        space = 40 - len(k)
-        pretty_alert += f'{k} :{r" "*space}{v}\n'
+    pretty_alert = text if text is not None else email_text(alert_content)
     subject = f"SNEWS COINCIDENCE {datetime.utcnow().isoformat()}"
     emails = 'snews2-test-ahabig@d.umn.edu'
 
     _smtp_sender(pretty_alert, subject, emails)
     log.info(f"\t\t> SNEWS Alert mail was sent at {datetime.utcnow().isoformat()} to {emails}")
 
-### _smtp_sender service function.  All other functions in this file 
+### _smtp_sender service function.  All other functions in this file
 ### call this for mail handling.
 def _smtp_sender(body, subject, addr, attachment=None):
-    with smtplib.SMTP(smtpserver) as smtp:
-         smtp.connect(smtpserver)
-         # TODO: We may need this.  Leaving for now.
-         ## Bits and pieces for authenticated smtp.
-         #smtp.starttls()
-         #smtp.login(sender,password)
-
-         # Convert addr to a list, incase it is passed in as a
-         # string.  smtplib will take both, but ultimately it wants a list.
-         if type(addr) == str:
-               addr = [addr]
-
-         # While smtplib will take a list for the to: address, the envelope
-         # ought to be addressed to one person.  If we get a list of people,
-         # break them up into separate emails.
-         for to_addr in addr:
-              # Create a text/plain message
-              msg = email.mime.multipart.MIMEMultipart()
-              msg['Subject'] = subject
-
-              msg['From'] = 'SNEWS USER <' + sender + '>'
-              msg['To'] = to_addr
-
-              # The main body is just another attachment
-              emailbody = email.mime.text.MIMEText(body)
-              msg.attach(emailbody)
-
-              if attachment is not None:
-                   fp=open(attachment,'rb')
-                   att = email.mime.application.MIMEApplication(fp.read(),_subtype="octet-stream")
-                   fp.close()
-                   att.add_header('Content-Disposition','attachment',filename=attachment)
-                   msg.attach(att)
-
-              #SMTP.sendmail(from_addr, to_addrs, msg, mail_options=(), rcpt_options=())
-              smtp.sendmail(sender,['cjorr@purdue.edu'], msg.as_string())
-              smtp.sendmail(sender, to_addr, msg.as_string())
-              log.info(f"\t\t> An e-mail was sent at {datetime.utcnow().isoformat()} to {to_addr} via _smtp_sender")
-
-              # call the destructor for msg, so we don't inadvertently start adding
-              # things to the object if more than one loop is needed.
-              del msg
+    return get_mailer().send(subject, body, addr, attachment)
 
 ### FEEDBACK EMAIL
 def send_feedback_mail(detector, attachment=None, message_content=None, given_contact=None):
     """ Send feedback email to authorized, requested users
+        Returns True if the mail reached all of them
     """
     # Accept a contact list (e-mail(s)) # mail addresses already checked
     if type(given_contact) != list:
@@ -104,29 +254,25 @@ def send_feedback_mail(detector, attachment=None, message_content=None, given_co
     if len(contacts) > 0:
         time = datetime.utcnow().isoformat()
         subject = "SNEWS FEEDBACK " + time
-        base_msg = f"echo {message_content} | s-nail -s 'SNEWS FEEDBACK {time}' "
+        attached_file = None
         if attachment is not None:
             attached_file = os.path.join(beats_path, attachment)
-            base_msg += f" -a {attached_file}"
-
-        for contact in contacts:
-            base_msg += f" {contact}"
-            log.info(f"\t\t> Trying to send feedback to {contact} for {detector}")
-            _smtp_sender(message_content, subject, contact, attachment)
+        log.info(f"\t\t> Trying to send feedback to {'; '.join(contacts)} for {detector}")
+        return _smtp_sender(message_content, subject, contacts, attached_file)
     else:
         log.info(f"\t\t> Feedback mail is requested for {detector}. However, there are no contacts added.")
+        return False
 
 ### Send WARNING message
 def send_warning_mail(detector, message_content=None):
     """ Send warning mail when a heartbeat is skipped
         This function is invoked within the feedback script
     """
-    contacts = contact_list[detector]["emails"]
+    contacts = get_contact_list()[detector]["emails"]
     message_content = message_content or ""
     subject = "SNEWS Server Heartbeat for " + detector + " is skipped!"
     if len(contacts) > 0:
-        for contact in contacts:
-            log.info(f"\t\t> Trying to send warning to {contact} for {detector}\n")
-            _smtp_sender(message_content, subject, contact)
+        log.info(f"\t\t> Trying to send warning to {'; '.join(contacts)} for {detector}\n")
+        _smtp_sender(message_content, subject, contacts)
     else:
         log.info(f"\t\t> Warning is triggered for {detector}. However, there are no contacts added.")
@@ -1,12 +1,9 @@
 import os
 import json
 import click
-from snews_pt.snews_format_checker import SnewsFormat
-import pandas as pd
-from .heartbeat_feedbacks import check_frequencies_and_send_mail, delete_old_figures
 from .core.logging import getLogger
+from .cs_utils import get_contact_list
 from hop.models import JSONBlob
-from .snews_hb import beats_path
 
 log = getLogger(__name__)
 
@@ -25,12 +22,17 @@ known_commands = [
     "Heartbeat",
     "display-heartbeats",
     "Retraction",
-    "Get-Feedback"
+    "Get-Feedback",
+    "profile",
+    "memory-report",
 ]
 
-contact_list_file = os.path.abspath(os.path.join(os.path.dirname(__file__), 'auxiliary/contact_list.json'))
-with open(contact_list_file) as file:
-    contact_list = json.load(file)
+# commands of the coincidence server only, snews_pt does not know their format
+# they are checked by their password instead of SnewsFormat
+server_commands = [
+    "profile",
+    "memory-report",
+]
 
 
 
@@ -45,7 +47,9 @@ class Commands:
                                         "Heartbeat": self.heartbeat_handle,
                                         "display-heartbeats": self.display_heartbeats,
                                         "Retraction":self.retract_message,
-                                        "Get-Feedback":self.send_feedback}
+                                        "Get-Feedback":self.send_feedback,
+                                        "profile": self.profile,
+                                        "memory-report": self.memory_report}
         self.passw = os.getenv('snews_cs_admin_pass', 'False')
 
     def _check_rights(self, message):
@@ -67,6 +71,9 @@ class Commands:
         """
         # get the function that executes given command
         command = self.known_command_functions[command_name]
+        # heartbeats are registered per batch, the other commands see every beat read before them
+        if command_name != "Heartbeat":
+            CoincDeciderInstance.flush_heartbeats()
         # execute that function
         command(message, CoincDeciderInstance)
         # return default NO-GO, this is only changed if the message is Retraction!
@@ -82,11 +89,10 @@ class Commands:
         default_connection_topic = "kafka://kafka.scimma.org/snews.connection-testing"
         connection_broker = os.getenv("CONNECTION_TEST_TOPIC", default_connection_topic)
 
-        from hop import Stream
-        stream = Stream(until_eos=True)
+        from .transport import open_stream
         msg = message.copy()
         msg["status"] = "received"
-        with stream.open(connection_broker, "w") as s:
+        with open_stream(connection_broker, "w", until_eos=True) as s:
             # insert back with a "received" status
             s.write(JSONBlob(msg))
             log.info(f"\t> Connection Tested. 'Received' message is reinserted to connection stream.")
@@ -115,12 +121,9 @@ class Commands:
         log.debug(f" broker requested to changed to '{new_broker_name}' but it is not implemented yet.\n")
 
     def heartbeat_handle(self, message, CoincDeciderInstance):
-        """handle heartbeat"""
-        success = CoincDeciderInstance.heartbeat.electrocardiogram(message)
-        if success:
-            log.debug(f"\t> Heartbeat registered.")
-        else:
-            log.debug(f"\t> Heartbeat failed to register!")
+        """handle heartbeat, registered together with the rest of the consumed batch"""
+        CoincDeciderInstance.queue_heartbeat(message)
+        log.debug(f"\t> Heartbeat queued.")
 
     def display_heartbeats(self, message, CoincDeciderInstance):
         authorized = self._check_rights(message)
@@ -156,6 +159,7 @@ class Commands:
         none_valid = True
         # avoid empty lines, and allow multiple emails
         given_mail =  [mail.strip() for mail in given_mail.split(";") if len(mail.strip())]
+        contact_list = get_contact_list()
         log.debug(f"> [DEBUG] These mails are passed {'; '.join(given_mail)} for detector: {detector}")
         for email in given_mail:
             if not email in contact_list[detector]["emails"]:
@@ -165,14 +169,58 @@ class Commands:
         if none_valid:
             log.error(f"\t> None of the the given email: {';'.join(given_mail)} is registered, ignoring all!")
             return None
+        # the feedback is created and sent in the background, do not hold up the stream
+        CoincDeciderInstance.feedback_jobs.submit(detector, given_mail)
+
+    def profile(self, message, CoincDeciderInstance):
+        """ Authorized User (passing a correct password) profiles the server
+            for message['duration'] seconds (default 30, at most 600), see `profiler`
+            Expected message format
+            message = {'_id': '0_profile_', 'pass': password, 'duration': 60}
+        """
+        authorized = self._check_rights(message)
+        if not authorized:
+            log.error("\t> Profile requested. User is NOT authorized.")
+            return None
         try:
-            attachment_name, out = check_frequencies_and_send_mail(detector, given_contact=given_mail)
-            if out:
-                log.info(f"\t> The feedback file: {attachment_name} is sent to the registered mails for {detector}")
-            else:
-                log.debug(f"\t> The feedback file: {attachment_name} is created but could not be sent.")
-        except Exception as e:
-            log.info(f"\t> Something went wrong for {detector}, couldn't send mail, see the exception;\n{e}")
+            duration = min(max(float(message.get('duration', 30)), 1), 600)
+        except (TypeError, ValueError):
+            log.error(f"\t> Profile requested with an invalid duration '{message.get('duration')}'.")
+            return None
+        log.info("\t> Profile requested. User is authorized.")
+        CoincDeciderInstance.profiler.start(duration)
+
+    def memory_report(self, message, CoincDeciderInstance):
+        """ Authorized User (passing a correct password) gets the allocation sites that grew the most
+            since the previous memory report (see `profiler.MemoryReport`), and the sizes of the caches.
+            The report is logged and sent to the connection test topic.
+            Expected message format
+            message = {'_id': '0_memory-report_', 'pass': password, 'top': 10}
+            'top' is the number of allocation sites, at most 100
+        """
+        authorized = self._check_rights(message)
+        if not authorized:
+            log.error("\t> Memory report requested. User is NOT authorized.")
+            return None
+        try:
+            top = min(max(int(message.get('top', 10)), 1), 100)
+        except (TypeError, ValueError):
+            log.error(f"\t> Memory report requested with an invalid top '{message.get('top')}'.")
+            return None
+        log.info("\t> Memory report requested. User is authorized.")
+        report = CoincDeciderInstance.memory.report(
+            top=top,
+            tables={'coincidence_cache': CoincDeciderInstance.coinc_data.cache,
+                    'heartbeat_cache': CoincDeciderInstance.heartbeat.cache_df})
+        lines = [f"{site['size_diff']:+12d} B {site['count_diff']:+8d} blocks  {site['site']}" for site in report['top']]
+        log.info(f"\t> Memory report: traced {report['traced']} B (peak {report['peak']} B), {report['tables']}\n"
+                 f"\t> Growth since {report['since']}:\n" + "\n".join(lines))
+
+        from .transport import open_stream
+        connection_broker = os.getenv("CONNECTION_TEST_TOPIC", "kafka://kafka.scimma.org/snews.connection-testing")
+        msg = {'_id': message['_id'], 'status': 'memory-report', 'report': report}
+        with open_stream(connection_broker, "w", until_eos=True) as s:
+            s.write(JSONBlob(msg))
 
 class CommandHandler:
     """ class to handle the manual command issued by the admins
@@ -185,6 +233,8 @@ class CommandHandler:
             - Get logs
             - Change Broker
             - Request Feedback
+            - Profile the server
+            - Report the memory
         """
 
     def __init__(self, message):
@@ -200,11 +250,16 @@ class CommandHandler:
         self.entry = f"\n|{self.username}|"
 
     def check_message_format(self):
+        from snews_pt.snews_format_checker import SnewsFormat
         formatter = SnewsFormat(self.input_message, log=log)
         return formatter()
 
     def handle(self, CoincDeciderInstance):
         log.debug(f"\t> Handling message..\n")
+        command_name = str(self.input_message.get('_id', '')).split('_')
+        if len(command_name) > 1 and command_name[1] in server_commands:
+            self.command_name = command_name[1]
+            return self.check_command(CoincDeciderInstance)
         # check if the message in stream has SnewsFormat
         if not self.check_message_format():
             log.error("\t> Message not in SnewsFormat! NO-GO")
@@ -1,16 +1,24 @@
+import os
+import math
 import numpy as np
-from scipy.stats import poisson
-import pandas as pd
-import json
+from collections import OrderedDict
+from datetime import datetime
+
+_epoch = datetime(1970, 1, 1)
 
 
 def cache_false_alarm_rate(cache_sub_list, hb_cache):
     """
     Generates false alarm rates for a set of detector heartbeats
+    Stateless version of `FalseAlarmService.false_alarm_prob`, every
+    detector currently ON in the heartbeat cache counts as online.
 
     Parameters
     ----------
-
+    cache_sub_list : `pandas.DataFrame`
+        The sub-group of the coincidence
+    hb_cache : `pandas.DataFrame`
+        The heartbeat cache
 
     Returns
     -------
@@ -18,11 +26,112 @@ def cache_false_alarm_rate(cache_sub_list, hb_cache):
         probability that SNEWS alert is  a false alarm
 
     """
-    # convert our n-fold coicidence from n-fold/day to n-fold/per week
-    num_coinc_detectors = len(cache_sub_list['detector_name']) * (1/7)
-    num_detectors_online = len(hb_cache)
-    mu = 1 * num_detectors_online   # expected number of false coincidence for a week
-    prob_false_alarm_rate = poisson.pmf(k=num_coinc_detectors, mu=mu)
-    return np.round(prob_false_alarm_rate, decimals=5)
+    last_status = hb_cache.groupby("Detector")["Status"].last()
+    num_detectors_online = int((last_status == "ON").sum())
+    return poisson_pmf(len(cache_sub_list['detector_name']), num_detectors_online)
+
+
+# log(k!) for every possible number of coincident detectors
+_log_factorial = np.cumsum(np.log(np.maximum(np.arange(129), 1)))
+
+
+def poisson_pmf(k, mu):
+    """ Poisson probability of `k` events for a mean of `mu`, from the log-factorial table
+    """
+    k = int(k)
+    if mu <= 0:
+        return float(k == 0)
+    log_fact = _log_factorial[k] if k < len(_log_factorial) else math.lgamma(k + 1)
+    return np.round(math.exp(k * math.log(mu) - mu - log_fact), decimals=5)
+
+
+class FalseAlarmService:
+    """ Running set of the online detectors, fed by the heartbeat stream
+
+    A detector is online while its latest beat is ON and not older than `stale_after`.
+    The online detectors are kept as a running set, so the false alarm probability of an
+    alert is computed in constant time, without looking at the heartbeat cache. As in
+    `cache_false_alarm_rate`, the expected number of false coincidences is `rate` per online detector.
+
+    Parameters
+    ----------
+    rate : `float`, optional
+        Expected false coincidences per online detector, defaults to env FALSE_ALARM_RATE or 1 (per week)
+    stale_after : `float`, optional
+        Seconds without a beat after which a detector is offline, defaults to env HB_ONLINE_WINDOW or 900
+
+    """
+
+    def __init__(self, rate=None, stale_after=None):
+        self.rate = float(rate or os.getenv("FALSE_ALARM_RATE", "1"))
+        self.stale_after = float(stale_after or os.getenv("HB_ONLINE_WINDOW", "900"))
+        self.last_beat = dict()     # detector -> (received time (s), status)
+        self._online = OrderedDict()  # online detectors, in order of their latest ON beat
+
+    def update(self, detector, status, received):
+        """ Register one beat
+
+        Parameters
+        ----------
+        detector : `str`
+        status : `str`
+            'ON' or 'OFF'
+        received : `datetime.datetime` or `float`
+            time the beat is received (UTC), datetimes are converted to seconds
+
+        """
+        now = (received - _epoch).total_seconds() if isinstance(received, datetime) else float(received)
+        self.expire(now)
+        status = str(status).upper()
+        self.last_beat[detector] = (now, status)
+
+        self._online.pop(detector, None)
+        if status == "ON":
+            self._online[detector] = now
+
+    def update_many(self, beats):
+        """ Register a batch of beats
+
+        Parameters
+        ----------
+        beats : `pandas.DataFrame`
+            with columns 'detector_name', 'detector_status', 'Received Times'
+
+        """
+        # nanoseconds since the epoch, converted to seconds in one go
+        received = np.asarray(beats["Received Times"], dtype="datetime64[ns]").astype(np.int64) / 1e9
+        for detector, status, seconds in zip(beats["detector_name"], beats["detector_status"], received):
+            self.update(detector, status, float(seconds))
+
+    def expire(self, now):
+        """ Take offline the detectors without a beat for `stale_after` seconds
+        """
+        while self._online:
+            detector = next(iter(self._online))
+            if now - self.last_beat[detector][0] <= self.stale_after:
+                break
+            del self._online[detector]
+
+    @property
+    def num_online(self):
+        return len(self._online)
+
+    def false_alarm_prob(self, num_coinc_detectors, now=None):
+        """ Probability of a false `num_coinc_detectors`-fold coincidence
+
+        Parameters
+        ----------
+        num_coinc_detectors : `int`
+            number of detectors in the coincidence
+        now : `datetime.datetime` or `float`, optional
+            current time (UTC), online detectors are expired at this time if given
 
+        Returns
+        -------
+        false alarm probability: float
 
+        """
+        if now is not None:
+            self.expire((now - _epoch).total_seconds() if isinstance(now, datetime) else float(now))
+        mu = self.rate * self.num_online
+        return poisson_pmf(num_coinc_detectors, mu)
@@ -2,8 +2,12 @@
 Example initial docstring
 """
 from dotenv import load_dotenv
+from functools import lru_cache
+import json
 import os
 
+auxiliary_path = os.path.join(os.path.dirname(__file__), 'auxiliary')
+
 def set_env(env_path=None):
     """ Set environment parameters
 
@@ -22,6 +26,43 @@ def make_beat_directory(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
+def as_nanoseconds(time):
+    """ Nanoseconds since the epoch (UTC) of an ISO time string or a datetime
+        Unlike `datetime.fromisoformat`, the nanoseconds of the string are kept
+
+    Parameters
+    ----------
+    time : `str`, `datetime.datetime` or `pandas.Timestamp`
+        naive times are taken as UTC
+
+    Returns
+    -------
+    `int`
+
+    """
+    import pandas as pd
+    return int(pd.Timestamp(time).value)
+
+@lru_cache(maxsize=None)
+def get_detector_properties():
+    """ Registered detectors, name -> [name, id, location], read once per process
+    """
+    with open(os.path.join(auxiliary_path, 'detector_properties.json')) as file:
+        return json.load(file)
+
+@lru_cache(maxsize=None)
+def get_detector_names():
+    """ Names of the registered detectors, read once per process
+    """
+    return list(get_detector_properties().keys())
+
+@lru_cache(maxsize=None)
+def get_contact_list():
+    """ Registered contacts of each detector, read once per process
+    """
+    with open(os.path.join(auxiliary_path, 'contact_list.json')) as file:
+        return json.load(file)
+
 
 
 
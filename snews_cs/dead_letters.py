@@ -0,0 +1,48 @@
+"""
+Observation messages that can not be processed
+
+A message that is malformed or invalid (a missing field, a value of the wrong type, a time
+that can not be parsed...) fails the same way each time it is read, so it is recorded to
+logs/dead_letters.jsonl and passed over. Any other failure (the database, the broker, the disk)
+is not the fault of the message; the batch stops before it and the message is read again.
+
+"""
+
+import os
+import json
+from datetime import datetime
+from .core.logging import getLogger, log_dir
+
+log = getLogger(__name__)
+
+# the exceptions raised by the content of a message, rather than by the system processing it
+malformed_errors = (KeyError, TypeError, ValueError, AttributeError, IndexError)
+
+
+class DeadLetterLog:
+    """ Record the messages passed over because they could not be processed
+
+    Parameters
+    ----------
+    path : `str`, optional
+        json lines file, defaults to env DEAD_LETTER_LOG or logs/dead_letters.jsonl
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("DEAD_LETTER_LOG", os.path.join(log_dir, "dead_letters.jsonl"))
+
+    def record(self, message, metadata, error):
+        """ Append the message, its position in the topic and the error to the log
+        """
+        position = None if metadata is None else dict(topic=metadata.topic, partition=metadata.partition,
+                                                      offset=metadata.offset)
+        content = getattr(message, "content", message)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as file:
+                file.write(json.dumps(dict(time=datetime.utcnow().isoformat(), position=position,
+                                           error=f"{type(error).__name__}: {error}", message=content),
+                                      default=str) + "\n")
+        except OSError as e:
+            log.error(f"\t> Could not record the dead letter to {self.path}\n{e}")
@@ -0,0 +1,127 @@
+"""
+Run the requested heartbeat feedbacks in the background
+
+A `Get-Feedback` request reads the heartbeat cache, renders a figure and sends mails.
+Doing this inside the coincidence consumer would hold up the observation messages,
+so the consumer only enqueues a job here and a small process pool does the rest.
+
+"""
+
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+
+def _run_feedback(detector, contacts):
+    """ Executed in a worker process
+    """
+    from .heartbeat_feedbacks import check_frequencies_and_send_mail
+    return check_frequencies_and_send_mail(detector, given_contact=contacts)
+
+
+class FeedbackJobs:
+    """ Bounded queue of feedback jobs, executed by a process pool
+
+    There is at most one job per detector. A request for a detector that already has
+    a job is merged into it; if it asks for additional addresses, these are served by
+    one follow-up job once the current one is done (which reuses the rendered figure).
+
+    Parameters
+    ----------
+    max_workers : `int`, optional
+        Number of worker processes, defaults to env FEEDBACK_WORKERS or 2
+    max_pending : `int`, optional
+        Maximum number of queued or running jobs, defaults to env FEEDBACK_QUEUE_SIZE or 16
+
+    """
+
+    def __init__(self, max_workers=None, max_pending=None):
+        self.max_workers = int(max_workers or os.getenv("FEEDBACK_WORKERS", "2"))
+        self.max_pending = int(max_pending or os.getenv("FEEDBACK_QUEUE_SIZE", "16"))
+        self._pool = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._jobs = dict()        # detector -> (future, contacts)
+        self._followups = dict()   # detector -> contacts requested while a job was in flight
+
+    def submit(self, detector, contacts):
+        """ Queue a feedback for `detector` to be sent to `contacts`
+
+        Returns
+        -------
+        `bool`
+            False if the request is dropped because the queue is full
+
+        """
+        with self._lock:
+            if detector in self._jobs:
+                _, queued_contacts = self._jobs[detector]
+                extra = [c for c in contacts if c not in queued_contacts]
+                if not extra:
+                    log.info(f"\t> [FEEDBACK] A feedback for {detector} is already queued, ignoring the duplicate.")
+                    return True
+                followup = self._followups.setdefault(detector, [])
+                followup.extend(c for c in extra if c not in followup)
+                log.info(f"\t> [FEEDBACK] A feedback for {detector} is in progress, "
+                         f"{'; '.join(extra)} will be served right after.")
+                return True
+            if len(self._jobs) >= self.max_pending:
+                log.error(f"\t> [FEEDBACK] {len(self._jobs)} feedback jobs are pending, dropping the request for {detector}!")
+                return False
+            future = self._submit(detector, list(contacts))
+        future.add_done_callback(lambda f: self._done(detector, f))
+        return True
+
+    def _submit(self, detector, contacts):
+        """ Hand the job to the pool, requires the lock
+        """
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context("forkserver"))
+        try:
+            future = self._pool.submit(_run_feedback, detector, contacts)
+        except BrokenProcessPool:
+            log.error("\t> [FEEDBACK] The feedback pool is broken, starting a new one.")
+            self._pool = None
+            return self._submit(detector, contacts)
+        self._jobs[detector] = (future, contacts)
+        log.info(f"\t> [FEEDBACK] Feedback job for {detector} is queued ({len(self._jobs)} pending).")
+        return future
+
+    def _done(self, detector, future):
+        try:
+            attachment_name, out = future.result()
+            if out:
+                log.info(f"\t> [FEEDBACK] The feedback file: {attachment_name} is sent to the registered mails for {detector}")
+            else:
+                log.debug(f"\t> [FEEDBACK] The feedback file: {attachment_name} is created but could not be sent.")
+        except Exception as e:
+            log.info(f"\t> [FEEDBACK] Something went wrong for {detector}, couldn't send mail, see the exception;\n{e}")
+
+        with self._lock:
+            self._jobs.pop(detector, None)
+            followup = self._followups.pop(detector, None)
+            if self._closed:
+                followup = None
+            if followup:
+                future = self._submit(detector, followup)
+        if followup:
+            future.add_done_callback(lambda f: self._done(detector, f))
+
+    def pending(self):
+        """ Detectors with a queued or running feedback job
+        """
+        with self._lock:
+            return list(self._jobs)
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            self._closed = True
+            if self._pool is not None:
+                self._pool.shutdown(wait=wait, cancel_futures=not wait)
+                self._pool = None
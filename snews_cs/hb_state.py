@@ -0,0 +1,176 @@
+"""
+Share the live heartbeat cache between `run-coincidence` and `run-feedback`
+
+The `HeartBeat` instance living in the coincidence process owns the heartbeat cache.
+Rather than letting the feedback process re-parse the mirror csv from disk every minute,
+the producer serves its latest cache over a local Unix socket. Every connection receives
+the most recently published state, so both processes always look at the same data.
+A reader can also pass the version it already has and wait for the next one, which lets
+the feedback process react to new beats as they arrive instead of polling.
+
+The state is pickled, so a reader only unpickles what comes from a socket owned by its
+own user, and the socket (HB_STATE_SOCKET) must be in a directory that other users
+cannot write to.
+
+"""
+
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+# request: version known by the reader (-2 if none), seconds to wait for a newer one
+_request = struct.Struct("!qd")
+# response: version (-1 if nothing is published yet) and payload length
+_header = struct.Struct("!qQ")
+
+
+def _recv_exactly(sock, size):
+    """ Read exactly `size` bytes from the socket
+    """
+    chunks, remaining = [], size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError("heartbeat state connection closed early")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def _owned_by_us(path):
+    """ Whether the socket at `path` belongs to the user of this process
+    """
+    try:
+        owner = os.stat(path).st_uid
+    except OSError:
+        return False
+    if owner != os.getuid():
+        log.error(f"\t> {path} is owned by uid {owner}, not by this user. Not reading the heartbeat state from it.")
+        return False
+    return True
+
+
+class _StateRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        known_version, wait = _request.unpack(_recv_exactly(self.request, _request.size))
+        version, payload = self.server.state.snapshot(known_version, wait)
+        self.request.sendall(_header.pack(version, len(payload)) + payload)
+
+
+class _StateServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class HeartBeatStateServer:
+    """ Serve the latest heartbeat cache over a Unix socket
+
+    Parameters
+    ----------
+    path : `str`
+        Path of the Unix socket
+
+    Notes
+    -----
+    The published frame is kept as a reference and only pickled when a reader
+    asks for it. `HeartBeat` always replaces its cache with a new frame instead
+    of mutating a published one, so this is safe without copying.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = -1
+        self._frame = None
+        self._payload = b""
+        self._changed = threading.Condition()
+        self._server = None
+
+    def start(self):
+        """ Bind the socket and serve from a daemon thread
+            Returns False if another producer is already serving on this path
+        """
+        if os.path.exists(self.path):
+            if read_heartbeat_state(self.path, timeout=1)[0] is not None:
+                log.error(f"\t> Heartbeat state is already served on {self.path}, not sharing from here.")
+                return False
+            os.remove(self.path)  # stale socket from a previous run
+        self._server = _StateServer(self.path, _StateRequestHandler)
+        self._server.state = self
+        os.chmod(self.path, 0o600)
+        threading.Thread(target=self._server.serve_forever, name="hb-state-server", daemon=True).start()
+        log.info(f"\t> Heartbeat state is shared on {self.path}")
+        return True
+
+    def publish(self, frame):
+        """ Make `frame` the current heartbeat state
+        """
+        with self._changed:
+            self._frame = frame
+            self._payload = None
+            self.version += 1
+            self._changed.notify_all()
+
+    def snapshot(self, known_version=-2, wait=0.0):
+        """ Return the current (version, pickled frame)
+            If the current version is `known_version`, wait up to `wait` seconds for a new one.
+            The payload is empty if it is still `known_version` after that
+        """
+        with self._changed:
+            if not self._changed.wait_for(lambda: self.version != known_version, timeout=wait):
+                return self.version, b""
+            if self._payload is None:
+                self._payload = pickle.dumps(self._frame, protocol=pickle.HIGHEST_PROTOCOL)
+            return self.version, self._payload
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def read_heartbeat_state(path, timeout=5.0, known_version=None, wait=0.0):
+    """ Ask the running producer for its heartbeat cache
+
+    Parameters
+    ----------
+    path : `str`
+        Path of the Unix socket
+    timeout : `float`
+        Seconds to wait for the producer
+    known_version : `int`, optional
+        The version the caller already has
+    wait : `float`, optional
+        If the producer is still at `known_version`, seconds to wait for a newer one
+
+    Returns
+    -------
+    (version, frame) : (`int`, `pandas.DataFrame`)
+        (None, None) if there is no producer listening on `path`, or if another user owns it,
+        (known_version, None) if nothing changed within `wait`
+
+    """
+    if not _owned_by_us(path):
+        return None, None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout + wait)
+            sock.connect(path)
+            sock.sendall(_request.pack(-2 if known_version is None else known_version, wait))
+            version, size = _header.unpack(_recv_exactly(sock, _header.size))
+            payload = _recv_exactly(sock, size)
+    except OSError:
+        return None, None
+    if version < 0:
+        return None, None
+    if version == known_version:
+        return version, None
+    return version, pickle.loads(payload)
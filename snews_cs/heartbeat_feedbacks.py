@@ -1,108 +1,219 @@
 
-import json, os
+import os
+import hashlib
+import heapq
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 from time import sleep
 from .core.logging import getLogger
-from .cs_email import send_warning_mail, send_feedback_mail
-from .snews_hb import beats_path, mirror_csv
+from .cs_email import send_warning_mail, send_feedback_mail, get_mailer
+from .cs_utils import make_beat_directory, get_detector_names
+from .snews_hb import beats_path, mirror_csv, state_socket_path
+from .hb_state import read_heartbeat_state
+from .state_journal import StateJournal
 
 log = getLogger(__name__)
+pd.options.mode.chained_assignment = None
 
-contact_list_file = os.path.abspath(os.path.join(os.path.dirname(__file__), 'auxiliary/contact_list.json'))
-with open(contact_list_file) as file:
-    contact_list = json.load(file)
-
-# Check if detector name is in registered list.
-detector_file = os.path.abspath(os.path.join(os.path.dirname(__file__), 'auxiliary/detector_properties.json'))
-with open(detector_file) as file:
-    snews_detectors = json.load(file)
-snews_detectors = list(snews_detectors.keys())
+# rendered feedback figures, named after the detector and the hash of the plotted data
+figure_cache = os.path.join(beats_path, "feedback_figures")
 
 # verbose print. Prints only if verbose=True
 vprint = lambda inp, _bool: print(inp) if _bool else None
 
+class BeatDeadlines:
+    """ Min-heap of the moments by which each detector is expected to beat again
+        Rescheduling a detector leaves its old entry in the heap, stale entries
+        are skipped when they come up.
+    """
+    def __init__(self):
+        self._heap = []
+        self._deadlines = dict()
+
+    def __contains__(self, detector):
+        return detector in self._deadlines
+
+    def __iter__(self):
+        return iter(list(self._deadlines))
+
+    def schedule(self, detector, deadline):
+        if self._deadlines.get(detector) == deadline:
+            return
+        self._deadlines[detector] = deadline
+        heapq.heappush(self._heap, (deadline, detector))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            # too many stale entries, rebuild
+            self._heap = [(d, det) for det, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, detector):
+        self._deadlines.pop(detector, None)
+
+    def pop_expired(self, now):
+        """ Remove and return the detectors whose deadline is passed
+        """
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, detector = heapq.heappop(self._heap)
+            if self._deadlines.get(detector) == deadline:
+                del self._deadlines[detector]
+                expired.append(detector)
+        return expired
+
+    def seconds_until_next(self, now, default):
+        """ Seconds until the earliest deadline, at most `default`
+        """
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return default
+        return min(max((self._heap[0][0] - now).total_seconds(), 0.), default)
+
+
 class FeedBack:
-    """ Once every minute, check the HB of each detector
-        If the last heartbeat is from longer than usual, send an email
+    """ Track the HB of each detector, and when the next beat of a detector is
+        later than usual (mean+3*sigma), send an email
         Once every user-defined time interval, send a plot with latency and frequency statistics
 
     """
-    def __init__(self, verbose=False):
-        self.detectors = snews_detectors
+    def __init__(self, verbose=False, restore_state=False):
+        self.detectors = get_detector_names()
         self.last_feedback_time = dict()
         for k in self.detectors:
             self.last_feedback_time[k] = datetime(2022, 1, 1)
+        # remember the warnings already sent across restarts, see `state_journal`
+        self.journal = None
+        if os.getenv("STATE_JOURNAL", "True").lower() == "true":
+            self.journal = StateJournal("feedback", lambda: dict(last_feedback_time=self.last_feedback_time))
+            if restore_state:
+                state, records = self.journal.restore()
+                if state is not None:
+                    self.last_feedback_time.update(state['last_feedback_time'])
+                for _, (detector, last_hb) in records:
+                    self.last_feedback_time[detector] = last_hb
+            else:
+                self.journal.reset()
         self.day_in_min = 1440
-        self.running_min = 0
+        self.deadlines = BeatDeadlines()
+        # longest sleep between two checks, and the polling period when only the mirror csv is available
+        self.max_wait = float(os.getenv("HB_FEEDBACK_MAX_WAIT", "60"))  # seconds
+        self._csv_fallback = False
         self.verbose = verbose
+        self.state_socket = state_socket_path()
+        # deliver what the previous run left in the outbox, and keep retrying it
+        get_mailer()
         log.info(f"\t> Heartbeat tracking initiated.")
 
     def __call__(self):
-        """ Continuously run and check expected heartbeats every minute
-            Also, check if the detectors requested feedbacks
-            create and send feedbacks with the desired time intervals
+        """ Continuously track the expected heartbeats
+            Every new beat (re)schedules the deadline of its detector. The loop sleeps until
+            either the earliest deadline passes or `run-coincidence` publishes new beats,
+            so a missed beat is reported within seconds and an idle server costs nothing.
         """
+        version, stats = None, None
+        last_cleanup = datetime.utcnow()
         while True:
-            # run every minute
-            sleep(60)
-            try:
-                df = pd.read_csv(mirror_csv, parse_dates=['Received Times'], )
-            except FileNotFoundError:
-                log.error(f"{mirror_csv} does not exist yet! Maybe `snews_cs run-coincidence` is not invoked?")
-                while not os.path.isfile(mirror_csv):
-                    sleep(60)
-                df = pd.read_csv(mirror_csv, parse_dates=['Received Times'], )
-                log.debug(f"OK {mirror_csv} found! Moving on")
-
-            self.control(df) # check if a detector is taking longer than usual (mean+3*sigma>)
-            self.running_min += 1
-            vprint(f"[DEBUG] >>>>> Running minute: {self.running_min}", self.verbose)
-            # every hour, reset the minute counter, increase hour counter
-            # and check if it has been feedback time for any detector.
-            if (self.running_min % 60) == 0:
-                self.running_min = 0  # reset the counter
+            wait = self.deadlines.seconds_until_next(datetime.utcnow(), self.max_wait)
+            version, df = self.wait_for_heartbeats(version, wait)
+            if df is not None:
+                stats = self.schedule_deadlines(df)
+            # check if a detector is taking longer than usual (mean+3*sigma>)
+            for detector in self.deadlines.pop_expired(datetime.utcnow()):
+                self.check_missed_beats(detector, stats.loc[detector])
+            # every hour, clean up the old figures
+            if datetime.utcnow() - last_cleanup > timedelta(hours=1):
+                last_cleanup = datetime.utcnow()
                 delete_old_figures()
 
+    def wait_for_heartbeats(self, version, wait):
+        """ Wait up to `wait` seconds for a heartbeat cache newer than `version`
+
+        Returns
+        -------
+        (version, df)
+            df is None if nothing changed
+
+        """
+        new_version, df = read_heartbeat_state(self.state_socket, known_version=version, wait=wait)
+        if new_version is not None:
+            self._csv_fallback = False
+            return new_version, None if df is None else _as_heartbeat_frame(df)
+
+        # run-coincidence is not reachable, poll the mirror csv instead
+        sleep(wait)
+        try:
+            df = pd.read_csv(mirror_csv, parse_dates=['Received Times'], )
+        except FileNotFoundError:
+            if not self._csv_fallback:
+                log.error(f"{mirror_csv} does not exist yet! Maybe `snews_cs run-coincidence` is not invoked?")
+            self._csv_fallback = True
+            return None, None
+        if self._csv_fallback:
+            log.debug(f"OK {mirror_csv} found! Moving on")
+        self._csv_fallback = False
+        return None, df
+
+    def schedule_deadlines(self, df):
+        """ Recompute the statistics and reschedule the next expected beat of each detector
+        """
+        stats = self.beat_statistics(df)
+        # not enough statistics, nothing to expect.
+        enough = stats['count'] >= 5
+        for detector, count in stats.loc[~enough, 'count'].items():
+            vprint(f"[DEBUG] >>>>> {detector} len {count} Not enough!", self.verbose)
+        stats = stats[enough]
+        for detector in self.deadlines:
+            if detector not in stats.index:
+                self.deadlines.cancel(detector)
+        expected = stats['last_hb'] + pd.to_timedelta(stats['threshold'], unit='s')
+        for detector, deadline in expected.items():
+            self.deadlines.schedule(detector, deadline)
+        return stats
+
+    def beat_statistics(self, df):
+        """ Compute the last beat, the mean and std of the time between beats and
+            the trigger threshold (mean+3*std) of every detector in a single pass
 
-    def control(self, df):
-        """ Check the current cache, check if any detector
-            missed a beat
+        Returns
+        -------
+        stats : `pandas.DataFrame`
+            indexed by detector, with columns count, mean, std, threshold and last_hb
 
         """
-        # get the heartbeats of this detector from last 24 hours
+        # get the heartbeats from last 24 hours
         last24hours = (datetime.utcnow() - timedelta(hours=24))
-        data = df[df['Received Times'] > last24hours]
-        data.sort_values('Received Times', inplace=True)
-
-        for detector in data['Detector'].unique():
-            detector_df = data.query('Detector==@detector')
-            # For a given detector, if already sent an email,
-            # ignore the beats before that email. Otherwise, the same cause would ruin the statistics.
-            after_last_hb =  self.last_feedback_time[detector]
-            detector_df = detector_df[detector_df['Received Times'] > after_last_hb]
-            detector_df.sort_values('Received Times', inplace=True)
-
-            if len(detector_df) < 5:
-                # not enough statistics, skip.
-                vprint(f"[DEBUG] >>>>> len {len(detector_df)} Not enough!", self.verbose)
-                continue
-            # check if a heartbeat is skipped
-            self.check_missed_beats(detector_df, detector)
-
-    def check_missed_beats(self, df, detector):
-        """ Check if a heartbeat is skipped
+        received = pd.to_datetime(df['Received Times'])
+        # For a given detector, if already sent an email,
+        # ignore the beats before that email. Otherwise, the same cause would ruin the statistics.
+        after_last_hb = pd.to_datetime(df['Detector'].map(self.last_feedback_time))
+        keep = (received > last24hours) & (received > after_last_hb)
+
+        gaps = df.loc[keep, 'Time After Last'].astype(float)
+        data = pd.DataFrame({'Detector': df.loc[keep, 'Detector'], 'gap': gaps, 'gap2': gaps ** 2,
+                             'Received Times': received[keep]})
+        stats = data.groupby('Detector').agg(count=('gap', 'size'), total=('gap', 'sum'),
+                                             total2=('gap2', 'sum'), last_hb=('Received Times', 'max'))
+        stats['mean'] = stats['total'] / stats['count']
+        # population std, same as np.std
+        stats['std'] = np.sqrt((stats['total2'] / stats['count'] - stats['mean'] ** 2).clip(lower=0))
+        stats['threshold'] = stats['mean'] + 3 * stats['std']
+        return stats.drop(columns=['total', 'total2'])
+
+    def check_missed_beats(self, detector, stats):
+        """ Warn the detector whose heartbeat is skipped
+
+        Parameters
+        ----------
+        detector : `str`
+            name of the detector
+        stats : `pandas.Series`
+            the row of `beat_statistics` for this detector
 
         """
         vprint("\n[DEBUG] >>>>> Checking if beat skipped", self.verbose)
-        # get the computed delays between 2 consecutive hb
-        mean = np.mean(df['Time After Last'])
-        std = np.std(df['Time After Last'])
-
-        last_hb = df['Received Times'].values[-1] # this is a numpy.datetime
-        last_hb = pd.to_datetime(last_hb)         # we have to convert it to datetime.datetime
+        mean, std = stats['mean'], stats['std']
+        last_hb = stats['last_hb']
         since_lasthb = datetime.utcnow() - last_hb
         vprint(f"[DEBUG] >>>>> mean:{mean:.2f}, std:{std:.2f}, trigger at {mean + 3 * std:.2f}", self.verbose)
         vprint(f"[DEBUG] >>>>> Delay since last: {since_lasthb.total_seconds():.2f}", self.verbose)
@@ -120,6 +231,9 @@ class FeedBack:
             # send warning to detector
             send_warning_mail(detector, text)
             self.last_feedback_time[detector] = last_hb
+            if self.journal is not None:
+                self.journal.append('feedback', (detector, last_hb))
+                self.journal.checkpoint()
         return None
 
     def check_enough_detectors(self):
@@ -128,13 +242,28 @@ class FeedBack:
         """
         pass
 
+def _as_heartbeat_frame(df):
+    """ Bring the shared heartbeat cache to the same shape as the parsed mirror csv
+    """
+    df = df.reset_index(drop=True)
+    df['Received Times'] = pd.to_datetime(df['Received Times'])
+    return df
+
+def load_heartbeats():
+    """ Get the current heartbeat cache. It is read live from `run-coincidence`
+        when its state socket is reachable, otherwise from the mirror csv on disk
+    """
+    _, df = read_heartbeat_state(state_socket_path())
+    if df is None:
+        return pd.read_csv(mirror_csv, parse_dates=['Received Times'], )
+    return _as_heartbeat_frame(df)
+
 def check_frequencies_and_send_mail(detector, given_contact=None):
     """ Create a plot with latency and heartbeat frequencies
         and send it via emails
     """
-    df = pd.read_csv(mirror_csv, parse_dates=['Received Times'], )
+    df = load_heartbeats()
     df.query("Detector==@detector", inplace=True)
-    now_str = datetime.utcnow().strftime("%Y-%m-%d_%HH%MM")
     mean = np.mean(df['Time After Last'])
     std = np.std(df['Time After Last'])
     try:
@@ -151,28 +280,47 @@ def check_frequencies_and_send_mail(detector, given_contact=None):
            f" The received heartbeat frequency, together with the computed latency" \
            f" is plotted, and sent in the attachment."
 
-    attachment = f"{detector}_{now_str}.png"
-    plot_beats(df, detector, attachment)  # create a plot to send
+    attachment = render_beats(df, detector)  # create a plot to send, or reuse an identical one
     out = send_feedback_mail(detector, attachment, text, given_contact=given_contact)
     return attachment, out
 
 
+def render_beats(df, detector):
+    """ Plot the beats of a detector, reusing the figure if the same data was plotted before
+        The figures are cached on disk, keyed by the detector and a hash of the plotted data window
+
+    Returns
+    -------
+    figname : `str`
+        path of the figure, relative to the beats directory
+
+    """
+    columns = ['Received Times', 'Latency', 'Time After Last', 'Status']
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df[columns], index=False).values.tobytes()).hexdigest()
+    figname = os.path.join(os.path.basename(figure_cache), f"{detector}_{digest[:16]}.png")
+    figpath = os.path.join(beats_path, figname)
+    if os.path.isfile(figpath):
+        log.debug(f"\t> Reusing the feedback figure {figname} for {detector}")
+        os.utime(figpath)  # recently used, keep it around
+        return figname
+
+    make_beat_directory(figure_cache)
+    # render next to it and move in place, so a half written figure is never picked up
+    tmpname = f"{figname}.{os.getpid()}.tmp.png"
+    plot_beats(df, detector, tmpname)
+    os.replace(os.path.join(beats_path, tmpname), figpath)
+    return figname
+
+
 def plot_beats(df, detector, figname):
     """ Requires QT libraries: sudo apt-get install qt5-default
     """
+    # matplotlib is slow to import, only load it when a figure is needed
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
     latency = pd.to_timedelta(df['Latency'].values).total_seconds()
-    received_times = df['Received Times']
-    unique_days = list(set([datetime.strptime(date, '%Y-%m-%d %H:%M:%S.%f').strftime('%Y-%m-%d') for date in received_times]))
-    if len(unique_days) > 1:
-        date = "&".join([i for i in unique_days])
-    else:
-        date = list(unique_days)[0]
-
-    xticklabels = []
-    for date in received_times:
-        dt = datetime.strptime(date, '%Y-%m-%d %H:%M:%S.%f')
-        time_str = dt.strftime('%H:%M:%S')
-        xticklabels.append(time_str)
+    received_times = pd.to_datetime(df['Received Times']).to_numpy(dtype='datetime64[us]')
+    date = "&".join(np.unique(received_times.astype('datetime64[D]')).astype(str))
 
     time_after_last = df['Time After Last'].astype(float)
     mean = np.mean(time_after_last)
@@ -195,44 +343,38 @@ def plot_beats(df, detector, figname):
     ax2.scatter(received_times, latency, marker='o', c=latency, cmap='Wistia', ec='b', s=3.2**(latency), zorder=20)
     ax2.set_ylabel('Latency [sec]', color='k', fontsize=18)
     ax2.set_xlabel("Received Times", fontsize=18)
-    xticks_positions, _ = plt.xticks()
-    ax2.set_xticks(xticks_positions, xticklabels);
+    ax2.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
     ax2.tick_params(axis='x', labelsize=18)
     ax1.tick_params(axis='y', labelsize=18)
     ax2.tick_params(axis='y', labelsize=18)
     ax2.set_ylim(0, np.max([8, np.max(latency)]))
 
     ax1.legend(loc='upper right', fontsize=18); ax2.legend(loc='upper right', fontsize=18)
-    plt.savefig(os.path.join(beats_path, figname))
+    fig.savefig(os.path.join(beats_path, figname))
+    plt.close(fig)
 
 def delete_old_figures():
     """ Remove the old feedback figures from the server
         the duration set in the configuration file
+        A cached figure counts from the last time it was used
     """
     delete_after = timedelta(days=int(os.getenv("REMOVE_FIGURES_AFTER")))
-    now = datetime.utcnow()
-
-    # the times of existing figures
-    existing_figures = os.listdir(beats_path)
-    existing_figures = np.array([x for x in existing_figures if x.endswith('.png')])
-    # take only dates
-    dates_str = ["_".join(i.split('/')[-1].split("_")[1:]).split('.png')[0] for i in existing_figures]
-    dates, files = [], []
-    for d_str, logfile in zip(dates_str, existing_figures):
-        try:
-            dates.append(datetime.strptime(d_str, "%Y-%m-%d_%HH%MM"))
-            files.append(logfile)
-        except Exception as e:
-            log.error(f"\t> Something went wrong during deletion of old figures \n\t{e}")
-            continue
+    now = datetime.utcnow().timestamp()
 
-    time_differences = np.array([date - now for date in dates])
-    older_than_limit = np.where(np.abs(time_differences) > delete_after)
-    files = np.array(files)
+    # the existing figures, in the figure cache and the older ones directly in the beats directory
+    existing_figures = [os.path.join(os.path.basename(figure_cache), x) for x in os.listdir(figure_cache)] \
+        if os.path.isdir(figure_cache) else []
+    existing_figures += [x for x in os.listdir(beats_path) if x.endswith('.png')]
+    files = np.array(existing_figures)
+    ages = np.array([now - os.path.getmtime(os.path.join(beats_path, x)) for x in existing_figures])
+    older_than_limit = np.where(ages > delete_after.total_seconds())
     log.debug(f"\t> The following feedback figures are older than "
               f"{int(os.getenv('REMOVE_FIGURES_AFTER'))} days and will be removed; "
               f"\n\t{files[older_than_limit[0]]}")
     for file in files[older_than_limit[0]]:
         filepath = os.path.join(beats_path, file)
-        os.remove(filepath)
-        log.debug(f"\t> {file} deleted.")
+        try:
+            os.remove(filepath)
+            log.debug(f"\t> {file} deleted.")
+        except OSError as e:
+            log.error(f"\t> Something went wrong during deletion of old figures \n\t{e}")
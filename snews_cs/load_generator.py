@@ -0,0 +1,272 @@
+"""
+Synthetic observation traffic, to load the coincidence system on one machine
+
+`LoadGenerator` simulates the registered detectors (auxiliary/detector_properties.json):
+    - heartbeats every `heartbeat_interval` seconds, with jitter and random dropouts
+    - background CoincidenceTier messages, a Poisson process per detector
+    - supernova bursts, where several detectors observe within the coincidence window,
+      some of them followed by an update and some by a retraction
+
+The traffic is generated in simulated time and played `speedup` times faster than
+real time (or at a fixed number of messages per second) into a file of json lines
+or an in-process topic. `measure` consumes such a topic with a `CoincidenceDistributor`
+in the same process, the way `run_coincidence` consumes the observation topic.
+
+    snews_cs simulate-load --duration 3600 --speedup 100 --output load.jsonl
+    snews_cs simulate-load --duration 3600 --speedup 1000 --measure
+
+All the messages are marked as tests, their times are not checked against the clock.
+
+"""
+
+import os
+import time
+import heapq
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from .cs_utils import get_detector_properties
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+
+class LoadGenerator:
+    """ Simulated heartbeats and observations of the registered detectors
+
+    Parameters
+    ----------
+    detectors : `list`, optional
+        Names of the simulated detectors, defaults to all the registered ones
+    heartbeat_interval : `float`
+        Seconds between two heartbeats of a detector
+    jitter : `float`
+        Relative spread of the heartbeat interval
+    dropout : `float`
+        Probability that a detector goes silent after a heartbeat, for
+        10 heartbeat intervals on average. Half of the dropouts send an OFF beat first.
+    noise_rate : `float`
+        Background CoincidenceTier messages per detector per second
+    burst_interval : `float`
+        Mean seconds between two supernova bursts
+    burst_size : `tuple`
+        (min, max) number of detectors observing a burst
+    window : `float`
+        Seconds within which the detectors of a burst observe it
+    update_fraction : `float`
+        Fraction of the burst messages followed by an update
+    retraction_fraction : `float`
+        Fraction of the burst messages followed by a retraction
+    start : `datetime.datetime`, optional
+        Simulated time of the first message, defaults to now
+    seed : `int`, optional
+
+    """
+
+    def __init__(self, detectors=None, heartbeat_interval=60., jitter=0.1, dropout=0.001, noise_rate=1 / 86400.,
+                 burst_interval=1800., burst_size=(3, 8), window=10., update_fraction=0.3,
+                 retraction_fraction=0.1, start=None, seed=None):
+        properties = get_detector_properties()
+        self.detectors = {name: properties[name][1] for name in (detectors or properties)}
+        self.heartbeat_interval = heartbeat_interval
+        self.jitter = jitter
+        self.dropout = dropout
+        self.noise_rate = noise_rate
+        self.burst_interval = burst_interval
+        self.burst_size = (min(burst_size[0], len(self.detectors)), min(burst_size[1], len(self.detectors)))
+        self.window = window
+        self.update_fraction = update_fraction
+        self.retraction_fraction = retraction_fraction
+        self.start = start or datetime.utcnow()
+        self.random = random.Random(seed)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _time(self, t):
+        return (self.start + timedelta(seconds=t)).isoformat()
+
+    def _message(self, detector, tier, t, **fields):
+        machine_time = self._time(t)
+        message = {"_id": f"{self.detectors[detector]}_{tier}_{machine_time}",
+                   "detector_name": detector,
+                   "machine_time": machine_time}
+        message.update(fields)
+        message["meta"] = {"is_test": True, "simulated": True}
+        message["schema_version"] = "1.3.0"
+        message["sent_time"] = machine_time
+        return message
+
+    def heartbeat(self, detector, t, status="ON"):
+        return self._message(detector, "Heartbeat", t, detector_status=status)
+
+    def observation(self, detector, t, neutrino_t, p_val):
+        return self._message(detector, "CoincidenceTier", t, neutrino_time=self._time(neutrino_t),
+                             p_val=round(p_val, 4))
+
+    def retraction(self, detector, t):
+        return self._message(detector, "Retraction", t, retract_latest=1, retraction_reason="simulated")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def messages(self, duration):
+        """ Generate the traffic of `duration` simulated seconds
+
+        Yields
+        ------
+        (t, message) : (`float`, `dict`)
+            in order of the simulated time t (seconds after `start`) at which they are sent
+
+        """
+        rand = self.random
+        events = []  # heap of (t, order, kind, detector)
+        order = 0
+
+        def schedule(t, kind, detector=None):
+            nonlocal order
+            if t < duration:
+                heapq.heappush(events, (t, order, kind, detector))
+                order += 1
+
+        for detector in self.detectors:
+            schedule(rand.uniform(0, self.heartbeat_interval), "heartbeat", detector)
+            if self.noise_rate > 0:
+                schedule(rand.expovariate(self.noise_rate), "noise", detector)
+        if self.burst_interval > 0:
+            schedule(rand.expovariate(1 / self.burst_interval), "burst")
+
+        pending = []  # heap of (t, order, message), the burst messages and their follow-ups
+        while events or pending:
+            if pending and (not events or pending[0][0] <= events[0][0]):
+                t, _, message = heapq.heappop(pending)
+                yield t, message
+                continue
+            t, _, kind, detector = heapq.heappop(events)
+            if kind == "heartbeat":
+                next_beat = self.heartbeat_interval * max(1 + rand.gauss(0, self.jitter), 0.1)
+                if rand.random() < self.dropout:
+                    if rand.random() < 0.5:
+                        yield t, self.heartbeat(detector, t, status="OFF")
+                    next_beat += rand.expovariate(1 / (10 * self.heartbeat_interval))
+                else:
+                    yield t, self.heartbeat(detector, t)
+                schedule(t + next_beat, "heartbeat", detector)
+            elif kind == "noise":
+                latency = rand.uniform(1, 30)
+                yield t, self.observation(detector, t, t - latency, rand.uniform(0, 1))
+                schedule(t + rand.expovariate(self.noise_rate), "noise", detector)
+            elif kind == "burst":
+                size = rand.randint(*self.burst_size)
+                for detector in rand.sample(list(self.detectors), size):
+                    neutrino_t = t + rand.uniform(0, self.window)
+                    sent = neutrino_t + rand.uniform(1, 30)
+                    heapq.heappush(pending, (sent, order, self.observation(detector, sent, neutrino_t,
+                                                                           rand.uniform(0, 0.05))))
+                    order += 1
+                    if rand.random() < self.update_fraction:
+                        updated = sent + rand.uniform(30, 300)
+                        heapq.heappush(pending, (updated, order, self.observation(
+                            detector, updated, neutrino_t + rand.uniform(-1, 1), rand.uniform(0, 0.01))))
+                        order += 1
+                    if rand.random() < self.retraction_fraction:
+                        retracted = sent + rand.uniform(300, 600)
+                        heapq.heappush(pending, (retracted, order, self.retraction(detector, retracted)))
+                        order += 1
+                schedule(t + rand.expovariate(1 / self.burst_interval), "burst")
+
+    def produce(self, emit, duration, speedup=1., rate=None):
+        """ Play the traffic of `duration` simulated seconds
+
+        Parameters
+        ----------
+        emit : `callable`
+            Called with each message, e.g. the `write` of a stream
+        duration : `float`
+            Simulated seconds
+        speedup : `float`
+            Times faster than real time, 0 for as fast as possible
+        rate : `float`, optional
+            Messages per second, replaces the simulated timing if given
+
+        Returns
+        -------
+        `dict`
+            number of messages of each tier, 'messages', 'seconds' and 'rate' (messages per second)
+
+        """
+        counts = dict()
+        t0 = time.monotonic()
+        sent = 0
+        for t, message in self.messages(duration):
+            if rate:
+                due = sent / rate
+            elif speedup:
+                due = t / speedup
+            else:
+                due = 0
+            wait = due - (time.monotonic() - t0)
+            if wait > 0:
+                time.sleep(wait)
+            emit(message)
+            sent += 1
+            tier = message["_id"].split("_")[1]
+            counts[tier] = counts.get(tier, 0) + 1
+        elapsed = time.monotonic() - t0
+        return dict(counts, messages=sent, seconds=round(elapsed, 3), rate=round(sent / max(elapsed, 1e-9), 1))
+
+
+def measure(generator, duration, speedup=1., rate=None, storage_backend="sqlite", env_path=None):
+    """ Play the traffic into an in-process topic, and process it with a `CoincidenceDistributor` in this process
+
+    The observation and alert topics of the distributor are memory topics (see `transport`),
+    its database, state journal and heartbeat logs are in a temporary directory. The batches are the ones of
+    `run_coincidence`, env CONSUMER_BATCH_SIZE and CONSUMER_BATCH_TIMEOUT.
+
+    Returns
+    -------
+    `dict`
+        'produced' (see `LoadGenerator.produce`), 'processed' messages, 'alerts', 'seconds' and
+        'rate' of processing, 'max_backlog' messages waiting to be processed,
+        and 'batch_p50' / 'batch_p99' seconds to process a batch
+
+    """
+    from .snews_coinc import CoincidenceDistributor
+    from .transport import open_stream, memory_topic
+    workdir = tempfile.mkdtemp(prefix="snews_cs_load_")
+    name = os.path.basename(workdir)
+    os.environ.update(OBSERVATION_TOPIC=f"memory://{name}", FIREDRILL_OBSERVATION_TOPIC=f"memory://{name}",
+                      ALERT_TOPIC=f"memory://{name}-alerts", FIREDRILL_ALERT_TOPIC=f"memory://{name}-alerts",
+                      LOCAL_DB_PATH=os.path.join(workdir, "snews_db.sqlite3"),
+                      STATE_DIR=os.path.join(workdir, "state"),
+                      ARCHIVE_MESSAGES="False",
+                      ALERT_LEASE="off",
+                      HB_SHARE_STATE="False")
+    distributor = CoincidenceDistributor(env_path=env_path, drop_db=True, hb_path=os.path.join(workdir, "beats"),
+                                         server_tag="load-test", send_email=False, send_slack=False, storage_backend=storage_backend)
+    observations = memory_topic(name)
+    produced = dict()
+
+    def play():
+        with open_stream(f"memory://{name}", "w") as stream:
+            produced.update(generator.produce(stream.write, duration, speedup=speedup, rate=rate))
+        observations.finish()
+
+    player = threading.Thread(target=play, name="load-generator", daemon=True)
+    durations, processed, max_backlog = [], 0, 0
+    t0 = time.monotonic()
+    player.start()
+    try:
+        with open_stream(distributor.observation_topic, "r", group_id=distributor.consumer_group) as consumer:
+            for batch in distributor.read_batches(consumer):
+                max_backlog = max(max_backlog, len(observations.messages) - processed)
+                t = time.monotonic()
+                distributor.process_batch(batch, consumer)
+                durations.append(time.monotonic() - t)
+                processed += len(batch)
+    finally:
+        elapsed = time.monotonic() - t0
+        player.join()
+        distributor.shutdown()
+    durations.sort()
+    percentile = lambda q: round(durations[min(int(q * len(durations)), len(durations) - 1)], 4) if durations else 0
+    return dict(produced=produced, processed=processed, alerts=len(memory_topic(f"{name}-alerts").messages),
+                seconds=round(elapsed, 3), rate=round(processed / max(elapsed, 1e-9), 1), max_backlog=max_backlog,
+                batch_p50=percentile(0.5), batch_p99=percentile(0.99), workdir=workdir)
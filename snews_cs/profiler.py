@@ -0,0 +1,229 @@
+"""
+Find out where a running server spends its time and memory
+
+`SamplingProfiler` samples the stacks of all the threads (`sys._current_frames`) for a
+given number of seconds, and writes them to logs/ in the folded format of flame graphs,
+one line per distinct stack with the number of samples:
+
+    MainThread;run_coincidence (snews_coinc.py:797);process_batch (snews_coinc.py:728);... 42
+
+e.g. `flamegraph.pl logs/profile-<time>.folded > profile.svg`, or open it in speedscope.
+It is started by `run-coincidence --profile SECONDS` or by the authorized remote command 'profile'.
+
+`StageTimer` and `SlowMessageLog` time the stages of every message, and record the ones
+slower than SLOW_MESSAGE_THRESHOLD seconds to logs/slow_messages.jsonl.
+
+`MemoryReport` traces the allocations (`tracemalloc`) from its first report on, and each
+report lists the allocation sites that grew the most since the previous one, requested
+with the authorized remote command 'memory-report'.
+
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from .core.logging import getLogger, log_dir
+
+log = getLogger(__name__)
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """ Sampling profiler of all the threads of the process
+
+    Parameters
+    ----------
+    interval : `float`, optional
+        Seconds between two samples, defaults to env PROFILE_INTERVAL or 0.01
+    directory : `str`, optional
+        Where the profiles are written, defaults to logs/
+
+    """
+
+    def __init__(self, interval=None, directory=None):
+        self.interval = float(interval or os.getenv("PROFILE_INTERVAL", "0.01"))
+        self.directory = directory or log_dir
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration):
+        """ Sample for `duration` seconds in a background thread, then write the profile
+
+        Returns
+        -------
+        `str` or None
+            path of the profile to be written, None if a profile is already running
+
+        """
+        with self._lock:
+            if self.running:
+                log.info("\t> A profile is already running, not starting another one.")
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"profile-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.folded")
+            self._thread = threading.Thread(target=self._run, args=(float(duration), path), name="profiler",
+                                            daemon=True)
+            self._thread.start()
+        log.info(f"\t> Profiling for {duration} sec. every {self.interval} sec., writing to {path}")
+        return path
+
+    def _run(self, duration, path):
+        stacks = Counter()
+        names = dict()
+        me = threading.get_ident()
+        end = time.monotonic() + duration
+        samples = 0
+        while time.monotonic() < end:
+            names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        with open(path, "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        log.info(f"\t> Profile of {samples} samples is written to {path}")
+
+
+class StageTimer:
+    """ Durations of the successive stages of processing a message
+
+        timer = StageTimer()
+        ...
+        timer.lap("format")   # time since the previous lap
+        ...
+        timer.lap("cache")
+
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.stages = dict()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.) + now - self._last
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+
+class SlowMessageLog:
+    """ Record the stage breakdown of the messages processed slower than a threshold
+
+    Parameters
+    ----------
+    threshold : `float`, optional
+        Seconds, defaults to env SLOW_MESSAGE_THRESHOLD or 1
+    path : `str`, optional
+        json lines file, defaults to logs/slow_messages.jsonl
+
+    """
+
+    def __init__(self, threshold=None, path=None):
+        self.threshold = float(threshold or os.getenv("SLOW_MESSAGE_THRESHOLD", "1"))
+        self.path = path or os.path.join(log_dir, "slow_messages.jsonl")
+
+    def check(self, message_id, timer):
+        """ Record the message if `timer` took longer than the threshold
+
+        Returns
+        -------
+        `bool`
+            True if the message was slow
+
+        """
+        if timer.total <= self.threshold:
+            return False
+        stages = {stage: round(seconds, 4) for stage, seconds in timer.stages.items()}
+        log.warning(f"\t> Slow message {message_id}: {timer.total:.3f} sec. {stages}")
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as file:
+                file.write(json.dumps(dict(time=datetime.utcnow().isoformat(), _id=message_id,
+                                           seconds=round(timer.total, 4), stages=stages)) + "\n")
+        except OSError as e:
+            log.error(f"\t> Could not record the slow message to {self.path}\n{e}")
+        return True
+
+
+def table_size(df):
+    """ Rows and bytes (deep) of a DataFrame
+    """
+    return dict(rows=len(df), bytes=int(df.memory_usage(index=True, deep=True).sum()))
+
+
+class MemoryReport:
+    """ Diffs of `tracemalloc` snapshots, taken on request
+
+    Tracing slows down every allocation, so it only starts with the first report, which
+    is the baseline of the next one. Each report compares to the previous snapshot.
+
+    Parameters
+    ----------
+    frames : `int`, optional
+        Frames kept per allocation, defaults to env MEMORY_TRACE_FRAMES or 1
+
+    """
+
+    def __init__(self, frames=None):
+        self.frames = int(frames or os.getenv("MEMORY_TRACE_FRAMES", "1"))
+        self._previous = None
+        self._previous_time = None
+
+    def report(self, top=10, tables=None):
+        """ Snapshot the traced allocations, and compare them to the previous snapshot
+
+        Parameters
+        ----------
+        top : `int`
+            Number of allocation sites in the report
+        tables : `dict`, optional
+            name -> `pandas.DataFrame` whose sizes are reported
+
+        Returns
+        -------
+        `dict`
+            'traced' and 'peak' bytes, the sizes of the `tables`, and 'top', the sites that grew the most
+            since 'since' (empty for the first report, when tracing starts)
+
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            log.info(f"\t> Tracing the memory allocations from now on, with {self.frames} frames.")
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        traced, peak = tracemalloc.get_traced_memory()
+        report = dict(time=datetime.utcnow().isoformat(), since=self._previous_time, traced=traced, peak=peak,
+                      tables={name: table_size(df) for name, df in (tables or {}).items()}, top=[])
+        if self._previous is not None:
+            for stat in snapshot.compare_to(self._previous, "lineno")[:top]:
+                frame = stat.traceback[0]
+                report["top"].append(dict(site=f"{frame.filename}:{frame.lineno}", size=stat.size,
+                                          size_diff=stat.size_diff, count=stat.count, count_diff=stat.count_diff))
+        self._previous, self._previous_time = snapshot, report["time"]
+        return report
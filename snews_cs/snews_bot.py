@@ -2,97 +2,160 @@
 # Melih Kara, Karlsruhe Institute of Technology
 # make sure you have the slackAPI installed pip install slack_sdk
 # https://api.slack.com/reference/surfaces/formatting
-# TODO: Later, use threaded options to add new incoming messages to same alert
 
 from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
 import os
-from . import cs_utils
-from .cs_alert_schema import CoincidenceTierAlert
+import queue
+import threading
+import time
+from .core.logging import getLogger
+from .alert_render import get_image, markdown_table
 import warnings
-import pandas as pd
-
-cs_utils.set_env()
-slack_token = os.getenv('SLACK_TOKEN')
-client = WebClient(slack_token)
-broker = os.getenv("HOP_BROKER")
-alert_topic = os.getenv("ALERT_TOPIC")
-slack_channel_id = os.getenv("slack_channel_id")
-alert_schema = CoincidenceTierAlert()
-
-def get_image(is_test, alert_data, topic):
-    ## parse input
-    tag = '<!here>\n' if not is_test else '\n'
-    test = "TEST" if is_test else ""
-    topic_str = f"\n> Broker: {topic.center(50,'-')}"
-
-    alert_data = alert_data or dict(server_tag="Unknown Server",
-                                    alert_type="Unkown",
-                                    _id="Unknown ID",
-                                    false_alarm_prob="Unknown")
-    # update = True if "UPDATE" in alert_data['_id'] else False
-    # update = "UPDATE" if update else ""
-    alert_type = alert_data['alert_type']
-    server = alert_data['server_tag']
-    falseprob = alert_data['False Alarm Prob']
-
-    header = f"{test} *SUPERNOVA ALERT* {alert_type}".center(60, '=')+topic_str+f"{tag}" + \
-             f"> False Alarm Probability= *{falseprob}*\n> Issued from {server}"
-    giflink = "https://raw.githubusercontent.com/SNEWS2/SNEWS_Coincidence_System/main/snews_cs/auxiliary/snalert.gif"
-    retractlink = "https://www.shutterstock.com/image-vector/ooops-word-bubble-pop-art-600w-408777070.jpg"
-    updatelink = "https://www.shutterstock.com/image-vector/vector-illustration-modern-label-new-600w-1520423249.jpg"
-    # updatelink = "https://raw.githubusercontent.com/SNEWS2/SNEWS_Coincidence_System/main/snews_cs/auxiliary/update_image.png"
-    #"https://www.ris.world/wp-content/uploads/2018/09/update.jpg"
-    sendlink = giflink if alert_type=="NEW_MESSAGE" else (updatelink if alert_type=="UPDATE" else retractlink)
-
-    im = \
-        [{
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": header
-            }
-        },
-        {
-            "type": "image",
-            "image_url": sendlink,
-            "alt_text": "snews-alert"
-        },
-        {
-            "type": "actions",
-            "block_id": "actionblock789",
-            "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Checkout the SNEWS webpage!"
-                            },
-                    "url": "http://snews2.org"
-                }
-                        ]
-        }
-    ]
-    return im
-
-
-# it is going to be two subsequent messages
-# Later we can brush this up
-# TODO: for tables it complains
-# UserWarning: The `text` argument is missing in the request payload for a chat.postMessage call -
-# It's a best practice to always provide a `text` argument when posting a message.
-# The `text` argument is used in places where content cannot be rendered such as: system push notifications,
-# assistive technology such as screen readers, etc.
-def send_table(alert_data, alert, is_test, topic):
+
+log = getLogger(__name__)
+
+
+class SlackDispatcher:
+    """ Post the alerts on slack from a background thread
+
+    The posts are paced by a token bucket and a rate limited (429) call is retried
+    after the `Retry-After` the server asks for, so a burst of alerts never blocks
+    the coincidence loop. UPDATE and RETRACTION alerts are posted as replies in the
+    thread of the first alert of the same sub-group.
+
+    Parameters
+    ----------
+    client : `slack_sdk.WebClient`, optional
+        Defaults to a client with the SLACK_TOKEN, any object with `chat_postMessage` works
+    channel : `str`, optional
+        Defaults to env slack_channel_id
+    rate : `float`, optional
+        Sustained posts per second, defaults to env SLACK_RATE or 1
+    burst : `int`, optional
+        Posts allowed at once, defaults to env SLACK_BURST or 4
+
+    """
+
+    def __init__(self, client=None, channel=None, rate=None, burst=None, max_retries=5):
+        self.client = client or WebClient(os.getenv('SLACK_TOKEN'))
+        self.channel = channel or os.getenv("slack_channel_id")
+        self.rate = float(rate or os.getenv("SLACK_RATE", "1"))
+        self.burst = float(burst or os.getenv("SLACK_BURST", "4"))
+        self.max_retries = max_retries
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        # sub group -> ts of the first alert posted for it
+        self.threads = dict()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def _put(self, job):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="slack-dispatcher", daemon=True)
+            self._worker.start()
+        self._queue.put(job)
+
+    def submit(self, alert_data, alert, is_test, topic, rendered=None):
+        """ Queue an alert to be posted
+        """
+        self._put((alert_data, alert, is_test, topic, rendered))
+
+    def flush(self, timeout=None):
+        """ Wait until the queued alerts are posted, returns False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def forget_threads(self):
+        """ Sub-group numbers restart after a cache reset, do not reply to older threads
+            Queued behind the pending alerts, which still reply to the threads of before the reset
+        """
+        self._put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    self.threads.clear()
+                else:
+                    self.post(*job)
+            except Exception as e:
+                log.error(f"\t> Could not post the alert on slack\n{e}")
+            finally:
+                self._queue.task_done()
+
+    def post(self, alert_data, alert, is_test, topic, rendered=None):
+        """ Post the alert header, and the table as a reply to it
+            If the alert is already rendered (`alert_render.RenderedAlert`), its blocks and table are used
+        """
+        if rendered is not None:
+            image_block, table = rendered.slack_blocks, rendered.markdown
+        else:
+            image_block, table = get_image(is_test, alert, topic), markdown_table(alert_data)
+        sub_group = alert.get("sub list number")
+        thread_ts = None
+        if alert.get("alert_type") in ["UPDATE", "RETRACTION"]:
+            thread_ts = self.threads.get(sub_group)
+        header = self._call(channel=self.channel, blocks=image_block, thread_ts=thread_ts,
+                            text=f"SUPERNOVA ALERT {alert.get('alert_type')}")
+        if header is None:
+            return
+        if thread_ts is None:
+            thread_ts = header["ts"]
+            self.threads[sub_group] = thread_ts
+        self._call(channel=self.channel, text=f'```{table}```', thread_ts=thread_ts)
+
+    def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate)
+
+    def _call(self, **kwargs):
+        kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        for attempt in range(self.max_retries):
+            self._take_token()
+            try:
+                with warnings.catch_warnings():
+                    warnings.filterwarnings("ignore")
+                    return self.client.chat_postMessage(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    log.error(f"\t> Slack refused the alert post\n{e}")
+                    return None
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+                log.info(f"\t> Slack rate limit hit, retrying in {retry_after} sec.")
+                time.sleep(retry_after)
+        log.error(f"\t> Giving up the slack post after {self.max_retries} rate limited attempts.")
+        return None
+
+
+_dispatcher = None
+
+def get_dispatcher():
+    """ The slack dispatcher of this process
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = SlackDispatcher()
+    return _dispatcher
+
+
+def send_table(alert_data, alert, is_test, topic, rendered=None):
     """ send warning on slack.
         Both alert_data (dictionary with info from each detector)
         and the alert (single dict with collected info) are required
+        The alert is queued and posted in the background, see `SlackDispatcher`
+        Pass `rendered` to reuse the blocks and table rendered for the other channels
     """
-    df = pd.DataFrame.from_dict(alert_data)
-    df_simplified = df[["detector_names", "neutrino_times", "p_vals"]]
-    df_simplified.sort_values("neutrino_times", inplace=True)
-    table = df_simplified.to_markdown() # tablefmt="grid"
-    image_block = get_image(is_test, alert, topic)
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore")
-        client.chat_postMessage(channel=slack_channel_id, blocks=image_block)
-        client.chat_postMessage(channel=slack_channel_id, text=f'```{table}```')
+    get_dispatcher().submit(alert_data, alert, is_test, topic, rendered)
@@ -1,24 +1,32 @@
 from . import cs_utils
-from .snews_db import Storage
+from .snews_db import get_storage, close_mongo_clients
 import os, click
-from datetime import datetime
+from datetime import datetime, timedelta
 from .alert_pub import AlertPublisher
-import numpy as np
 import pandas as pd
-from hop import Stream
-from . import snews_bot
 from .cs_alert_schema import CoincidenceTierAlert
+from .alert_render import AlertRenderer, snapshot_sub_group
 from .cs_remote_commands import CommandHandler
-from .core.logging import getLogger
-from .cs_email import send_email
+from .core.logging import getLogger, initialize_logging
+from .cs_email import send_email, get_mailer
 from .snews_hb import HeartBeat
-from .cs_stats import cache_false_alarm_rate
+from .feedback_jobs import FeedbackJobs
+from .state_journal import StateJournal
+from .archiver import MessageArchiver
+from .transport import open_stream
+from .profiler import SamplingProfiler, StageTimer, SlowMessageLog, MemoryReport
+from .dead_letters import DeadLetterLog, malformed_errors
+from .alert_lease import get_alert_leases
 import sys
+import queue
 import random
 import time
+import uuid
+import threading
 import adc.errors
 
 log = getLogger(__name__)
+pd.options.mode.chained_assignment = None
 
 
 # TODO: duplicate for a test-cache. Do not drop actual cache each time there are tests
@@ -29,16 +37,37 @@ class CacheManager:
     """
 
     def __init__(self):
-        # define the col names of the cache df
-        self.cache = pd.DataFrame(columns=[
+        # define the col names of the cache df, the neutrino times are parsed once to int64 nanoseconds
+        self.cache = pd.DataFrame({col: pd.Series(dtype="int64" if col == "neutrino_time_ns" else object) for col in [
             "_id", "detector_name", "received_time", "machine_time", "neutrino_time",
-            'neutrino_time_as_datetime',
-            "p_val", "meta", "sub_group", "neutrino_time_delta"])
+            'neutrino_time_ns',
+            "p_val", "meta", "sub_group", "neutrino_time_delta"]})
         # keep track of updated sub groups
         self.updated = []
         self.msg_state = None
         # this dict is used to store the current state of each sub group in the cache, UPDATE, COINCIDENT, None, RETRACTION.
         self.sub_group_state = {}
+        # the sub groups whose state was set by the current message, only these are decided and reset
+        self.dirty = set()
+
+    def set_state(self, sub_group_tag, state):
+        """ Set the state of a sub group, and mark it as changed by the current message
+        """
+        self.sub_group_state[sub_group_tag] = state
+        self.dirty.add(sub_group_tag)
+
+    def changed_states(self):
+        """ The (sub group tag, state) set by the current message, in order of the tags
+        """
+        return [(tag, self.sub_group_state[tag]) for tag in sorted(self.dirty)]
+
+    def reset_states(self):
+        """ Reset the states set by the current message, once its alerts are decided
+        """
+        for tag in self.dirty:
+            self.sub_group_state[tag] = None
+        self.dirty.clear()
+        self.updated = []
 
     def add_to_cache(self, message):
         """
@@ -56,7 +85,7 @@ class CacheManager:
             print('RETRACTING MESSAGE FROM')
             self.cache_retraction(retraction_message=message)
             return None  # break if message is meant for retraction
-        message['neutrino_time_as_datetime'] = datetime.fromisoformat(message['neutrino_time'])
+        message['neutrino_time_ns'] = cs_utils.as_nanoseconds(message['neutrino_time'])
         # update
         if message['detector_name'] in self.cache['detector_name'].to_list():
             self._update_message(message)
@@ -86,7 +115,7 @@ class CacheManager:
             message['neutrino_time_delta'] = 0
             message['sub_group'] = 0
             temp = pd.DataFrame([message])
-            self.sub_group_state[0] = 'INITIAL'
+            self.set_state(0, 'INITIAL')
             self.cache = pd.concat([self.cache, temp], ignore_index=True)
         # if the cache is not empty, check if the message is coincident with other sub groups
         else:
@@ -111,19 +140,14 @@ class CacheManager:
             SNEWS message
 
         """
-        # grab the current sub group tags
-        sub_group_tags = self.cache['sub_group'].unique()
+        # grab the current sub group tags, and the initial nu time (ns) of each
+        initial_times = self.cache.groupby('sub_group', sort=False)['neutrino_time_ns'].min()
+        sub_group_tags = initial_times.index
         #  this boolean declares whether if the message is not coincident
         is_coinc = False
-        for tag in sub_group_tags:
-            # query the cache, select the current sub group
-            sub_cache = self.cache.query('sub_group==@tag')
-            #  reset the index, for the sake of keeping things organized
-            sub_cache = sub_cache.reset_index(drop=True)
-            # select the initial nu time of the sub group
-            sub_ini_t = sub_cache['neutrino_time_as_datetime'].min()
-            #  make the nu time delta series
-            delta = abs(message['neutrino_time_as_datetime'] - sub_ini_t).total_seconds()
+        for tag, sub_ini_t in initial_times.items():
+            #  the nu time delta, in seconds
+            delta = abs(message['neutrino_time_ns'] - sub_ini_t) / 1e9
             #  if the message's nu time is within the coincidence window
             if 0 < delta <= 10.0:
                 # to the message add the corresponding sub group and nu time delta
@@ -136,12 +160,12 @@ class CacheManager:
                 #  set the message as coinc
                 is_coinc = True
                 #  declare the state the sub group to COINC_MSG
-                self.sub_group_state[tag] = 'COINC_MSG'
+                self.set_state(tag, 'COINC_MSG')
 
         # if the message is not coincident with any of the sub groups create a new sub group
         if not is_coinc:
             # set the message's nu time, as the initial nu time
-            new_ini_t = message['neutrino_time_as_datetime']
+            new_ini_t = message['neutrino_time_ns']
             # create the sub group tag
             new_sub_tag = len(sub_group_tags)
             #  turn the message into a df
@@ -151,8 +175,7 @@ class CacheManager:
             #  drop dublicates of detector name and nu time
             temp_cache = temp_cache.drop_duplicates(subset=['detector_name', 'neutrino_time'])
             # create  a new time delta
-            temp_cache['neutrino_time_delta'] = (
-                    pd.to_datetime(temp_cache['neutrino_time_as_datetime']) - new_ini_t).dt.total_seconds()
+            temp_cache['neutrino_time_delta'] = (temp_cache['neutrino_time_ns'] - new_ini_t) / 1e9
             # Make two subgroup one for early signal and post
             new_sub_group_early = temp_cache.query('-10 <= neutrino_time_delta <= 0')
             new_sub_group_post = temp_cache.query('0 <= neutrino_time_delta <= 10.0')
@@ -163,8 +186,8 @@ class CacheManager:
             new_sub_group_early['sub_group'] = new_sub_tag
             new_sub_group_post['sub_group'] = new_sub_tag + 1
             # sort sub-group by nu time
-            new_sub_group_early = new_sub_group_early.sort_values(by='neutrino_time_as_datetime')
-            new_sub_group_post = new_sub_group_post.sort_values(by='neutrino_time_as_datetime')
+            new_sub_group_early = new_sub_group_early.sort_values(by='neutrino_time_ns')
+            new_sub_group_post = new_sub_group_post.sort_values(by='neutrino_time_ns')
             #  organize the cache
             self._organize_cache(sub_cache=new_sub_group_post)
             self._organize_cache(sub_cache=new_sub_group_early)
@@ -223,7 +246,7 @@ class CacheManager:
         # concat to the cache
         self.cache = pd.concat([self.cache, sub_cache], ignore_index=True)
         #  sort the values of the cache by their sub group and nu time ( ascending order)
-        self.cache = self.cache.sort_values(by=['sub_group', 'neutrino_time_as_datetime']).reset_index(drop=True)
+        self.cache = self.cache.sort_values(by=['sub_group', 'neutrino_time_ns']).reset_index(drop=True)
 
     def _fix_deltas(self, sub_df):
         """
@@ -240,14 +263,13 @@ class CacheManager:
 
         """
         #  find the new initial nu time
-        initial_time = sub_df['neutrino_time_as_datetime'].min()
+        initial_time = sub_df['neutrino_time_ns'].min()
         #  drop the old delta col
         sub_df = sub_df.drop(columns='neutrino_time_delta', axis=0)
         #  make the new delta col
-        sub_df['neutrino_time_delta'] = (
-                pd.to_datetime(sub_df['neutrino_time_as_datetime']) - initial_time).dt.total_seconds()
+        sub_df['neutrino_time_delta'] = (sub_df['neutrino_time_ns'] - initial_time) / 1e9
         #  sort the nu times by ascending order
-        sub_df = sub_df.sort_values(by=['neutrino_time_as_datetime'])
+        sub_df = sub_df.sort_values(by=['neutrino_time_ns'])
         return sub_df
 
     def _update_message(self, message):
@@ -269,25 +291,24 @@ class CacheManager:
         update_message = f'\t> UPDATING MESSAGE FROM: {update_detector}'
         log.info(update_message)
         # get indices of where the detector name is present
-        detector_ind = self.cache.query(f'detector_name==@update_detector').index.to_list()
+        detector_ind = self.cache.query('detector_name==@update_detector').index.to_list()
         #  loop through the indices
         for ind in detector_ind:
             # get the sub tag
             sub_tag = self.cache['sub_group'][ind]
             #  declare the state of the sub group as UPDATE
-            self.sub_group_state[sub_tag] = 'UPDATE'
+            self.set_state(sub_tag, 'UPDATE')
             #  get the initial nu time of the sub group
-            initial_time = self.cache.query('sub_group==@sub_tag')['neutrino_time_as_datetime'].min()
+            initial_time = self.cache.loc[self.cache['sub_group'] == sub_tag, 'neutrino_time_ns'].min()
             # ignore update if the updated message is outside the coincident window
-            if abs((message['neutrino_time_as_datetime'] - initial_time).total_seconds()) > 10.0:
+            if abs(message['neutrino_time_ns'] - initial_time) / 1e9 > 10.0:
                 continue
             # update the message if it is coincident with the current sub group
             else:
                 #  find the ind to be updated and replace its contents with
                 for key in message.keys():
                     self.cache.at[ind, key] = message[key]
-                self.cache.at[ind, 'neutrino_time_delta'] = (
-                        message['neutrino_time_as_datetime'] - initial_time).total_seconds()
+                self.cache.at[ind, 'neutrino_time_delta'] = (message['neutrino_time_ns'] - initial_time) / 1e9
                 # append the updated list
                 self.updated.append(self.cache['sub_group'][ind])
 
@@ -305,7 +326,7 @@ class CacheManager:
                 self.cache = pd.concat([self.cache, sub_df], ignore_index=True)
                 #  sort the values of the cache by sub group nu time
                 self.cache = self.cache.sort_values(
-                    by=['sub_group', 'neutrino_time_as_datetime']).reset_index(drop=True)
+                    by=['sub_group', 'neutrino_time_ns']).reset_index(drop=True)
 
     def cache_retraction(self, retraction_message):
         """
@@ -326,7 +347,7 @@ class CacheManager:
         if len(self.cache) == 0:
             return 0
         for sub_tag in self.cache['sub_group'].unique():
-            self.sub_group_state[sub_tag] = 'RETRACTION'
+            self.set_state(sub_tag, 'RETRACTION')
             other_sub = self.cache.query('sub_group == @sub_tag')
             if other_sub['neutrino_time_delta'].min() != 0.0:
                 if len(other_sub) == 1:
@@ -335,24 +356,34 @@ class CacheManager:
 
                 else:
                     # set new initial nu time
-                    new_initial_time = pd.to_datetime(other_sub['neutrino_time_as_datetime'].min())
+                    new_initial_time = other_sub['neutrino_time_ns'].min()
                     # drop the old delta
                     other_sub = other_sub.drop(columns=['neutrino_time_delta'])
                     #  make new delta
-                    other_sub['neutrino_time_delta'] = (pd.to_datetime(
-                        other_sub['neutrino_time_as_datetime']) - new_initial_time).dt.total_seconds()
+                    other_sub['neutrino_time_delta'] = (other_sub['neutrino_time_ns'] - new_initial_time) / 1e9
                 # concat retracted sub group to the cache
                 self.cache = self.cache.query('sub_group!=@sub_tag')
                 self.cache = pd.concat([self.cache, other_sub], ignore_index=True)
-                self.cache = self.cache.sort_values(by='neutrino_time').reset_index()
+                self.cache = self.cache.sort_values(by='neutrino_time_ns').reset_index()
             # log retraction to log file
             log.info(f"\t> Retracted {logstr} from sub-group {sub_tag}")
 
 
+def received_time(metadata):
+    """ Time the message at `metadata` was received in its topic (the Kafka timestamp,
+        or when a memory or file stream read it), None if it has none
+    """
+    timestamp = getattr(metadata, "timestamp", None)
+    if not isinstance(timestamp, (int, float)) or timestamp <= 0:
+        return None
+    return datetime.utcfromtimestamp(timestamp / 1000)
+
+
 class CoincidenceDistributor:
 
     def __init__(self, env_path=None, use_local_db=True, drop_db=False, firedrill_mode=True, hb_path=None,
-                 server_tag=None, send_email=False, send_slack=True, show_table=False):
+                 server_tag=None, send_email=False, send_slack=True, show_table=False, storage_backend=None,
+                 warm_start=False, restore_state=False):
         """This class is in charge of sending alerts to SNEWS when CS is triggered
 
         Parameters
@@ -363,18 +394,31 @@ class CoincidenceDistributor:
             tells CoincDecider to use local MongoClient, defaults to True
         send_slack: `bool`
             Whether to send alerts on slack
+        storage_backend: `str`
+            'mongo' or 'sqlite', defaults to env STORAGE_BACKEND or 'mongo'
+        warm_start: `bool`
+            Rebuild the cache from the messages stored within the cache lifetime, implies drop_db=False
+        restore_state: `bool`
+            Restore the cache and heartbeat state from the journal of the previous run (see `state_journal`)
 
         """
+        initialize_logging("debug")
         log.debug("Initializing CoincDecider\n")
         cs_utils.set_env(env_path)
         self.show_table = show_table
         self.send_email = send_email
+        if send_email:
+            # deliver what the previous run left in the outbox, and keep retrying it
+            get_mailer()
         self.send_slack = send_slack
         self.hb_path = hb_path
         # name of your sever, used for alerts
         self.server_tag = server_tag
-        # initialize local MongoDB
-        self.storage = Storage(drop_db=drop_db, use_local_db=use_local_db)
+        if warm_start and drop_db:
+            log.info("\t> Warm start requested, the database is not dropped.")
+            drop_db = False
+        # initialize the database, MongoDB or the embedded one
+        self.storage = get_storage(backend=storage_backend, drop_db=drop_db, use_local_db=use_local_db)
         # declare topic type, used for alerts
         self.topic_type = "CoincidenceTier"
         #  from the env var get the coinc thresh, 10sec
@@ -386,27 +430,184 @@ class CoincidenceDistributor:
         self.max_retriable_errors = 20
         self.exit_on_error = False  # True
         self.initial_set = False
-        self.alert = AlertPublisher(env_path=env_path, use_local=use_local_db, firedrill_mode=firedrill_mode)
+        # move the old messages out of the database
+        self.archiver = None
+        if os.getenv("ARCHIVE_MESSAGES", "False").lower() == "true":
+            self.archiver = MessageArchiver(self.storage)
+            self.archiver.start()
+        self.alert = AlertPublisher(env_path=env_path, use_local=use_local_db, firedrill_mode=firedrill_mode,
+                                    storage=self.storage)
         if firedrill_mode:
             self.observation_topic = os.getenv("FIREDRILL_OBSERVATION_TOPIC")
         else:
             self.observation_topic = os.getenv("OBSERVATION_TOPIC")
+        # the observation topic is read in batches, the offsets are committed once a batch is processed
+        # each server has its own consumer group, and resumes from its committed offsets after a reconnect
+        self.consumer_group = os.getenv("CONSUMER_GROUP_ID") or f"snews-cs-{self.server_tag or 'server'}"
+        self.batch_size = int(os.getenv("CONSUMER_BATCH_SIZE", "100"))
+        self.batch_timeout = float(os.getenv("CONSUMER_BATCH_TIMEOUT", "0.5"))
+        self._heartbeats = []
+        # position in its topic of the message being processed, e.g. for the receive time of a heartbeat
+        self._metadata = None
+        # (topic, partition) -> offset of the last message processed, a redelivered message is skipped
+        self.applied_offsets = dict()
+        self._offsets_journaled = True
+        # on-demand profiles, and the stage breakdown of the slow messages
+        self.profiler = SamplingProfiler()
+        self.slow_messages = SlowMessageLog()
+        # the messages passed over because they are malformed
+        self.dead_letters = DeadLetterLog()
+        self.memory = MemoryReport()
         self.alert_schema = CoincidenceTierAlert(env_path)
+        self.renderer = AlertRenderer(server_tag=self.server_tag, topic=self.observation_topic,
+                                      is_test=True, env_path=env_path)
+        # with redundant servers, each alert is published by one of them
+        self.leases = get_alert_leases(storage=self.storage, server_tag=self.server_tag)
+        self._publish_lock = threading.Lock()
         # handle heartbeat
         self.store_heartbeat = bool(os.getenv("STORE_HEARTBEAT", "True"))
-        self.heartbeat = HeartBeat(env_path=env_path, firedrill_mode=firedrill_mode)
+        self.heartbeat = HeartBeat(env_path=env_path, firedrill_mode=firedrill_mode, directory=hb_path)
+        # requested feedbacks are handled in a process pool
+        self.feedback_jobs = FeedbackJobs()
 
         self.stash_time = 86400
         self.coinc_data = CacheManager()
+        # log of the inputs and snapshots of the state, to restore it after a crash or redeploy
+        self.journal = None
+        if os.getenv("STATE_JOURNAL", "True").lower() == "true":
+            self.journal = StateJournal("coincidence", self.get_state)
+        restored = False
+        if restore_state and self.journal is not None:
+            restored = self.restore_state()
+        elif self.journal is not None:
+            self.journal.reset()
+        if warm_start and not restored:
+            self.warm_start()
+        if self.journal is not None:
+            self.journal.checkpoint(force=True)
+            self.heartbeat.journal = self.journal
+
+    def get_state(self):
+        """ The state kept in the journal snapshots
+        """
+        return dict(cache=self.coinc_data.cache,
+                    sub_group_state=self.coinc_data.sub_group_state,
+                    heartbeat_cache=self.heartbeat.cache_df,
+                    heartbeat_last_row=self.heartbeat._last_row,
+                    false_alarms=self.heartbeat.false_alarms,
+                    offsets=dict(self.applied_offsets),
+                    reset_id=self.renderer.reset_id)
+
+    def restore_state(self):
+        """ Load the latest snapshot of the journal and replay the inputs logged after it,
+            without publishing alerts or storing anything again.
+            The offsets of the processed messages are restored too, the messages that are
+            already in the state are skipped when the broker delivers them again.
+
+        Returns
+        -------
+        `bool`
+            False if there was nothing to restore
+
+        """
+        state, records = self.journal.restore()
+        if state is not None:
+            self.coinc_data.cache = state['cache']
+            self.coinc_data.sub_group_state = state['sub_group_state']
+            self.heartbeat.cache_df = state['heartbeat_cache']
+            self.heartbeat._last_row = state['heartbeat_last_row']
+            self.heartbeat.false_alarms = state['false_alarms']
+            self.applied_offsets = dict(state.get('offsets', {}))
+            self.renderer.clear(reset_id=state.get('reset_id'))
+        for kind, payload in records:
+            if kind == 'message':
+                # (message, position) since the offsets are journaled, only the message before
+                message, position = payload if isinstance(payload, tuple) else (payload, None)
+                self.coinc_data.add_to_cache(message=message)
+                self.coinc_data.reset_states()
+                if position is not None:
+                    topic, partition, offset = position
+                    previous = self.applied_offsets.get((topic, partition), -1)
+                    self.applied_offsets[(topic, partition)] = max(offset, previous)
+            elif kind == 'offsets':
+                self.applied_offsets.update(payload)
+            elif kind == 'beats':
+                messages, received = payload
+                self.heartbeat.electrocardiogram_many(messages, received=received, replay=True)
+            elif kind == 'reset':
+                self.coinc_data = CacheManager()
+                self.renderer.clear(reset_id=payload)
+        self.heartbeat.publish_state()
+        return state is not None or len(records) > 0
+
+    def warm_start(self):
+        """ Rebuild the cache from the observation messages and retractions
+            received within the cache lifetime, e.g. after a restart.
+            The messages are replayed in the order they were received, without publishing alerts;
+            those were already sent before the restart.
+
+        Returns
+        -------
+        `int`
+            number of replayed messages
+
+        """
+        start = datetime.utcnow() - timedelta(seconds=self.cache_expiration)
+        # all_mgs is used since the tier archives expire after MSG_EXPIRATION
+        messages = self.storage.iter_query(start=start, tiers=['CoincidenceTier', 'Retraction'], page_size=1000)
+        count = 0
+        for message in messages:
+            # drop the fields the cache added, they are derived again
+            for key in ['neutrino_time_ns', 'neutrino_time_as_datetime', 'sub_group', 'neutrino_time_delta', 'tier']:
+                message.pop(key, None)
+            self.coinc_data.add_to_cache(message=message)
+            count += 1
+        # these states belong to the alerts that were already published
+        self.coinc_data.reset_states()
+        log.info(f"\t> Warm start: {count} messages since {start.isoformat()} are replayed, "
+                 f"{self.coinc_data.cache['sub_group'].nunique()} sub-groups in the cache.")
+        return count
 
     def clear_cache(self):
         """ When a reset cache is passed, recreate the
             CoincidenceDataHandler instance
+            The alerts formed after the reset get new identities (see `alert_lease`), from the
+            position of the reset message in the topic, which is the same on every server.
 
         """
         log.info("\t > [RESET] Resetting the cache.")
         del self.coinc_data
         self.coinc_data = CacheManager()
+        metadata = self._metadata
+        if metadata is not None:
+            reset_id = f"{metadata.topic}:{metadata.partition}:{metadata.offset}"
+        else:
+            reset_id = uuid.uuid4().hex
+        if self.journal is not None:
+            self.journal.append('reset', reset_id)
+        self.renderer.clear(reset_id=reset_id)
+        if self.send_slack:
+            from . import snews_bot
+            # sub-group numbers start over, new alerts should not reply to the old threads
+            snews_bot.get_dispatcher().forget_threads()
+
+    def shutdown(self):
+        """ Stop the background workers, letting the queued slack posts go out first,
+            and snapshot the state
+        """
+        self.feedback_jobs.shutdown()
+        if self.archiver is not None:
+            self.archiver.stop()
+        if self.leases is not None:
+            self.leases.stop()
+        if self.send_slack:
+            from . import snews_bot
+            snews_bot.get_dispatcher().flush(timeout=10)
+        if self.journal is not None:
+            # a redeploy restores from this snapshot without replaying
+            self.journal.checkpoint(force=True)
+            self.journal.close()
+        close_mongo_clients()
 
     # ----------------------------------------------------------------------------------------------------------------
     def display_table(self):
@@ -415,43 +616,42 @@ class CoincidenceDistributor:
 
         """
         click.secho(
-            f'Here is the current coincident table\n',
+            'Here is the current coincident table\n',
             fg='magenta', bold=True, )
         for sub_list in self.coinc_data.cache['sub_group'].unique():
             sub_df = self.coinc_data.cache.query(f'sub_group=={sub_list}')
-            sub_df = sub_df.drop(columns=['meta', 'machine_time', 'schema_version', 'neutrino_time_as_datetime'])
-            sub_df = sub_df.sort_values(by=['neutrino_time'])
+            sub_df = sub_df.sort_values(by=['neutrino_time_ns'])
+            sub_df = sub_df.drop(columns=['meta', 'machine_time', 'schema_version', 'neutrino_time_ns'])
             # snews_bot.send_table(sub_df) # no need to print the table on the server. Logs have the full content
             print(sub_df.to_markdown())
             print('=' * 168)
 
     def send_alert(self, sub_group_tag, alert_type):
-        sub_df = self.coinc_data.cache.query('sub_group==@sub_group_tag')
-        p_vals = sub_df['p_val'].to_list()
-        p_vals_avg = np.round(sub_df['p_val'].mean(), decimals=5)
-        nu_times = sub_df['neutrino_time'].to_list()
-        detector_names = sub_df['detector_name'].to_list()
-        false_alarm_prob = cache_false_alarm_rate(cache_sub_list=sub_df, hb_cache=self.heartbeat.cache_df)
-
-        alert_data = dict(p_vals=p_vals,
-                          p_val_avg=p_vals_avg,
-                          sub_list_num=sub_group_tag,
-                          neutrino_times=nu_times,
-                          detector_names=detector_names,
-                          false_alarm_prob=false_alarm_prob,
-                          server_tag=self.server_tag,
-                          alert_type=alert_type)
-
-        with self.alert as pub:
-            alert = self.alert_schema.get_cs_alert_schema(data=alert_data)
-            pub.send(alert)
+        snapshot = snapshot_sub_group(self.coinc_data.cache, sub_group_tag)
+        false_alarm_prob = self.heartbeat.false_alarms.false_alarm_prob(len(snapshot['detector_names']),
+                                                                        now=datetime.utcnow())
+        # rendered once for kafka, mail and slack
+        rendered = self.renderer.render(sub_group_tag, alert_type, snapshot, false_alarm_prob)
+        if self.leases is not None:
+            self.leases.publish_once(rendered.alert_data['alert_id'], lambda: self.publish_alert(rendered))
+        else:
+            self.publish_alert(rendered)
+
+    def publish_alert(self, rendered):
+        """ Send a rendered alert to kafka, and by mail and slack if enabled
+            Also called from the lease watcher when taking over an alert of another server
+        """
+        with self._publish_lock, self.alert as pub:
+            pub.send(rendered.kafka)
             if self.send_email:
-                send_email(alert)
+                send_email(rendered.kafka, text=rendered.email_text)
             if self.send_slack:
-                snews_bot.send_table(alert_data,
-                                     alert,
+                from . import snews_bot  # slack_sdk is only loaded when slack is used
+                snews_bot.send_table(rendered.alert_data,
+                                     rendered.kafka,
                                      is_test=True,
-                                     topic=self.observation_topic)
+                                     topic=self.observation_topic,
+                                     rendered=rendered)
 
     # ------------------------------------------------------------------------------------------------------------------
     def alert_decider(self):
@@ -462,8 +662,8 @@ class CoincidenceDistributor:
         """
         # mkae a pretty terminal output
         click.secho(f'{"=" * 100}', fg='bright_red')
-        # loop through the sub group tag and state
-        for sub_group_tag, state in self.coinc_data.sub_group_state.items():
+        # loop through the sub group tags and states changed by this message
+        for sub_group_tag, state in self.coinc_data.changed_states():
             # if state is none skip the sub group
             if state is None:
                 continue
@@ -506,11 +706,222 @@ class CoincidenceDistributor:
                 self.send_alert(sub_group_tag=sub_group_tag, alert_type=state)
                 continue
 
+    def queue_heartbeat(self, message):
+        """ Keep a heartbeat until the end of the batch, see `flush_heartbeats`
+            It is received when it was read from the topic, not when the batch is registered.
+        """
+        message["Received Times"] = received_time(self._metadata) or datetime.utcnow()
+        self._heartbeats.append(message)
+
+    def flush_heartbeats(self):
+        """ Register the queued heartbeats in one go
+        """
+        if not self._heartbeats:
+            return 0
+        beats, self._heartbeats = self._heartbeats, []
+        registered = self.heartbeat.electrocardiogram_many(beats)
+        log.debug(f"\t> {registered}/{len(beats)} heartbeats registered.")
+        return registered
+
+    def read_batches(self, consumer):
+        """ Read the consumer in a thread, and yield the messages in batches of (message, metadata)
+            A batch has up to `batch_size` messages, or the ones that arrived within
+            `batch_timeout` seconds of its first message. Nothing is committed here.
+
+        Parameters
+        ----------
+        consumer : `hop.io.Consumer`
+            or a memory or file reader of `transport`
+
+        """
+        messages = queue.Queue(maxsize=4 * self.batch_size)
+        stop = threading.Event()
+        end_of_stream = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    messages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read():
+            try:
+                for item in consumer.read(metadata=True, autocommit=False, batch_size=self.batch_size,
+                                          batch_timeout=timedelta(seconds=self.batch_timeout)):
+                    if not put(item):
+                        return
+                put(end_of_stream)
+            except Exception as e:
+                # raised in the main thread, to reconnect
+                put(e)
+
+        reader = threading.Thread(target=read, name="observation-reader", daemon=True)
+        reader.start()
+        try:
+            while True:
+                batch, end = [], None
+                item = messages.get()
+                deadline = time.monotonic() + self.batch_timeout
+                while True:
+                    if item is end_of_stream or isinstance(item, Exception):
+                        end = item
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = messages.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                if batch:
+                    yield batch
+                if isinstance(end, Exception):
+                    raise end
+                if end is not None:
+                    return
+        finally:
+            stop.set()
+
+    def process_batch(self, batch, consumer):
+        """ Process a batch of observation messages in the order they were read, then commit their offsets
+            The offsets are only committed once the batch is stored and journaled, if the server
+            stops before that, the batch is read again when it resumes. Each message is recorded
+            in `applied_offsets` once processed, so a batch read again after a reconnect skips it.
+            A malformed message is recorded to the dead letters and passed over (see `dead_letters`).
+            Any other failure stops the batch: the messages before it are committed, and the
+            exception is raised so the stream reconnects and reads the failed message again.
+
+        Parameters
+        ----------
+        batch : `list`
+            (message, metadata) pairs from `read_batches`
+        consumer : `hop.io.Consumer`
+            or a memory or file reader of `transport`
+
+        """
+        failure = None
+        for i, (snews_message, metadata) in enumerate(batch):
+            if self.is_applied(metadata):
+                log.info(f"\t> Offset {metadata.offset} of {metadata.topic} is already processed, skipping it.")
+                continue
+            try:
+                self.process_message(snews_message, metadata)
+            except malformed_errors as e:
+                log.exception(f"\t> The message at {metadata} can not be processed, moving past it.")
+                self.dead_letters.record(snews_message, metadata, e)
+            except Exception as e:
+                log.exception(f"\t> Could not process the message at {metadata}, it will be read again.")
+                # only what was processed before it is committed
+                failure, batch = e, batch[:i]
+                break
+            self.mark_applied(metadata)
+        timer = StageTimer()
+        self.flush_heartbeats()
+        self.journal_offsets()
+        timer.lap("heartbeats")
+        if hasattr(self.storage, "flush"):
+            self.storage.flush()
+        timer.lap("store")
+        if self.journal is not None:
+            self.journal.checkpoint()
+        timer.lap("checkpoint")
+        # committing the last offset of a partition commits everything before it
+        last_read = dict()
+        for _, metadata in batch:
+            if metadata is not None:
+                last_read[(metadata.topic, metadata.partition)] = metadata
+        for metadata in last_read.values():
+            consumer.mark_done(metadata, asynchronous=False)
+        timer.lap("commit")
+        self.slow_messages.check(f"batch of {len(batch)} messages", timer)
+        if failure is not None:
+            raise failure
+
+    def is_applied(self, metadata):
+        """ Whether the message at this position was already processed
+        """
+        if metadata is None:
+            return False
+        return metadata.offset <= self.applied_offsets.get((metadata.topic, metadata.partition), -1)
+
+    def mark_applied(self, metadata):
+        """ Record that the message at this position is processed
+        """
+        if metadata is None:
+            return
+        self.applied_offsets[(metadata.topic, metadata.partition)] = metadata.offset
+        self._offsets_journaled = False
+        self.journal_offsets()
+
+    def journal_offsets(self):
+        """ Log the offsets of the processed messages, see `restore_state`
+            Not while heartbeats are queued, they are only journaled once registered
+            and a restored state must not skip them.
+        """
+        if self.journal is None or self._offsets_journaled or self._heartbeats:
+            return
+        self.journal.append('offsets', dict(self.applied_offsets))
+        self._offsets_journaled = True
+
+    def process_message(self, snews_message, metadata=None):
+        """ Run a single observation message through the command handler and the coincidence logic
+            `metadata` is the position of the message in the topic, if it is read from one
+        """
+        # check for the hop version
+        try:
+            snews_message = snews_message.content
+        except Exception as e:
+            log.error(f"A message with older hop version is found. {e}\n{snews_message}")
+            snews_message = snews_message
+        timer = StageTimer()
+        self._metadata = metadata
+        # handle the input message
+        handler = CommandHandler(snews_message)
+        # if a coincidence tier message (or retraction) run through the logic
+        go = handler.handle(self)
+        if go and self.storage.has_message(snews_message['_id']):
+            log.info(f"\t> {snews_message['_id']} is already stored, skipping it.")
+            go = False
+        timer.lap("handle")
+        if go:
+            snews_message['received_time'] = datetime.utcnow().isoformat()
+            click.secho(f'{"-" * 57}', fg='bright_blue')
+            # the false alarm probability uses the heartbeats read before this message
+            self.flush_heartbeats()
+            timer.lap("heartbeats")
+            if self.journal is not None:
+                # logged before the cache adds its own fields to it
+                position = None if metadata is None else (metadata.topic, metadata.partition, metadata.offset)
+                self.journal.append('message', (dict(snews_message), position))
+            timer.lap("journal")
+            self.coinc_data.add_to_cache(message=snews_message)
+            timer.lap("cache")
+            if self.show_table:
+                self.display_table()  ## don't display on the server
+            self.alert_decider()
+            timer.lap("alerts")
+            self.storage.insert_mgs(snews_message)
+            timer.lap("store")
+            sys.stdout.flush()
+            # reset the state of the sub groups changed by this message
+            self.coinc_data.reset_states()
+        self.slow_messages.check(snews_message.get('_id') if isinstance(snews_message, dict) else None, timer)
+
+        # for each read message reduce the retriable err count
+        if self.retriable_error_count > 1:
+            self.retriable_error_count -= 1
+
     # ------------------------------------------------------------------------------------------------------------------
     def run_coincidence(self):
         """
         As the name states this method runs the coincidence system.
-        Starts by subscribing to the hop observation_topic.
+        Starts by subscribing to the observation_topic, in the consumer group of this server.
+        The topic is read through hop, or from memory or a file (see `transport`).
+        The messages are read and processed in batches, and the offsets of a batch are committed
+        after it is processed, so a reconnect resumes from the first unprocessed message.
 
         * If a CoincidenceTier message is received then it is passed to _check_coincidence.
         * other commands include "test-connection", "test-scenarios",
@@ -525,42 +936,16 @@ class CoincidenceDistributor:
 
         while True:
             try:
-                stream = Stream(until_eos=False)
-                with stream.open(self.observation_topic, "r") as s:
+                with open_stream(self.observation_topic, "r", group_id=self.consumer_group) as s:
                     click.secho(f'{datetime.utcnow().isoformat()} (re)Initializing Coincidence System for '
                                 f'{self.observation_topic}\n')
-                    for snews_message in s:
-                        # check for the hop version
-                        try:
-                            snews_message = snews_message.content
-                        except Exception as e:
-                            log.error(f"A message with older hop version is found. {e}\n{snews_message}")
-                            snews_message = snews_message
-                        # handle the input message
-                        handler = CommandHandler(snews_message)
-                        # if a coincidence tier message (or retraction) run through the logic
-                        if handler.handle(self):
-                            snews_message['received_time'] = datetime.utcnow().isoformat()
-                            click.secho(f'{"-" * 57}', fg='bright_blue')
-                            self.coinc_data.add_to_cache(message=snews_message)
-                            if self.show_table:
-                                self.display_table()  ## don't display on the server
-                            self.alert_decider()
-                            self.storage.insert_mgs(snews_message)
-                            sys.stdout.flush()
-                            # reset state of each sub group
-                            for key in self.coinc_data.sub_group_state.keys():
-                                self.coinc_data.sub_group_state[key] = None
-                            self.coinc_data.updated = []
-
-                        # for each read message reduce the retriable err count
-                        if self.retriable_error_count > 1:
-                            self.retriable_error_count -= 1
+                    for batch in self.read_batches(s):
+                        self.process_batch(batch, s)
 
             # handle a keyboard interrupt (ctrl+c)
             except KeyboardInterrupt:
                 print("Caught a keyboard interrupt.  Goodbye world!")
-                log.error(f"(2) Caught a keyboard interrupt. Exiting.\n")
+                log.error("(2) Caught a keyboard interrupt. Exiting.\n")
                 fatal_error = True
                 self.exit_on_error = True
                 sys.exit(0)
@@ -1,6 +1,173 @@
 import pymongo
+from pymongo import monitoring
 from . import cs_utils
 import os
+import re
+import json
+import time
+import sqlite3
+import atexit
+import threading
+from datetime import datetime, timedelta
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+local_db_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../local_db/snews_db.sqlite3"))
+
+
+class PoolHealth(monitoring.ConnectionPoolListener):
+    """ Counts the connection pool events of a client, see `mongo_pool_metrics`
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict(created=0, closed=0, checked_out=0, checked_in=0, check_out_failed=0, pool_cleared=0)
+        self.check_out_wait = 0.0   # seconds spent waiting for a connection
+        self._started = dict()
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self.counts)
+            metrics['open'] = metrics['created'] - metrics['closed']
+            metrics['in_use'] = metrics['checked_out'] - metrics['checked_in']
+            metrics['mean_check_out_wait'] = self.check_out_wait / max(metrics['checked_out'], 1)
+            return metrics
+
+    def connection_check_out_started(self, event):
+        self._started[threading.get_ident()] = time.monotonic()
+
+    def connection_checked_out(self, event):
+        started = self._started.pop(threading.get_ident(), None)
+        with self._lock:
+            self.counts['checked_out'] += 1
+            if started is not None:
+                self.check_out_wait += time.monotonic() - started
+
+    def connection_check_out_failed(self, event):
+        self._started.pop(threading.get_ident(), None)
+        self._count('check_out_failed')
+        log.error(f"\t> Could not get a database connection from the pool of {event.address}: {event.reason}")
+
+    def connection_checked_in(self, event):
+        self._count('checked_in')
+
+    def connection_created(self, event):
+        self._count('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count('closed')
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count('pool_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+
+# one client per server, shared by all the storages of the process
+_mongo_clients = dict()    # (uri, replicaset) -> (MongoClient, PoolHealth)
+_mongo_clients_lock = threading.Lock()
+
+
+def get_mongo_client(uri, replicaset=None):
+    """ The shared client of the server at `uri`
+        The pool is configured by env MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_MS,
+        MONGO_WAIT_QUEUE_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS and MONGO_SERVER_SELECTION_TIMEOUT_MS
+    """
+    key = (uri, replicaset)
+    with _mongo_clients_lock:
+        if key not in _mongo_clients:
+            options = dict(maxPoolSize=int(os.getenv('MONGO_MAX_POOL_SIZE', '20')),
+                           minPoolSize=int(os.getenv('MONGO_MIN_POOL_SIZE', '0')),
+                           connectTimeoutMS=int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '10000')),
+                           serverSelectionTimeoutMS=int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000')))
+            for option, env in [('maxIdleTimeMS', 'MONGO_MAX_IDLE_MS'), ('waitQueueTimeoutMS', 'MONGO_WAIT_QUEUE_TIMEOUT_MS')]:
+                if os.getenv(env):
+                    options[option] = int(os.getenv(env))
+            if replicaset is not None:
+                options['replicaset'] = replicaset
+            health = PoolHealth()
+            client = pymongo.MongoClient(uri, event_listeners=[health], **options)
+            _mongo_clients[key] = (client, health)
+            log.info(f"\t> Connected to the database at {_mask_uri(uri)}, pool of {options['maxPoolSize']}")
+        return _mongo_clients[key][0]
+
+
+def _mask_uri(uri):
+    return re.sub(r'//[^/@]*@', '//***@', uri or '')
+
+
+def mongo_pool_metrics():
+    """ Connection pool counts of each shared client, keyed by the uri without credentials
+    """
+    with _mongo_clients_lock:
+        return {_mask_uri(uri): health.metrics() for (uri, _), (_, health) in _mongo_clients.items()}
+
+
+def close_mongo_clients():
+    """ Close the shared clients, the next `get_mongo_client` connects again
+    """
+    with _mongo_clients_lock:
+        for (uri, _), (client, health) in _mongo_clients.items():
+            log.info(f"\t> Closing the database client of {_mask_uri(uri)}, pool metrics: {health.metrics()}")
+            client.close()
+        _mongo_clients.clear()
+
+
+atexit.register(close_mongo_clients)
+
+
+def _as_time_string(t):
+    """ Times are stored as iso strings, which sort as the times do
+    """
+    return t.isoformat() if isinstance(t, datetime) else t
+
+
+def _project(document, projection):
+    if projection is None:
+        return document
+    return {k: document[k] for k in ['_id'] + list(projection) if k in document}
+
+
+def get_storage(backend=None, env=None, drop_db=True, use_local_db=False):
+    """ Create the storage of the chosen backend
+
+    Both backends have the same collections and the same `insert_mgs`, `get_*`,
+    `empty_*` and `purge_archive` methods.
+
+    Parameters
+    ----------
+    backend : `str`, optional
+        'mongo' or 'sqlite', defaults to env STORAGE_BACKEND or 'mongo'
+    env : `str`, optional
+        Path to env file
+    drop_db : `bool`, optional
+        drops all items in the DB
+    use_local_db : `bool`, optional
+        Use a local Mongo server, ignored by the sqlite backend
+
+    """
+    cs_utils.set_env(env)
+    backend = (backend or os.getenv("STORAGE_BACKEND", "mongo")).lower()
+    if backend == "mongo":
+        return Storage(env=env, drop_db=drop_db, use_local_db=use_local_db)
+    if backend == "sqlite":
+        return SQLiteStorage(env=env, drop_db=drop_db)
+    raise ValueError(f"Unknown storage backend '{backend}', use 'mongo' or 'sqlite'")
 
 
 class Storage:
@@ -25,9 +192,9 @@ class Storage:
         self.mongo_server = os.getenv('DATABASE_SERVER')
 
         if use_local_db:
-            self.client = pymongo.MongoClient('mongodb://localhost:27017/', replicaset='rs0')
+            self.client = get_mongo_client('mongodb://localhost:27017/', replicaset='rs0')
         else:
-            self.client = pymongo.MongoClient(self.mongo_server)
+            self.client = get_mongo_client(self.mongo_server)
 
         self.db = self.client.snews_db
         self.all_mgs = self.db.all_mgs
@@ -68,6 +235,15 @@ class Storage:
             self.sig_tier_alerts.create_index('received_time')
             self.time_tier_alerts.create_index('received_time')
 
+        # compound indexes of the range queries, see `query`. Creating an existing index is a no-op
+        for coll in [self.all_mgs, self.false_warnings, self.sig_tier_archive, self.time_tier_archive,
+                     self.coincidence_tier_archive, self.coincidence_tier_alerts, self.time_tier_alerts,
+                     self.sig_tier_alerts]:
+            coll.create_index([('received_time', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+            coll.create_index([('detector_name', pymongo.ASCENDING), ('neutrino_time', pymongo.ASCENDING)])
+        self.all_mgs.create_index([('tier', pymongo.ASCENDING), ('received_time', pymongo.ASCENDING),
+                                   ('_id', pymongo.ASCENDING)])
+
         self.coll_list = {
             'CoincidenceTier': self.coincidence_tier_archive,
             'SigTier':self.sig_tier_archive,
@@ -80,6 +256,7 @@ class Storage:
 
     def insert_mgs(self, mgs):
         """ This method inserts a SNEWS message to its corresponding collection
+            A message that is already stored (same _id) is replaced, so it is safe to insert it again
         
         Parameters
         ----------
@@ -89,8 +266,80 @@ class Storage:
         """
         mgs_type = mgs['_id'].split('_')[1]
         specific_coll = self.coll_list[mgs_type]
-        specific_coll.insert_one(mgs)
-        self.all_mgs.insert_one(mgs)
+        specific_coll.replace_one({'_id': mgs['_id']}, mgs, upsert=True)
+        # the tier is kept in all_mgs to query a single tier through the (tier, received_time) index
+        self.all_mgs.replace_one({'_id': mgs['_id']}, dict(mgs, tier=mgs_type), upsert=True)
+
+    def has_message(self, _id):
+        """ Whether a message with this _id is stored
+        """
+        return self.all_mgs.count_documents({'_id': _id}, limit=1) > 0
+
+    def query(self, coll=None, start=None, end=None, detector_names=None, tiers=None, projection=None,
+              limit=1000, after=None, time_field='received_time', sort_order=pymongo.ASCENDING):
+        """ Returns one page of the messages matching the filters
+
+        Parameters
+        ----------
+        coll : `str`, optional
+            A key of `coll_list` (e.g. 'CoincidenceTier'), defaults to all messages
+        start, end : `str` or `datetime.datetime`, optional
+            Time range, start included and end excluded
+        detector_names : `list`, optional
+        tiers : `list`, optional
+            Message types, e.g. ['CoincidenceTier', 'Retraction'], only for all messages
+        projection : `list`, optional
+            The fields to return, '_id' is always returned
+        limit : `int`, optional
+            Size of the page
+        after : `tuple`, optional
+            The cursor returned with the previous page
+        time_field : `str`, optional
+            'received_time' or 'neutrino_time', the field of the time range and of the order
+        sort_order : `object`, optional
+            default to `pymongo.ASCENDING`
+
+        Returns
+        -------
+        (documents, cursor) : (`list`, `tuple`)
+            cursor is the (time, _id) of the last document, None if this was the last page
+
+        """
+        collection = self.all_mgs if coll is None else self.coll_list[coll]
+        conditions = []
+        if start is not None or end is not None:
+            time_range = dict()
+            if start is not None:
+                time_range['$gte'] = _as_time_string(start)
+            if end is not None:
+                time_range['$lt'] = _as_time_string(end)
+            conditions.append({time_field: time_range})
+        if detector_names is not None:
+            conditions.append({'detector_name': {'$in': list(detector_names)}})
+        if tiers is not None:
+            conditions.append({'tier': {'$in': list(tiers)}})
+        if after is not None:
+            op = '$gt' if sort_order == pymongo.ASCENDING else '$lt'
+            conditions.append({'$or': [{time_field: {op: after[0]}},
+                                       {time_field: after[0], '_id': {op: after[1]}}]})
+        query = {'$and': conditions} if conditions else {}
+        fields = None if projection is None else {k: 1 for k in list(projection) + [time_field]}
+        cursor = collection.find(query, fields).sort([(time_field, sort_order), ('_id', sort_order)]).limit(limit)
+        documents = list(cursor)
+        next_cursor = None
+        if len(documents) == limit:
+            next_cursor = (documents[-1].get(time_field), documents[-1]['_id'])
+        return [_project(doc, projection) for doc in documents], next_cursor
+
+    def iter_query(self, page_size=1000, **filters):
+        """ Stream all the messages matching the filters of `query`, one page at a time
+        """
+        after = None
+        while True:
+            documents, after = self.query(limit=page_size, after=after, **filters)
+            yield from documents
+            if after is None:
+                return
 
     def get_all_messages(self, sort_order=pymongo.ASCENDING):
         """ Returns a list of all messages in the 'all-messages' collection
@@ -169,6 +418,18 @@ class Storage:
         """
         self.coll_list[coll].delete_many({})
 
+    def delete_messages(self, ids, before):
+        """ Delete the given messages, received before `before`, from all messages in one request
+
+        Returns
+        -------
+        `int`
+            number of deleted messages
+
+        """
+        result = self.all_mgs.delete_many({'_id': {'$in': list(ids)}, 'received_time': {'$lt': _as_time_string(before)}})
+        return result.deleted_count
+
     def get_alert_collection(self, which_tier):
         """Gives a Mongo cursor for a specifc alert collection
 
@@ -186,3 +447,260 @@ class Storage:
         sort_order = pymongo.ASCENDING
         return self.coll_list[f'{which_tier}Alert'].find().sort('received_time', sort_order)
 
+
+
+class SQLiteStorage:
+    """
+    Embedded SNEWS database, on a SQLite file in WAL mode.
+    Needs no server, meant for single node deployments, development and benchmarks.
+
+    Each collection of `Storage` is a table of json documents. Inserts are buffered and
+    written in one transaction once `batch_size` messages are pending or the oldest one
+    waited `flush_interval` seconds; reads always see the pending messages.
+
+    Parameters
+    ----------
+    env : `str`, optional
+        Path to env file, defaults to './auxiliary/test-config.env'
+    drop_db : `bool`, optional
+        drops all items in the DB every time Storage is initialized, defaults to False
+    path : `str`, optional
+        The database file, defaults to env LOCAL_DB_PATH or local_db/snews_db.sqlite3
+    batch_size : `int`, optional
+        defaults to env LOCAL_DB_BATCH_SIZE or 64
+    flush_interval : `float`, optional
+        defaults to env LOCAL_DB_FLUSH_INTERVAL or 1 (seconds)
+
+    """
+
+    collections = ['all_mgs', 'false_warnings', 'sig_tier_archive', 'time_tier_archive',
+                   'coincidence_tier_archive', 'coincidence_tier_alerts', 'time_tier_alerts', 'sig_tier_alerts']
+    # fields of the documents that are also stored in their own column, for `query`
+    query_columns = ['doc_id', 'tier', 'detector_name', 'neutrino_time']
+    # these expire after MSG_EXPIRATION, as with the TTL indexes of Storage
+    expiring = ['coincidence_tier_archive', 'sig_tier_archive', 'time_tier_archive']
+
+    def __init__(self, env=None, drop_db=True, path=None, batch_size=None, flush_interval=None):
+        cs_utils.set_env(env)
+        self.mgs_expiration = int(os.getenv('MSG_EXPIRATION'))
+        self.coinc_threshold = int(os.getenv('COINCIDENCE_THRESHOLD'))
+        self.path = path or os.getenv('LOCAL_DB_PATH', local_db_path)
+        self.batch_size = int(batch_size or os.getenv('LOCAL_DB_BATCH_SIZE', '64'))
+        self.flush_interval = float(flush_interval or os.getenv('LOCAL_DB_FLUSH_INTERVAL', '1'))
+        self._lock = threading.RLock()
+        self._pending = []       # (table, row)
+        self._pending_since = None
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            for coll in self.collections:
+                if drop_db:
+                    self.connection.execute(f'DROP TABLE IF EXISTS {coll}')
+                self.connection.execute(f'CREATE TABLE IF NOT EXISTS {coll} '
+                                        f'(seq INTEGER PRIMARY KEY, received_time TEXT, document TEXT)')
+                # the queried fields have their own columns, added to the tables of older files
+                existing = [row[1] for row in self.connection.execute(f'PRAGMA table_info({coll})')]
+                for column in self.query_columns:
+                    if column not in existing:
+                        self.connection.execute(f'ALTER TABLE {coll} ADD COLUMN {column} TEXT')
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {coll}_received_time ON {coll} (received_time, doc_id)')
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {coll}_detector ON {coll} (detector_name, neutrino_time)')
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {coll}_doc_id ON {coll} (doc_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS all_mgs_tier ON all_mgs (tier, received_time, doc_id)')
+        log.info(f"\t> Using the local database {self.path}")
+
+        self.coll_list = {
+            'CoincidenceTier': 'coincidence_tier_archive',
+            'SigTier': 'sig_tier_archive',
+            'TimeTier': 'time_tier_archive',
+            'Retraction': 'false_warnings',
+            'CoincidenceTierAlert': 'coincidence_tier_alerts',
+            'SigTierAlert': 'sig_tier_alerts',
+            'TimeTierAlert': 'time_tier_alerts',
+        }
+        atexit.register(self.close)
+
+    def insert_mgs(self, mgs):
+        """ This method inserts a SNEWS message to its corresponding collection
+            A message that is already stored (same _id) is replaced, so it is safe to insert it again
+
+        Parameters
+        ----------
+        mgs : `dict`
+            dictionary of the SNEWS message
+
+        """
+        mgs_type = mgs['_id'].split('_')[1]
+        specific_coll = self.coll_list[mgs_type]
+        document = json.dumps(dict(mgs, tier=mgs_type), default=str)
+        row = (str(mgs.get('received_time', '')), document, mgs['_id'], mgs_type,
+               mgs.get('detector_name'), _as_time_string(mgs.get('neutrino_time')))
+        with self._lock:
+            self._pending.append((specific_coll, row))
+            self._pending.append(('all_mgs', row))
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+                # the batch is written after flush_interval even if no other message comes
+                timer = threading.Timer(self.flush_interval, self.flush)
+                timer.daemon = True
+                timer.start()
+            if len(self._pending) >= 2 * self.batch_size or \
+                    time.monotonic() - self._pending_since >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """ Write the pending messages in one transaction, and drop the expired ones
+        """
+        with self._lock:
+            if not self._pending or self.connection is None:
+                return
+            # table -> doc_id -> row, the last insert of a message replaces the earlier ones
+            by_table = dict()
+            for table, row in self._pending:
+                by_table.setdefault(table, dict())[row[2]] = row
+            expired = (datetime.utcnow() - timedelta(seconds=self.mgs_expiration)).isoformat()
+            with self.connection:
+                self.connection.execute('BEGIN')
+                for table, rows in by_table.items():
+                    self.connection.executemany(f'DELETE FROM {table} WHERE doc_id = ?', [(doc_id,) for doc_id in rows])
+                    self.connection.executemany(f'INSERT INTO {table} (received_time, document, doc_id, tier, '
+                                                f'detector_name, neutrino_time) VALUES (?, ?, ?, ?, ?, ?)',
+                                                list(rows.values()))
+                for table in self.expiring:
+                    self.connection.execute(f'DELETE FROM {table} WHERE received_time < ?', (expired,))
+            self._pending = []
+            self._pending_since = None
+
+    def close(self):
+        with self._lock:
+            if self.connection is not None:
+                self.flush()
+                self.connection.close()
+                self.connection = None
+
+    def _find(self, table, sort_order=pymongo.ASCENDING):
+        with self._lock:
+            self.flush()
+            order = 'ASC' if sort_order == pymongo.ASCENDING else 'DESC'
+            rows = self.connection.execute(f'SELECT document FROM {table} ORDER BY received_time {order}, seq {order}')
+            return [json.loads(document) for document, in rows]
+
+    def has_message(self, _id):
+        """ Whether a message with this _id is stored, or waiting to be written
+        """
+        with self._lock:
+            if any(table == 'all_mgs' and row[2] == _id for table, row in self._pending):
+                return True
+            return self.connection.execute('SELECT 1 FROM all_mgs WHERE doc_id = ? LIMIT 1', (_id,)).fetchone() is not None
+
+    def query(self, coll=None, start=None, end=None, detector_names=None, tiers=None, projection=None,
+              limit=1000, after=None, time_field='received_time', sort_order=pymongo.ASCENDING):
+        """ Returns one page of the messages matching the filters, see `Storage.query`
+        """
+        if time_field not in ['received_time', 'neutrino_time']:
+            raise ValueError(f"Can not query by {time_field}")
+        table = 'all_mgs' if coll is None else self.coll_list[coll]
+        conditions, params = [], []
+        if start is not None:
+            conditions.append(f'{time_field} >= ?')
+            params.append(_as_time_string(start))
+        if end is not None:
+            conditions.append(f'{time_field} < ?')
+            params.append(_as_time_string(end))
+        for column, values in [('detector_name', detector_names), ('tier', tiers)]:
+            if values is not None:
+                values = list(values)
+                conditions.append(f'{column} IN ({", ".join("?" * len(values))})')
+                params += values
+        op, order = ('>', 'ASC') if sort_order == pymongo.ASCENDING else ('<', 'DESC')
+        if after is not None:
+            conditions.append(f'({time_field}, doc_id) {op} (?, ?)')
+            params += list(after)
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        with self._lock:
+            self.flush()
+            rows = self.connection.execute(f'SELECT {time_field}, doc_id, document FROM {table} {where} '
+                                           f'ORDER BY {time_field} {order}, doc_id {order} LIMIT ?',
+                                           params + [limit]).fetchall()
+        next_cursor = (rows[-1][0], rows[-1][1]) if len(rows) == limit else None
+        return [_project(json.loads(document), projection) for _, _, document in rows], next_cursor
+
+    def iter_query(self, page_size=1000, **filters):
+        """ Stream all the messages matching the filters of `query`, one page at a time
+        """
+        after = None
+        while True:
+            documents, after = self.query(limit=page_size, after=after, **filters)
+            yield from documents
+            if after is None:
+                return
+
+    def _count(self, table):
+        with self._lock:
+            self.flush()
+            return self.connection.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def get_all_messages(self, sort_order=pymongo.ASCENDING):
+        """ Returns a list of all messages in the 'all-messages' collection
+        """
+        return self._find('all_mgs', sort_order)
+
+    def get_coincidence_tier_archive(self, sort_order=pymongo.ASCENDING):
+        """ Returns a list of all messages in the 'cache' collection
+        """
+        return self._find('coincidence_tier_archive', sort_order)
+
+    def get_false_warnings(self, sort_order=pymongo.ASCENDING):
+        """ Returns a list of all messages in the 'false warnings' collection
+        """
+        return self._find('false_warnings', sort_order)
+
+    def empty_retractions(self):
+        """ Returns True of if false warnings is empty
+        """
+        return self._count('false_warnings') == 0
+
+    def empty_coinc_archive(self):
+        """ Returns True of if coincidence cache is empty
+        """
+        return self._count('coincidence_tier_archive') <= 1
+
+    def purge_archive(self, coll):
+        """ Erases all items in a collection
+
+        Parameters
+        ----------
+        coll : `str`
+            name of collection
+
+        """
+        table = self.coll_list[coll]
+        with self._lock:
+            self.flush()
+            with self.connection:
+                self.connection.execute(f'DELETE FROM {table}')
+
+    def delete_messages(self, ids, before):
+        """ Delete the given messages, received before `before`, from all messages in one transaction
+        """
+        ids = list(ids)
+        deleted = 0
+        with self._lock:
+            self.flush()
+            with self.connection:
+                self.connection.execute('BEGIN')
+                # sqlite limits the number of parameters of a statement
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    deleted += self.connection.execute(
+                        f'DELETE FROM all_mgs WHERE received_time < ? AND doc_id IN ({", ".join("?" * len(chunk))})',
+                        [_as_time_string(before)] + chunk).rowcount
+        return deleted
+
+    def get_alert_collection(self, which_tier):
+        """ Returns a list of all documents of a specific alert collection, in received order
+        """
+        return self._find(self.coll_list[f'{which_tier}Alert'])
@@ -7,20 +7,26 @@ import os, json
 import pandas as pd
 from datetime import datetime
 import numpy as np
-from .cs_utils import set_env, make_beat_directory
+from .cs_utils import set_env, make_beat_directory, get_detector_names
 from .core.logging import getLogger
+from .hb_state import HeartBeatStateServer
+from .cs_stats import FalseAlarmService
 
 log = getLogger(__name__)
 
-# Check if detector name is in registered list.
-detector_file = os.path.abspath(os.path.join(os.path.dirname(__file__), 'auxiliary/detector_properties.json'))
-with open(detector_file) as file:
-    snews_detectors = json.load(file)
-snews_detectors = list(snews_detectors.keys())
-
 beats_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../beats"))
-mirror_csv = os.path.abspath(os.path.join(beats_path, f"cached_heartbeats_mirror.csv"))
-master_csv = os.path.abspath(os.path.join(beats_path, f"complete_heartbeat_log.csv"))
+mirror_csv = os.path.abspath(os.path.join(beats_path, "cached_heartbeats_mirror.csv"))
+master_csv = os.path.abspath(os.path.join(beats_path, "complete_heartbeat_log.csv"))
+
+# times are kept as datetime64[ns] and latencies as timedelta64[ns] columns, not as python objects
+column_dtypes = {"Received Times": "datetime64[ns]", "Detector": object, "Stamped Times": "datetime64[ns]",
+                 "Latency": "timedelta64[ns]", "Time After Last": "float64", "Status": object}
+
+def state_socket_path():
+    """ Path of the Unix socket sharing the heartbeat cache, env HB_STATE_SOCKET
+        It is read when needed, after `set_env` loaded the env file
+    """
+    return os.path.abspath(os.getenv("HB_STATE_SOCKET", os.path.join(beats_path, "heartbeat_state.sock")))
 
 def get_data_strings(df_input):
     """ Convert datetime objects to strings
@@ -43,15 +49,20 @@ class HeartBeat:
     """ Class to handle heartbeat message stream
     """
 
-    def __init__(self, env_path=None, store=True, firedrill_mode=True):
+    def __init__(self, env_path=None, store=True, firedrill_mode=True, share_state=True, directory=None):
         """
         :param store: `bool`
+        :param share_state: `bool` serve the live cache to `run-feedback` over a Unix socket
+        :param directory: `str` where the heartbeat logs are stored, defaults to `beats_path`
         """
         log.info("\t> Heartbeat Instance is created.")
         set_env(env_path)
         self.store = store
-        log.info(f"\t> Heartbeats are stored in {beats_path}.")
-        make_beat_directory(beats_path)
+        self.beats_path = os.path.abspath(directory or beats_path)
+        self.mirror_csv = os.path.join(self.beats_path, os.path.basename(mirror_csv))
+        self.master_csv = os.path.join(self.beats_path, os.path.basename(master_csv))
+        log.info(f"\t> Heartbeats are stored in {self.beats_path}.")
+        make_beat_directory(self.beats_path)
         self.stash_time = float(os.getenv("HB_STASH_TIME", "24"))  # hours
         self.delete_after = float(os.getenv("HB_DELETE_AFTER", "7"))  # days
         if firedrill_mode:
@@ -60,31 +71,54 @@ class HeartBeat:
             self.heartbeat_topic = os.getenv("OBSERVATION_TOPIC")
 
         self.column_names = ["Received Times", "Detector", "Stamped Times", "Latency", "Time After Last", "Status"]
-        self.cache_df = pd.DataFrame(columns=self.column_names)
-        self._last_row = pd.DataFrame(columns=self.column_names) #pd.Series(index=self.column_names)
+        self.cache_df = self.empty_cache()
+        self._last_row = self.empty_cache() #pd.Series(index=self.column_names)
+        # online detectors, for the false alarm probability of the alerts
+        self.false_alarms = FalseAlarmService()
+        # set by the coincidence system to log the registered beats, see `state_journal`
+        self.journal = None
+
+        # share the live cache with the feedback process, instead of only through the mirror csv
+        self.state_server = None
+        if share_state and os.getenv("HB_SHARE_STATE", "True").lower() == "true":
+            self.state_server = HeartBeatStateServer(state_socket_path())
+            if self.state_server.start():
+                self.publish_state()
+            else:
+                self.state_server = None
 
-    def make_entry(self, message):
-        """ Make an entry in the cache df using new message
-            # NOTE:
-            since we create last row separately, the sequence matters
-        """
-        msg = {"Received Times": message["Received Times"],
-               "Detector": message["detector_name"]}
+    def empty_cache(self):
+        return pd.DataFrame({col: pd.Series(dtype=column_dtypes[col]) for col in self.column_names})
 
-        stamped_time_obj = datetime.fromisoformat(message["sent_time"])
-        msg["Stamped Times"] = stamped_time_obj
-        msg["Latency"] = msg["Received Times"] - msg["Stamped Times"]
+    def make_entries(self, beats):
+        """ Make entries in the cache df for a batch of valid beats
+            # NOTE:
+            since we create last rows separately, the sequence matters
 
-        # check the last message of given detector
-        detector_df = self.cache_df[self.cache_df["Detector"] == msg['Detector']]
-        if len(detector_df):
-            msg["Time After Last"] = (msg["Received Times"] - detector_df["Received Times"].max()).total_seconds()
-        else:
-            msg["Time After Last"] = 0 #timedelta(0)
+        Parameters
+        ----------
+        beats : `pandas.DataFrame`
+            with columns 'Received Times', 'detector_name', 'sent_time', 'detector_status'
 
-        msg["Status"] = message["detector_status"]
-        self._last_row = pd.DataFrame([msg])
-        # add this new entry to cache
+        """
+        received = pd.to_datetime(beats["Received Times"]).astype("datetime64[ns]")
+        # parsed once, as naive UTC
+        stamped = pd.to_datetime(beats["sent_time"], format="ISO8601", utc=True).dt.tz_localize(None)
+        stamped = stamped.astype("datetime64[ns]")
+        entries = pd.DataFrame({"Received Times": received.values,
+                                "Detector": beats["detector_name"].values,
+                                "Stamped Times": stamped.values})
+        entries["Latency"] = entries["Received Times"] - entries["Stamped Times"]
+
+        # the previous beat of each detector is either earlier in this batch, or the last one in the cache
+        last_in_cache = self.cache_df.groupby("Detector")["Received Times"].max()
+        previous = entries.groupby("Detector")["Received Times"].shift()
+        previous = previous.fillna(entries["Detector"].map(last_in_cache))
+        entries["Time After Last"] = (entries["Received Times"] - previous).dt.total_seconds().fillna(0)
+
+        entries["Status"] = beats["detector_status"].values
+        self._last_row = entries
+        # add the new entries to cache
         self.cache_df = pd.concat([self.cache_df, self._last_row], ignore_index=True)
 
     def store_beats(self):
@@ -116,7 +150,13 @@ class HeartBeat:
             For heartbeat checks I need one that mirrors the current cache.
         """
         self.drop_old_messages()
-        self.cache_df.to_csv(mirror_csv, mode='w', header=True, index=False)
+        self.cache_df.to_csv(self.mirror_csv, mode='w', header=True, index=False)
+
+    def publish_state(self):
+        """ Hand the current cache to the state server, if sharing
+        """
+        if self.state_server is not None:
+            self.state_server.publish(self.cache_df)
 
     def dump_csv(self):
         """ dump a local csv file once a day
@@ -129,7 +169,7 @@ class HeartBeat:
         """
         today = datetime.utcnow()
         today_str = datetime.strftime(today, "%y-%m-%d")
-        output_csv_name = os.path.join(beats_path, f"{today_str}_heartbeat_log.csv")
+        output_csv_name = os.path.join(self.beats_path, f"{today_str}_heartbeat_log.csv")
         if os.path.exists(output_csv_name):
             self._last_row.to_csv(output_csv_name, mode='a', header=False, index=False)
         else:
@@ -151,7 +191,7 @@ class HeartBeat:
         curr_data = df.to_json(orient='columns')
         today = datetime.utcnow()
         today_str = datetime.strftime(today, "%y-%m-%d")
-        output_json_name = os.path.join(beats_path, f"{today_str}_heartbeat_log.json")
+        output_json_name = os.path.join(self.beats_path, f"{today_str}_heartbeat_log.json")
         # if os.path.exists(output_json_name):
         with open(output_json_name, 'w') as file:
             #     file_data = json.load(file)
@@ -165,10 +205,10 @@ class HeartBeat:
             Append and save everything
 
         """
-        if os.path.exists(master_csv):
-            self._last_row.to_csv(master_csv, mode='a', header=False, index=False)
+        if os.path.exists(self.master_csv):
+            self._last_row.to_csv(self.master_csv, mode='a', header=False, index=False)
         else:
-            self.cache_df.to_csv(master_csv, mode='w', header=True, index=False)
+            self.cache_df.to_csv(self.master_csv, mode='w', header=True, index=False)
 
     def burn_logs(self):
         """ Remove the logs after pre-decided time
@@ -177,7 +217,7 @@ class HeartBeat:
         today_fulldate = datetime.utcnow()
         today_str = datetime.strftime(today_fulldate, "%y-%m-%d")
         today = datetime.strptime(today_str, "%y-%m-%d")
-        existing_logs = os.listdir(beats_path)
+        existing_logs = os.listdir(self.beats_path)
         if self.store:
             existing_logs = np.array([x for x in existing_logs if (x.endswith('log.json') or x.endswith('log.csv')) and
                                       ("complete_heartbeat_log.csv" not in x)])
@@ -197,7 +237,7 @@ class HeartBeat:
         files = np.array(files)
         log.debug(f"\t> The following logs are older than {self.delete_after} days and will be removed; \n{files[older_than_limit[0]]}")
         for file in files[older_than_limit[0]]:
-            filepath = os.path.join(beats_path, file)
+            filepath = os.path.join(self.beats_path, file)
             os.remove(filepath)
             log.debug(f"\t> {file} deleted.")
 
@@ -209,47 +249,84 @@ class HeartBeat:
         print(f"\nCurrent cache \n{'=' * 133}\n{self.cache_df.to_markdown()}\n{'=' * 133}\n")
 
 
-    def sanity_checks(self, message):
-        """ check if the message will crash the server
+    def sanity_checks(self, beats):
+        """ check if the messages will crash the server
             Check  the following
-                 - detector frequencies are reasonable
-                 - latencies are reasonable
-                 - At least one detector is operational
+                 - detector name and status exist
+                 - the status is either ON or OFF
+                 - the detector is a registered one
+                 - the sent time can be parsed
+
+        Parameters
+        ----------
+        beats : `pandas.DataFrame`
+            one row per received heartbeat
+
+        Returns
+        -------
+        valid : `pandas.Series`
+            boolean mask of the valid beats
+
         """
-        issue = "no issue"
-        for key in ['detector_name', 'detector_status']:
-            if key not in message.keys():
-               issue = f" {key} is not in message keys"
-        if issue == "no issue":
-            if not isinstance(message['Received Times'], datetime):
-                issue = f" {message['Received Times']} is not a datetime object"
-            if not message['detector_status'].lower() in ['on','off']:
-                issue = f" {message['detector_status']} is neither ON nor OFF"
-            if not message['detector_name'] in snews_detectors:
-                issue = f" {message['detector_name']} is not a valid detector"
-
-        if issue == "no issue":
-            # do not log each time
-            return True
-        else:
+        status = beats["detector_status"].where(beats["detector_status"].map(type) == str)
+        valid = status.str.lower().isin(["on", "off"])
+        valid &= beats["detector_name"].isin(get_detector_names())
+        valid &= pd.to_datetime(beats["sent_time"], format="ISO8601", errors="coerce").notna()
+        for message in beats.loc[~valid, "message"]:
             log.error(f"\t> {message} is received at snews_hb.py but not valid.")
-            return False
-
+        return valid
 
     def electrocardiogram(self, message):
+        """ Register a single heartbeat, see `electrocardiogram_many`
+        """
+        return self.electrocardiogram_many([message]) == 1
+
+    def electrocardiogram_many(self, messages, received=None, replay=False):
+        """ Register a batch of heartbeats, e.g. everything drained from the consumer in one poll
+            The beats are validated together, added to the cache in one go,
+            and each file is written once per batch instead of once per beat.
+
+        Parameters
+        ----------
+        messages : `list`
+            heartbeat messages
+        received : `datetime.datetime`, optional
+            Received time of the beats without their own "Received Times", defaults to now
+        replay : `bool`, optional
+            Only rebuild the cache from already registered beats (journal replay),
+            without storing, publishing or journaling them again
+
+        Returns
+        -------
+        `int`
+            number of registered beats
+
+        """
+        if not len(messages):
+            return 0
         try:
-            message["Received Times"] = datetime.utcnow()
-            if self.sanity_checks(message):
-                self.make_entry(message)
+            received = received or datetime.utcnow()
+            for message in messages:
+                message.setdefault("Received Times", received)
+            beats = pd.DataFrame({"message": messages})
+            for key in ["detector_name", "detector_status", "sent_time"]:
+                beats[key] = [message.get(key) for message in messages]
+            beats["Received Times"] = [message["Received Times"] for message in messages]
+            beats = beats[self.sanity_checks(beats)]
+            if len(beats):
+                self.make_entries(beats)
+                self.false_alarms.update_many(beats)
+                if replay:
+                    return len(beats)
+                if self.journal is not None:
+                    self.journal.append('beats', (beats["message"].tolist(), received))
                 self.store_beats()
                 self.update_cache_csv()
+                self.publish_state()
                 # self.drop_old_messages()
                 self.burn_logs()
-                # if all successful, return True. Not logging each time, not to overcrowd
-                return True
-            else:
-                return False
-        except Exception as e:
-            log.error(f"\t Some heartbeats didn't make it\n{e}\n")
-            print(f"Something went terribly wrong \n {e}")
-            return False
+            # if all successful, return the count. Not logging each time, not to overcrowd
+            return len(beats)
+        except Exception:
+            log.exception("\t Some heartbeats didn't make it")
+            return 0
@@ -0,0 +1,181 @@
+"""
+Write-ahead log and snapshots of the live state
+
+The coincidence cache, the heartbeat cache and the feedback bookkeeping only live in
+the memory of their process. A `StateJournal` appends every input that changes this state
+to a log, and every so often writes a snapshot of the whole state and starts a new log.
+After a crash or a redeploy the state is restored by loading the snapshot and replaying
+the inputs logged after it, instead of starting from an empty cache.
+
+Files in the journal directory
+    snapshot.pkl : the latest snapshot, (seq, state) pickled
+    wal.log      : records (seq, kind, payload), each pickled and prefixed with its length
+
+"""
+
+import os
+import pickle
+import struct
+import threading
+import time
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+# outside of the source tree, so that a checkout or a redeploy does not touch it
+state_path = os.path.join("~", ".snews_cs", "state")
+
+_length = struct.Struct("!I")
+
+
+class StateJournal:
+    """ Log of the inputs of one process, with periodic snapshots of its state
+
+    Parameters
+    ----------
+    name : `str`
+        Sub-directory of the journal, one per process kind e.g. 'coincidence'
+    get_state : `callable`
+        Returns the (picklable) state to snapshot
+    directory : `str`, optional
+        Defaults to env STATE_DIR or ~/.snews_cs/state
+    snapshot_every : `int`, optional
+        Snapshot after this many records, defaults to env STATE_SNAPSHOT_EVERY or 1000
+    snapshot_interval : `float`, optional
+        or after this many seconds, defaults to env STATE_SNAPSHOT_INTERVAL or 300
+    fsync : `bool`, optional
+        Sync the log to disk after each record, defaults to env STATE_FSYNC or False.
+        Without it the records survive a crash of the process, not of the machine.
+
+    """
+
+    def __init__(self, name, get_state, directory=None, snapshot_every=None, snapshot_interval=None, fsync=None):
+        self.directory = os.path.join(os.path.expanduser(directory or os.getenv("STATE_DIR", state_path)), name)
+        self.get_state = get_state
+        self.snapshot_every = int(snapshot_every or os.getenv("STATE_SNAPSHOT_EVERY", "1000"))
+        self.snapshot_interval = float(snapshot_interval or os.getenv("STATE_SNAPSHOT_INTERVAL", "300"))
+        if fsync is None:
+            fsync = os.getenv("STATE_FSYNC", "False").lower() == "true"
+        self.fsync = fsync
+        self.snapshot_file = os.path.join(self.directory, "snapshot.pkl")
+        self.wal_file = os.path.join(self.directory, "wal.log")
+        self.seq = 0
+        self._since_snapshot = 0
+        self._last_snapshot = time.monotonic()
+        self._wal = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def restore(self):
+        """ Read the latest snapshot and the records logged after it
+
+        Returns
+        -------
+        (state, records) : (`object`, `list`)
+            state is None if there is no snapshot, records are (kind, payload) in logged order
+
+        """
+        t0 = time.monotonic()
+        snapshot_seq, state = 0, None
+        if os.path.isfile(self.snapshot_file):
+            with open(self.snapshot_file, "rb") as file:
+                snapshot_seq, state = pickle.load(file)
+        records = []
+        self.seq = snapshot_seq
+        for seq, kind, payload in self._read_wal():
+            # records of the snapshot are still in the log if we crashed before truncating it
+            if seq > snapshot_seq:
+                records.append((kind, payload))
+                self.seq = seq
+        self._since_snapshot = len(records)
+        log.info(f"\t> State restored from {self.directory}: snapshot #{snapshot_seq} and {len(records)} "
+                 f"logged records, read in {time.monotonic() - t0:.3f} sec.")
+        return state, records
+
+    def _read_wal(self):
+        """ The complete records of the log
+            A record cut by a crash is cut off the log, so that the next records are appended after
+            the last complete one, instead of after a record that stops the reading.
+        """
+        if not os.path.isfile(self.wal_file):
+            return []
+        records, end = [], 0
+        with open(self.wal_file, "rb") as file:
+            while True:
+                header = file.read(_length.size)
+                if not header:
+                    break
+                try:
+                    if len(header) < _length.size:
+                        raise EOFError
+                    length = _length.unpack(header)[0]
+                    body = file.read(length)
+                    if len(body) < length:
+                        raise EOFError
+                    records.append(pickle.loads(body))
+                except Exception:
+                    # the last record was cut by the crash
+                    log.error(f"\t> Truncating {self.wal_file} at the incomplete record at byte {end}")
+                    self._close_wal()
+                    os.truncate(self.wal_file, end)
+                    break
+                end = file.tell()
+        return records
+
+    def reset(self):
+        """ Start from an empty state, forget the previous snapshot and log
+        """
+        with self._lock:
+            self._close_wal()
+            for file in [self.snapshot_file, self.wal_file]:
+                if os.path.isfile(file):
+                    os.remove(file)
+            self.seq = 0
+            self._since_snapshot = 0
+
+    def append(self, kind, payload=None):
+        """ Log one input
+        """
+        with self._lock:
+            self.seq += 1
+            body = pickle.dumps((self.seq, kind, payload), protocol=pickle.HIGHEST_PROTOCOL)
+            if self._wal is None:
+                self._wal = open(self.wal_file, "ab", buffering=0)
+            self._wal.write(_length.pack(len(body)) + body)
+            if self.fsync:
+                os.fsync(self._wal.fileno())
+            self._since_snapshot += 1
+
+    def checkpoint(self, force=False):
+        """ Write a snapshot if enough records or time have passed since the last one, or if `force`
+            The state must include every appended record when this is called.
+        """
+        if not force and self._since_snapshot < self.snapshot_every and \
+                time.monotonic() - self._last_snapshot < self.snapshot_interval:
+            return False
+        with self._lock:
+            if not force and not self._since_snapshot and os.path.isfile(self.snapshot_file):
+                self._last_snapshot = time.monotonic()
+                return False
+            temp = self.snapshot_file + ".tmp"
+            with open(temp, "wb") as file:
+                pickle.dump((self.seq, self.get_state()), file, protocol=pickle.HIGHEST_PROTOCOL)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, self.snapshot_file)
+            # the snapshot covers the whole log, start a new one
+            self._close_wal()
+            open(self.wal_file, "wb").close()
+            self._since_snapshot = 0
+            self._last_snapshot = time.monotonic()
+        log.debug(f"\t> State snapshot #{self.seq} is written to {self.snapshot_file}")
+        return True
+
+    def _close_wal(self):
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+    def close(self):
+        with self._lock:
+            self._close_wal()
@@ -0,0 +1,64 @@
+""" Alerts published once through the leases, and again after a reset of the cache
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+from hop.models import JSONBlob
+
+from snews_cs.alert_lease import alert_identity
+from snews_cs.snews_coinc import CoincidenceDistributor
+from snews_cs.transport import memory_topic
+
+Position = namedtuple("Position", "topic partition offset")
+
+
+class Consumer:
+    def mark_done(self, metadata, asynchronous=True):
+        pass
+
+
+def observation(detector, seconds, now, resent=""):
+    return {"_id": f"{detector}_CoincidenceTier_{now.isoformat()}{resent}", "detector_name": detector,
+            "machine_time": now.isoformat(), "sent_time": now.isoformat(), "p_val": 0.1,
+            "neutrino_time": (now + timedelta(seconds=seconds)).isoformat(),
+            "meta": {"is_test": True}, "schema_version": "1.3.0"}
+
+
+@pytest.fixture
+def distributor(tmp_path, monkeypatch):
+    monkeypatch.setenv("LOCAL_DB_PATH", str(tmp_path / "snews_db.sqlite3"))
+    monkeypatch.setenv("STATE_DIR", str(tmp_path / "state"))
+    monkeypatch.setenv("ALERT_LEASE_DIR", str(tmp_path / "alert_leases"))
+    monkeypatch.setenv("ALERT_TOPIC", f"memory://{tmp_path.name}-alerts")
+    monkeypatch.setenv("FIREDRILL_ALERT_TOPIC", f"memory://{tmp_path.name}-alerts")
+    for key, value in dict(ALERT_LEASE="file", ARCHIVE_MESSAGES="False", HB_SHARE_STATE="False",
+                           snews_cs_admin_pass="secret").items():
+        monkeypatch.setenv(key, value)
+    distributor = CoincidenceDistributor(drop_db=True, hb_path=str(tmp_path / "beats"), send_slack=False,
+                                         storage_backend="sqlite")
+    yield distributor
+    distributor.shutdown()
+
+
+def test_reset_id_changes_the_identity():
+    alert = ("NEW_MESSAGE", ["JUNO", "IceCube"], ["t0", "t1"], [0.1, 0.1])
+    assert alert_identity(*alert, reset_id="observations:0:2") != alert_identity(*alert)
+    assert alert_identity(*alert, reset_id="observations:0:2") != alert_identity(*alert, reset_id="observations:0:7")
+
+
+def test_alerts_after_a_reset_are_published(distributor, tmp_path):
+    now = datetime.utcnow()
+    alerts = memory_topic(f"{tmp_path.name}-alerts").messages
+    reset = {"_id": "0_hard-reset", "pass": "secret", "detector_name": "JUNO", "meta": {}}
+    messages = [observation("JUNO", 0, now), observation("IceCube", 1, now), reset,
+                observation("JUNO", 0, now, resent="-again"), observation("IceCube", 1, now, resent="-again")]
+    batch = [(JSONBlob(message), Position("observations", 0, offset)) for offset, message in enumerate(messages)]
+
+    distributor.process_batch(batch[:2], Consumer())
+    published = len(alerts)
+    assert published > 0
+    # after a reset, the same observations are a new alert, not one already published
+    distributor.process_batch(batch[2:], Consumer())
+    assert distributor.renderer.reset_id == "observations:0:2"
+    assert len(alerts) == 2 * published
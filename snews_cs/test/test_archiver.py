@@ -0,0 +1,41 @@
+""" Archive the old messages of a local database and read them back
+"""
+import os
+from datetime import datetime, timedelta
+
+from snews_cs.archiver import ArchiveReader, MessageArchiver
+from snews_cs.snews_db import SQLiteStorage
+
+
+def message(i, received):
+    return {"_id": f"{i}_CoincidenceTier_{received.isoformat()}", "detector_name": "IceCube",
+            "neutrino_time": received.isoformat(), "p_val": 0.5, "received_time": received.isoformat()}
+
+
+def test_archive_and_read_back(tmp_path):
+    storage = SQLiteStorage(path=str(tmp_path / "snews_db.sqlite3"), drop_db=True)
+    now = datetime.utcnow()
+    old = [message(i, now - timedelta(days=10, hours=i)) for i in range(5)]
+    recent = [message(i, now - timedelta(hours=i)) for i in range(5, 8)]
+    for document in old + recent:
+        storage.insert_mgs(document)
+
+    archiver = MessageArchiver(storage, directory=str(tmp_path / "archive"), max_age=7, page_size=2)
+    assert archiver.archive_once(now=now) == 5
+    assert archiver.archive_once(now=now) == 0
+    # only the recent messages are left in the database
+    assert sorted(document["_id"] for document in storage.get_all_messages()) == \
+           sorted(document["_id"] for document in recent)
+    days = os.listdir(tmp_path / "archive" / "all_mgs")
+    assert sorted(days) == sorted({document["received_time"][:10] for document in old})
+
+    reader = ArchiveReader(storage, directory=str(tmp_path / "archive"))
+    documents = list(reader.iter_query())
+    expected = sorted(old + recent, key=lambda document: document["received_time"])
+    assert [document["_id"] for document in documents] == [document["_id"] for document in expected]
+    assert documents[0]["p_val"] == 0.5 and documents[0]["tier"] == "CoincidenceTier"
+
+    start = now - timedelta(days=10, hours=2, minutes=30)
+    ids = [document["_id"] for document in reader.iter_query(start=start, end=now - timedelta(days=1))]
+    assert ids == [document["_id"] for document in expected[2:5]]
+    storage.close()
@@ -0,0 +1,99 @@
+""" Mail delivery against a local SMTP stand-in
+
+The stand-in accepts everything and records the sessions and envelopes it receives.
+"""
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from snews_cs.cs_email import MailDelivery
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        server.sessions += 1
+        envelope = None
+        self.wfile.write(b"220 stand-in\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].split(":", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250 stand-in\r\n")
+            elif verb == "MAIL":
+                envelope = dict(sender=command.split(":", 1)[1].strip(" <>"), recipients=[])
+                self.wfile.write(b"250 OK\r\n")
+            elif verb == "RCPT":
+                envelope["recipients"].append(command.split(":", 1)[1].strip(" <>"))
+                self.wfile.write(b"250 OK\r\n")
+            elif verb == "DATA":
+                self.wfile.write(b"354 go ahead\r\n")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                server.envelopes.append(envelope)
+                self.wfile.write(b"250 OK\r\n")
+            elif verb == "QUIT":
+                self.wfile.write(b"221 bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+    server.daemon_threads = True
+    server.sessions, server.envelopes = 0, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _address(server):
+    return "{}:{}".format(*server.server_address)
+
+
+def _closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"127.0.0.1:{sock.getsockname()[1]}"
+
+
+@pytest.fixture(autouse=True)
+def no_monitor(monkeypatch):
+    monkeypatch.delenv("snews_monitor_email", raising=False)
+
+
+def test_one_envelope_per_recipient_over_one_session(smtp_server, tmp_path):
+    mailer = MailDelivery(server=_address(smtp_server), sender="cs@snews.org", outbox=str(tmp_path / "outbox.jsonl"))
+    assert mailer.send("first", "body", ["a@snews.org", "b@snews.org"])
+    assert mailer.send("second", "body", "c@snews.org")
+    mailer.close()
+    assert [envelope["recipients"] for envelope in smtp_server.envelopes] == \
+           [["a@snews.org"], ["b@snews.org"], ["c@snews.org"]]
+    assert smtp_server.sessions == 1
+
+
+def test_outbox_is_replayed(smtp_server, tmp_path):
+    outbox = tmp_path / "outbox.jsonl"
+    down = MailDelivery(server=_closed_port(), sender="cs@snews.org", outbox=str(outbox))
+    assert not down.send("queued", "body", ["a@snews.org", "b@snews.org"])
+    assert len(outbox.read_text().splitlines()) == 1
+
+    mailer = MailDelivery(server=_address(smtp_server), sender="cs@snews.org", outbox=str(outbox),
+                          retry_interval=60)
+    # the first retry runs when the retries start, e.g. at startup
+    mailer.start_retries()
+    deadline = time.monotonic() + 5
+    while len(smtp_server.envelopes) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    mailer.close()
+    assert sorted(envelope["recipients"][0] for envelope in smtp_server.envelopes) == ["a@snews.org", "b@snews.org"]
+    assert outbox.read_text() == ""
@@ -0,0 +1,34 @@
+""" The running false alarm service against the stateless computation on the heartbeat cache
+"""
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from snews_cs.cs_stats import FalseAlarmService, cache_false_alarm_rate, poisson_pmf
+
+
+def test_false_alarm_prob_matches_the_heartbeat_cache():
+    start = datetime(2026, 1, 1)
+    beats = [("IceCube", "ON", 0), ("KamLAND", "ON", 5), ("XENONnT", "ON", 10), ("Super-K", "ON", 12),
+             ("IceCube", "ON", 60), ("KamLAND", "OFF", 65), ("XENONnT", "ON", 70), ("Super-K", "ON", 72)]
+    hb_cache = pd.DataFrame({"Detector": [beat[0] for beat in beats],
+                             "Status": [beat[1] for beat in beats],
+                             "Received Times": [start + timedelta(seconds=beat[2]) for beat in beats]})
+    service = FalseAlarmService(rate=1, stale_after=900)
+    service.update_many(hb_cache.rename(columns={"Detector": "detector_name", "Status": "detector_status"}))
+    assert service.num_online == 3
+
+    now = start + timedelta(seconds=80)
+    for detectors in (["IceCube", "XENONnT"], ["IceCube", "XENONnT", "Super-K"]):
+        sub_group = pd.DataFrame({"detector_name": detectors})
+        expected = cache_false_alarm_rate(sub_group, hb_cache)
+        assert service.false_alarm_prob(len(detectors), now=now) == expected
+    assert service.false_alarm_prob(2, now=now) == poisson_pmf(2, 3) == 0.22404
+
+
+def test_stale_detectors_are_offline():
+    service = FalseAlarmService(rate=1, stale_after=900)
+    service.update("IceCube", "ON", 0.)
+    service.update("KamLAND", "ON", 600.)
+    assert service.false_alarm_prob(2, now=1000.) == poisson_pmf(2, 1)
+    assert service.num_online == 1
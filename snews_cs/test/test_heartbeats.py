@@ -0,0 +1,45 @@
+""" Ingest a batch of heartbeats and check the files they are stored to
+"""
+import json
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from snews_cs import snews_hb
+from snews_cs.cs_utils import get_detector_names
+
+
+def test_electrocardiogram_many(tmp_path):
+    heartbeat = snews_hb.HeartBeat(store=True, share_state=False, directory=str(tmp_path))
+
+    detectors = get_detector_names()[:3]
+    now = datetime.utcnow()
+    messages = [dict(detector_name=name, detector_status="ON", sent_time=(now - timedelta(seconds=i)).isoformat())
+                for i, name in enumerate(detectors)]
+    messages.append(dict(detector_name="NOT A DETECTOR", detector_status="ON", sent_time=now.isoformat()))
+    assert heartbeat.electrocardiogram_many(messages) == 3
+
+    today = now.strftime("%y-%m-%d")
+    with open(tmp_path / f"{today}_heartbeat_log.json") as file:
+        stored = json.loads(json.load(file))
+    assert sorted(stored["Detector"].values()) == sorted(detectors)
+
+    mirror = pd.read_csv(tmp_path / "cached_heartbeats_mirror.csv")
+    assert sorted(mirror["Detector"]) == sorted(detectors)
+    assert (mirror["Status"] == "ON").all()
+    for name in [f"{today}_heartbeat_log.csv", "complete_heartbeat_log.csv"]:
+        assert len(pd.read_csv(tmp_path / name)) == 3
+
+
+def test_beats_keep_their_receive_times(tmp_path):
+    heartbeat = snews_hb.HeartBeat(store=False, share_state=False, directory=str(tmp_path))
+    detector = get_detector_names()[0]
+    now = datetime.utcnow()
+    # two beats of a detector, read 30 seconds apart and registered in the same batch
+    messages = [dict(detector_name=detector, detector_status="ON", sent_time=(now + timedelta(seconds=t)).isoformat(),
+                     **{"Received Times": now + timedelta(seconds=t + 2)}) for t in (0, 30)]
+    assert heartbeat.electrocardiogram_many(messages, received=now + timedelta(seconds=60)) == 2
+
+    cache = heartbeat.cache_df
+    assert list(cache["Time After Last"]) == [0, 30]
+    assert (cache["Latency"] == pd.Timedelta(seconds=2)).all()
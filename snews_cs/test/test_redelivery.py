@@ -0,0 +1,79 @@
+""" A batch with a malformed message, and a message that fails to be stored
+"""
+import json
+import sqlite3
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+from hop.models import JSONBlob
+
+from snews_cs.snews_coinc import CoincidenceDistributor
+
+Position = namedtuple("Position", "topic partition offset")
+
+
+class Consumer:
+    """ Records the committed offsets
+    """
+
+    def __init__(self):
+        self.committed = []
+
+    def mark_done(self, metadata, asynchronous=True):
+        self.committed.append(metadata.offset)
+
+
+def observation(detector, seconds, now):
+    return {"_id": f"{detector}_CoincidenceTier_{now.isoformat()}", "detector_name": detector,
+            "machine_time": now.isoformat(), "sent_time": now.isoformat(), "p_val": 0.1,
+            "neutrino_time": (now + timedelta(seconds=seconds)).isoformat(),
+            "meta": {"is_test": True}, "schema_version": "1.3.0"}
+
+
+@pytest.fixture
+def distributor(tmp_path, monkeypatch):
+    monkeypatch.setenv("LOCAL_DB_PATH", str(tmp_path / "snews_db.sqlite3"))
+    monkeypatch.setenv("STATE_DIR", str(tmp_path / "state"))
+    monkeypatch.setenv("DEAD_LETTER_LOG", str(tmp_path / "dead_letters.jsonl"))
+    monkeypatch.setenv("ALERT_TOPIC", f"memory://{tmp_path.name}-alerts")
+    monkeypatch.setenv("FIREDRILL_ALERT_TOPIC", f"memory://{tmp_path.name}-alerts")
+    for key, value in dict(ALERT_LEASE="off", ARCHIVE_MESSAGES="False", HB_SHARE_STATE="False").items():
+        monkeypatch.setenv(key, value)
+    distributor = CoincidenceDistributor(drop_db=True, hb_path=str(tmp_path / "beats"), send_slack=False,
+                                         storage_backend="sqlite")
+    yield distributor
+    distributor.shutdown()
+
+
+def test_failed_message_is_read_again(distributor, tmp_path):
+    now = datetime.utcnow()
+    messages = [observation("JUNO", 0, now), ["not", "a", "message"],
+                observation("IceCube", 1, now), observation("XENONnT", 2, now)]
+    batch = [(JSONBlob(message), Position("observations", 0, offset)) for offset, message in enumerate(messages)]
+
+    insert_mgs = distributor.storage.insert_mgs
+    failures = [sqlite3.OperationalError("database is locked")]
+
+    def insert_once(message):
+        if message["detector_name"] == "IceCube" and failures:
+            raise failures.pop()
+        return insert_mgs(message)
+
+    distributor.storage.insert_mgs = insert_once
+    consumer = Consumer()
+    with pytest.raises(sqlite3.OperationalError):
+        distributor.process_batch(batch, consumer)
+    # the malformed message is passed over, the one that failed to be stored is not committed
+    assert consumer.committed == [1]
+    assert distributor.applied_offsets == {("observations", 0): 1}
+    with open(tmp_path / "dead_letters.jsonl") as file:
+        dead_letters = [json.loads(line) for line in file]
+    assert [letter["position"]["offset"] for letter in dead_letters] == [1]
+    assert dead_letters[0]["error"].startswith("AttributeError")
+
+    # the stream reconnects and resumes from the first message not committed
+    distributor.process_batch(batch[2:], consumer)
+    assert consumer.committed == [1, 3]
+    stored = sorted(message["detector_name"] for message in distributor.storage.get_all_messages())
+    assert stored == ["IceCube", "JUNO", "XENONnT"]
@@ -0,0 +1,89 @@
+""" Slack dispatcher against a mock WebClient
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+from slack_sdk.errors import SlackApiError
+
+from snews_cs.snews_bot import SlackDispatcher
+
+rendered = SimpleNamespace(slack_blocks=[], markdown="| table |")
+
+
+class MockClient:
+    """ Records the posts, answers each with a new ts
+        `rate_limited` posts are refused with a 429 first, `gate` holds the posts until it is set
+    """
+
+    def __init__(self, rate_limited=0, retry_after="0.2", gate=None):
+        self.posts = []
+        self.times = []
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.gate = gate
+
+    def chat_postMessage(self, **kwargs):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.times.append(time.monotonic())
+        if self.rate_limited:
+            self.rate_limited -= 1
+            response = SimpleNamespace(status_code=429, headers={"Retry-After": self.retry_after})
+            raise SlackApiError("ratelimited", response)
+        self.posts.append(kwargs)
+        return {"ts": str(len(self.posts))}
+
+
+def alert(alert_type, sub_group=0):
+    return {"alert_type": alert_type, "sub list number": sub_group}
+
+
+def test_token_bucket():
+    client = MockClient()
+    dispatcher = SlackDispatcher(client=client, channel="test", rate=20, burst=2)
+    for _ in range(3):
+        dispatcher.post({}, alert("NEW_MESSAGE", 0), True, "", rendered)
+    # 6 posts, the first 2 at once and the next 4 paced at 20 per second
+    assert len(client.posts) == 6
+    assert client.times[1] - client.times[0] < 0.02
+    assert client.times[-1] - client.times[0] >= 4 / 20 - 0.01
+
+
+def test_retry_after_rate_limit():
+    client = MockClient(rate_limited=1, retry_after="0.2")
+    dispatcher = SlackDispatcher(client=client, channel="test", rate=100, burst=10)
+    dispatcher.post({}, alert("NEW_MESSAGE"), True, "", rendered)
+    # the header is posted again after Retry-After, then the table
+    assert len(client.posts) == 2
+    assert client.times[1] - client.times[0] >= 0.2
+
+
+def test_updates_reply_in_the_thread_of_the_sub_group():
+    client = MockClient()
+    dispatcher = SlackDispatcher(client=client, channel="test", rate=100, burst=10)
+    dispatcher.submit({}, alert("NEW_MESSAGE", 0), True, "", rendered)
+    dispatcher.submit({}, alert("NEW_MESSAGE", 1), True, "", rendered)
+    dispatcher.submit({}, alert("UPDATE", 0), True, "", rendered)
+    dispatcher.submit({}, alert("RETRACTION", 1), True, "", rendered)
+    assert dispatcher.flush(timeout=5)
+    headers = [post for post in client.posts if "blocks" in post]
+    assert "thread_ts" not in headers[0] and "thread_ts" not in headers[1]
+    assert headers[2]["thread_ts"] == dispatcher.threads[0] == "1"
+    assert headers[3]["thread_ts"] == dispatcher.threads[1] == "3"
+
+
+def test_forget_threads_after_the_queued_alerts():
+    gate = threading.Event()
+    client = MockClient(gate=gate)
+    dispatcher = SlackDispatcher(client=client, channel="test", rate=100, burst=10)
+    dispatcher.submit({}, alert("NEW_MESSAGE", 0), True, "", rendered)
+    dispatcher.submit({}, alert("UPDATE", 0), True, "", rendered)
+    dispatcher.forget_threads()
+    # after the reset, sub-group 0 is a new one
+    dispatcher.submit({}, alert("UPDATE", 0), True, "", rendered)
+    gate.set()
+    assert dispatcher.flush(timeout=5)
+    headers = [post for post in client.posts if "blocks" in post]
+    assert headers[1]["thread_ts"] == "1"
+    assert "thread_ts" not in headers[2]
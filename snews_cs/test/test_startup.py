@@ -0,0 +1,44 @@
+""" Cold-start budget of the snews_cs CLI
+
+Each check runs a fresh interpreter with `-X importtime` and fails if a heavy
+dependency is imported where it is not needed. The cumulative import time depends on
+the load of the machine, it is only checked against a budget (in seconds) when one is
+given with env STARTUP_BUDGET_HELP (e.g. 0.5) or STARTUP_BUDGET_COINC (e.g. 3.0).
+"""
+import os
+import re
+import subprocess
+import sys
+
+help_budget = os.getenv("STARTUP_BUDGET_HELP")
+coinc_budget = os.getenv("STARTUP_BUDGET_COINC")
+
+
+def import_times(module):
+    """ Cumulative import time (s) of every module imported along with `module`
+    """
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         capture_output=True, text=True, check=True)
+    times = dict()
+    for line in out.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)", line)
+        if match:
+            times[match.group(2)] = int(match.group(1)) * 1e-6
+    return times
+
+
+def test_help_startup():
+    times = import_times("snews_cs.__main__")
+    for module in ("pandas", "hop", "matplotlib", "scipy", "slack_sdk"):
+        assert module not in times, f"{module} is imported by `snews_cs --help`"
+    if help_budget:
+        assert times["snews_cs.__main__"] < float(help_budget)
+    assert subprocess.run([sys.executable, "-m", "snews_cs", "--help"], capture_output=True).returncode == 0
+
+
+def test_run_coincidence_startup():
+    times = import_times("snews_cs.snews_coinc")
+    for module in ("matplotlib", "scipy", "slack_sdk"):
+        assert module not in times, f"{module} is imported by `snews_cs run-coincidence`"
+    if coinc_budget:
+        assert times["snews_cs.snews_coinc"] < float(coinc_budget)
@@ -0,0 +1,44 @@
+""" Restore the state journal after a crash in the middle of a record
+"""
+from snews_cs.state_journal import StateJournal
+
+
+def test_records_after_a_partial_one_are_kept(tmp_path):
+    state = []
+    journal = StateJournal("test", lambda: list(state), directory=str(tmp_path))
+    for i in range(3):
+        state.append(i)
+        journal.append("item", i)
+    assert journal.checkpoint(force=True)
+    journal.close()
+    # a record cut by a crash
+    with open(journal.wal_file, "ab") as file:
+        file.write(b"\x00\x00\x01\x00partial")
+
+    journal = StateJournal("test", lambda: list(state), directory=str(tmp_path))
+    snapshot, records = journal.restore()
+    assert snapshot == [0, 1, 2] and records == []
+    # forced, the snapshot is written again even without new records
+    assert journal.checkpoint(force=True)
+    for i in range(3, 5):
+        state.append(i)
+        journal.append("item", i)
+    journal.close()
+
+    snapshot, records = StateJournal("test", lambda: None, directory=str(tmp_path)).restore()
+    assert snapshot == [0, 1, 2] and records == [("item", 3), ("item", 4)]
+
+
+def test_partial_record_is_cut_on_restore(tmp_path):
+    journal = StateJournal("test", lambda: None, directory=str(tmp_path))
+    journal.append("item", 0)
+    journal.close()
+    with open(journal.wal_file, "ab") as file:
+        file.write(b"\x00\x00")
+
+    journal = StateJournal("test", lambda: None, directory=str(tmp_path))
+    assert journal.restore() == (None, [("item", 0)])
+    journal.append("item", 1)
+    journal.close()
+    assert StateJournal("test", lambda: None, directory=str(tmp_path)).restore() == \
+           (None, [("item", 0), ("item", 1)])
@@ -0,0 +1,285 @@
+"""
+Streams of messages, selected by the scheme of the topic URL
+
+    kafka://broker/topic     the hop client (default)
+    memory://name            a topic in the memory of this process, e.g. for tests and benchmarks
+    file:///path/to/file     json lines appended to a file, e.g. to replay recorded or simulated traffic
+
+`open_stream` returns a reader or a writer with the interface of the hop client that
+the coincidence system uses: `read(metadata, autocommit, ...)`, `mark_done(metadata)`,
+`write(message)`, `close()`, and use as a context manager. The memory and file readers
+keep the committed offset of each consumer group (files in `<path>.offsets/`), so
+they resume where they stopped, like a kafka consumer group.
+
+"""
+
+import os
+import json
+import time
+import threading
+from dataclasses import dataclass
+from .core.logging import getLogger
+
+log = getLogger(__name__)
+
+
+def _content(message):
+    """ The dict of a message, written as a dict or a `hop.models.JSONBlob`
+    """
+    return getattr(message, "content", message)
+
+
+@dataclass(frozen=True)
+class Metadata:
+    """ Position of a message read from a memory or file stream, as in `hop.io.Metadata`
+    """
+    topic: str
+    partition: int
+    offset: int
+    timestamp: int
+
+
+class _Reader:
+    """ The read loop shared by the memory and file readers, the subclasses implement
+        `_get(offset, timeout)` (the message at offset, None if there is none yet),
+        `_committed()` and `_commit(offset)`
+    """
+
+    def __init__(self, topic, group_id=None, until_eos=False):
+        self.topic = topic
+        self.group_id = group_id
+        self.until_eos = until_eos
+        self._closed = threading.Event()
+
+    def read(self, metadata=False, autocommit=True, **kwargs):
+        """ Yield the messages after the committed offset of the group, as `hop.models.JSONBlob`
+            batch_size and batch_timeout of the hop reader are accepted and ignored
+        """
+        from hop.models import JSONBlob
+        offset = self._committed()
+        while not self._closed.is_set():
+            content = self._get(offset, timeout=0.1)
+            if content is None:
+                if self.until_eos or self._finished():
+                    return
+                continue
+            position = Metadata(self.topic, 0, offset, int(time.time() * 1000))
+            message = JSONBlob(content)
+            yield (message, position) if metadata else message
+            offset += 1
+            if autocommit:
+                self.mark_done(position)
+
+    def _finished(self):
+        return False
+
+    def mark_done(self, metadata, asynchronous=True):
+        """ Commit everything up to and including `metadata`
+        """
+        self._commit(metadata.offset + 1)
+
+    def close(self):
+        self._closed.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class MemoryTopic:
+    """ Messages of an in-process topic, and the committed offsets of its groups
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = []
+        self.committed = dict()
+        self.finished = False
+        self.condition = threading.Condition()
+
+    def append(self, content):
+        with self.condition:
+            # copied through json, like a message sent to a broker
+            self.messages.append(json.loads(json.dumps(content, default=str)))
+            self.condition.notify_all()
+
+    def get(self, offset, timeout):
+        with self.condition:
+            if offset >= len(self.messages) and not self.finished:
+                self.condition.wait(timeout)
+            return self.messages[offset] if offset < len(self.messages) else None
+
+    def finish(self):
+        """ End the topic, its readers stop once they read everything
+        """
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+
+_memory_topics = dict()
+_memory_lock = threading.Lock()
+
+
+def memory_topic(name):
+    """ The in-process topic called `name`, created on first use
+    """
+    with _memory_lock:
+        if name not in _memory_topics:
+            _memory_topics[name] = MemoryTopic(name)
+        return _memory_topics[name]
+
+
+class MemoryConsumer(_Reader):
+
+    def __init__(self, name, group_id=None, until_eos=False):
+        super().__init__(name, group_id=group_id, until_eos=until_eos)
+        self.memory = memory_topic(name)
+
+    def _get(self, offset, timeout):
+        return self.memory.get(offset, timeout)
+
+    def _finished(self):
+        return self.memory.finished
+
+    def _committed(self):
+        return self.memory.committed.get(self.group_id, 0)
+
+    def _commit(self, offset):
+        if self.group_id is not None:
+            self.memory.committed[self.group_id] = max(offset, self._committed())
+
+
+class MemoryProducer:
+
+    def __init__(self, name):
+        self.memory = memory_topic(name)
+
+    def write(self, message):
+        self.memory.append(_content(message))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class FileConsumer(_Reader):
+    """ Reads a file of json lines, the offset of a message is its line number
+        Without `until_eos` it follows the file as lines are appended.
+    """
+
+    def __init__(self, path, group_id=None, until_eos=False):
+        super().__init__(path, group_id=group_id, until_eos=until_eos)
+        self.path = path
+        self.offsets_dir = f"{path}.offsets"
+        self._file = None
+        self._line = 0
+
+    def _get(self, offset, timeout):
+        if self._file is None:
+            if not os.path.isfile(self.path):
+                time.sleep(timeout)
+                return None
+            self._file = open(self.path)
+            self._line = 0
+        while self._line <= offset:
+            position = self._file.tell()
+            line = self._file.readline()
+            if not line.endswith("\n"):
+                # nothing more yet, or a line that is still being written
+                self._file.seek(position)
+                time.sleep(timeout)
+                return None
+            self._line += 1
+        return json.loads(line) if line.strip() else {}
+
+    def _offset_file(self):
+        return os.path.join(self.offsets_dir, f"{self.group_id}.offset")
+
+    def _committed(self):
+        if self.group_id is None or not os.path.isfile(self._offset_file()):
+            return 0
+        with open(self._offset_file()) as file:
+            return int(file.read().strip() or 0)
+
+    def _commit(self, offset):
+        if self.group_id is None:
+            return
+        os.makedirs(self.offsets_dir, exist_ok=True)
+        temp = self._offset_file() + ".tmp"
+        with open(temp, "w") as file:
+            file.write(str(offset))
+        os.replace(temp, self._offset_file())
+
+    def close(self):
+        super().close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FileProducer:
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def write(self, message):
+        with self._lock:
+            self._file.write(json.dumps(_content(message), default=str) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def open_stream(url, mode="r", group_id=None, until_eos=False, auth=True):
+    """ Open a topic for reading ('r') or writing ('w')
+
+    Parameters
+    ----------
+    url : `str`
+        kafka://broker/topic, memory://name or file:///path
+    mode : `str`
+        'r' or 'w'
+    group_id : `str`, optional
+        Consumer group of a reader, the committed offsets are kept per group
+    until_eos : `bool`
+        Stop reading at the end of the stream, instead of waiting for new messages
+    auth : `bool` or `hop.auth.Auth`
+        Credentials of the hop client, kafka only
+
+    """
+    if mode not in ("r", "w"):
+        raise ValueError(f"Unknown mode '{mode}', use 'r' or 'w'")
+    scheme, _, location = str(url).partition("://")
+    if scheme == "kafka":
+        from hop import Stream
+        stream = Stream(until_eos=until_eos, auth=auth)
+        if mode == "r":
+            return stream.open(url, mode, group_id=group_id)
+        return stream.open(url, mode)
+    if scheme == "memory":
+        return MemoryConsumer(location, group_id, until_eos) if mode == "r" else MemoryProducer(location)
+    if scheme == "file":
+        return FileConsumer(location, group_id, until_eos) if mode == "r" else FileProducer(location)
+    raise ValueError(f"Unknown stream '{url}', use kafka://, memory:// or file://")